@@ -0,0 +1,443 @@
+"""Retrieval benchmark for the reference-chunk query path.
+
+Seeds the local pgvector database (``DATABASE_URL``) with synthetic and real
+(``PSMT_ISMG.pdf``) chunks at several corpus sizes, runs labelled queries
+through every registered retriever and reports recall@k against exact search
+together with p50/p95 latency.
+
+Example:
+    python benchmark.py --sizes 100 1000 10000 --queries 50 --k 4 6
+    python benchmark.py --sources real --embedder gitee --embed-cache bench_vectors.json
+    python benchmark.py --index hnsw --ef-search 40 --json bench_output.json
+
+All benchmark rows live under ``bench-*`` assignment ids and are removed at the
+end of the run unless ``--keep`` is given.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import argparse
+import logging
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+from sqlalchemy import text as sqltext
+
+from rag_db import (
+    ReferenceChunk,
+    EmbeddingModel,
+    get_db_session,
+    run_chunker,
+    clean_chunks,
+    topk_reference_chunks,
+    topk_rubric,
+    topk_lexical,
+    fuse_rrf,
+)
+
+logging.basicConfig(level=logging.INFO)
+
+BENCH_PREFIX = "bench-"
+DEFAULT_PDF = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "..", "ragdb", "training-data", "PSMT_ISMG.pdf")
+)
+
+
+@dataclass
+class BenchQuery:
+    """A labelled query: the vector/text to search with and the chunk it came from."""
+
+    vector: List[float]
+    text: str
+    label: str
+
+
+@dataclass
+class Retriever:
+    """A query path under test.
+
+    ``fn(session, assignment_id, query, k)`` returns chunk contents in rank order.
+    ``doc_type`` is the filter the exact-search ground truth must apply so that
+    recall compares like with like (``None`` means every doc type). ``dims``
+    pins index-backed retrievers to corpora of one dimensionality.
+    """
+
+    name: str
+    fn: Callable
+    doc_type: Optional[str] = None
+    dims: Optional[int] = None
+
+
+@dataclass
+class Corpus:
+    assignment_id: str
+    source: str
+    size: int
+    dims: int
+    queries: List[BenchQuery] = field(default_factory=list)
+
+
+# ---------------------------------------------------------------------
+# Retriever registry – new indexes / backends register themselves here
+# ---------------------------------------------------------------------
+
+RETRIEVERS: Dict[str, Retriever] = {}
+
+
+def register_retriever(
+    name: str, fn: Callable, doc_type: Optional[str] = None, dims: Optional[int] = None
+):
+    RETRIEVERS[name] = Retriever(name=name, fn=fn, doc_type=doc_type, dims=dims)
+
+
+register_retriever(
+    "topk_reference_chunks",
+    lambda session, aid, q, k: topk_reference_chunks(session, aid, q.vector, k=k),
+)
+register_retriever(
+    "topk_rubric",
+    lambda session, aid, q, k: topk_rubric(session, aid, q.vector, k=k),
+    doc_type="rubric",
+)
+# Lexical retrievers ignore the vector; recall@k against exact vector search
+# shows how far they drift from it, hit@k whether they still find the label.
+register_retriever(
+    "lexical",
+    lambda session, aid, q, k: topk_lexical(session, aid, q.text, k=k),
+)
+register_retriever(
+    "hybrid_rrf",
+    lambda session, aid, q, k: fuse_rrf(
+        [
+            topk_reference_chunks(session, aid, q.vector, k=k),
+            topk_lexical(session, aid, q.text, k=k),
+        ],
+        k=k,
+    ),
+)
+
+
+def exact_topk(session, assignment_id: str, query_vec: List[float], k: int, doc_type=None):
+    """Ground truth: sequential-scan L2 ordering with every index path disabled."""
+    session.execute(sqltext("SET LOCAL enable_indexscan = off"))
+    session.execute(sqltext("SET LOCAL enable_bitmapscan = off"))
+    stmt = sqltext(
+        """
+        SELECT content
+        FROM   reference_chunks
+        WHERE  assignment_id = :aid
+          AND  (CAST(:dtype AS TEXT) IS NULL OR doc_type = :dtype)
+        ORDER  BY embedding <-> CAST(:qvec AS VECTOR)
+        LIMIT  :limit;
+        """
+    )
+    rows = session.execute(
+        stmt, {"aid": assignment_id, "qvec": str(query_vec), "limit": k, "dtype": doc_type}
+    ).fetchall()
+    return [r[0] for r in rows]
+
+
+# ---------------------------------------------------------------------
+# Corpus seeding
+# ---------------------------------------------------------------------
+
+
+def _unit(vec: List[float]) -> List[float]:
+    norm = math.sqrt(sum(v * v for v in vec)) or 1.0
+    return [v / norm for v in vec]
+
+
+def _perturb(vec: List[float], scale: float, rng: random.Random) -> List[float]:
+    return _unit([v + rng.gauss(0.0, scale) for v in vec])
+
+
+def _doc_type(i: int) -> str:
+    # Roughly one rubric chunk for every two exemplar chunks.
+    return "rubric" if i % 3 == 0 else "exemplar"
+
+
+def _insert(session, assignment_id: str, rows):
+    session.bulk_save_objects(
+        [
+            ReferenceChunk(
+                assignment_id=assignment_id, doc_type=doc_type, content=content, embedding=vec
+            )
+            for content, vec, doc_type in rows
+        ]
+    )
+    session.commit()
+
+
+def seed_synthetic(session, size: int, dims: int, n_queries: int, rng: random.Random) -> Corpus:
+    """Clustered random vectors, so neighbours are meaningful rather than uniform noise."""
+    corpus = Corpus(f"{BENCH_PREFIX}synthetic-{size}", "synthetic", size, dims)
+    n_topics = max(4, size // 25)
+    centroids = [_unit([rng.gauss(0.0, 1.0) for _ in range(dims)]) for _ in range(n_topics)]
+
+    rows = []
+    for i in range(size):
+        topic = i % n_topics
+        rows.append(
+            (f"synthetic chunk {i} topic {topic}", _perturb(centroids[topic], 0.05, rng), _doc_type(i))
+        )
+    _insert(session, corpus.assignment_id, rows)
+
+    for i in rng.sample(range(size), min(n_queries, size)):
+        content, vec, _ = rows[i]
+        corpus.queries.append(BenchQuery(vector=_perturb(vec, 0.01, rng), text=content, label=content))
+    return corpus
+
+
+def _load_vectors(cache_path: Optional[str]) -> Dict[str, List[float]]:
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            return json.load(f)
+    return {}
+
+
+def _embed_cached(embedder, texts: List[str], cache: Dict[str, List[float]]) -> List[List[float]]:
+    missing = [t for t in dict.fromkeys(texts) if t not in cache]
+    if missing:
+        for t, vec in zip(missing, embedder.embed(missing)):
+            cache[t] = vec
+    return [cache[t] for t in texts]
+
+
+def seed_real(
+    session,
+    size: int,
+    n_queries: int,
+    pdf_path: str,
+    embedder_name: str,
+    cache_path: Optional[str],
+    rng: random.Random,
+) -> Corpus:
+    """Chunks of the marking guide, padded with perturbed copies up to ``size``.
+
+    Queries are the first sentence of a sampled chunk, embedded with the same
+    model, and are labelled with the chunk they were cut from.
+    """
+    chunks = clean_chunks(run_chunker(pdf_path, "recursive"))
+    chunks = list(dict.fromkeys(c.replace("\x00", "") for c in chunks))
+    if not chunks:
+        raise RuntimeError(f"No chunks extracted from {pdf_path}")
+
+    cache = _load_vectors(cache_path)
+    embedder = EmbeddingModel(embedder_name)
+    vectors = _embed_cached(embedder, chunks, cache)
+    dims = len(vectors[0])
+
+    corpus = Corpus(f"{BENCH_PREFIX}real-{size}", "real", size, dims)
+    rows = [(c, v, _doc_type(i)) for i, (c, v) in enumerate(zip(chunks, vectors))][:size]
+    i = len(rows)
+    while len(rows) < size:
+        src = rng.randrange(len(chunks))
+        rows.append((f"[distractor {i}] {chunks[src]}", _perturb(vectors[src], 0.05, rng), _doc_type(i)))
+        i += 1
+    _insert(session, corpus.assignment_id, rows)
+
+    sampled = rng.sample(range(min(len(chunks), size)), min(n_queries, len(chunks), size))
+    query_texts = [chunks[j].split(". ")[0][:300] for j in sampled]
+    query_vecs = _embed_cached(embedder, query_texts, cache)
+    for j, qtext, qvec in zip(sampled, query_texts, query_vecs):
+        corpus.queries.append(BenchQuery(vector=qvec, text=qtext, label=chunks[j]))
+
+    if cache_path:
+        with open(cache_path, "w") as f:
+            json.dump(cache, f)
+    return corpus
+
+
+# ---------------------------------------------------------------------
+# Optional ANN index under test
+# ---------------------------------------------------------------------
+
+
+def _index_name(corpus: Corpus, kind: str) -> str:
+    return f"bench_{kind}_{corpus.source}_{corpus.size}"
+
+
+def create_index(session, corpus: Corpus, kind: str):
+    """Partial expression index over one benchmark corpus.
+
+    ``reference_chunks.embedding`` is declared without dimensions, so the index
+    is built on a dimension-typed cast and the matching retriever orders by the
+    same expression.
+    """
+    opts = "WITH (lists = %d)" % max(1, int(math.sqrt(corpus.size))) if kind == "ivfflat" else ""
+    session.execute(
+        sqltext(
+            f"""
+            CREATE INDEX IF NOT EXISTS {_index_name(corpus, kind)}
+            ON reference_chunks USING {kind} ((embedding::vector({corpus.dims})) vector_l2_ops)
+            {opts}
+            WHERE assignment_id = '{corpus.assignment_id}'
+            """
+        )
+    )
+    session.commit()
+
+
+def register_index_retriever(kind: str, dims: int, ef_search: Optional[int], probes: Optional[int]):
+    def query(session, aid, q, k):
+        if kind == "hnsw" and ef_search:
+            session.execute(sqltext(f"SET LOCAL hnsw.ef_search = {int(ef_search)}"))
+        if kind == "ivfflat" and probes:
+            session.execute(sqltext(f"SET LOCAL ivfflat.probes = {int(probes)}"))
+        stmt = sqltext(
+            f"""
+            SELECT content
+            FROM   reference_chunks
+            WHERE  assignment_id = :aid
+            ORDER  BY embedding::vector({dims}) <-> CAST(:qvec AS VECTOR({dims}))
+            LIMIT  :limit;
+            """
+        )
+        rows = session.execute(stmt, {"aid": aid, "qvec": str(q.vector), "limit": k}).fetchall()
+        return [r[0] for r in rows]
+
+    register_retriever(f"{kind}_{dims}", query, dims=dims)
+
+
+# ---------------------------------------------------------------------
+# Measurement
+# ---------------------------------------------------------------------
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100.0
+    lo, hi = math.floor(rank), math.ceil(rank)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (rank - lo)
+
+
+def run_retriever(session, corpus: Corpus, retriever: Retriever, k: int, warmup: int = 3) -> dict:
+    for q in corpus.queries[:warmup]:
+        retriever.fn(session, corpus.assignment_id, q, k)
+        session.rollback()
+
+    latencies, recalls, hits = [], [], []
+    for q in corpus.queries:
+        start = time.perf_counter()
+        got = retriever.fn(session, corpus.assignment_id, q, k)
+        latencies.append((time.perf_counter() - start) * 1000.0)
+        session.rollback()
+
+        truth = exact_topk(session, corpus.assignment_id, q.vector, k, retriever.doc_type)
+        session.rollback()
+        if truth:
+            recalls.append(len(set(got) & set(truth)) / len(truth))
+        hits.append(1.0 if q.label in got else 0.0)
+
+    return {
+        "source": corpus.source,
+        "size": corpus.size,
+        "retriever": retriever.name,
+        "k": k,
+        "queries": len(corpus.queries),
+        "recall_at_k": sum(recalls) / len(recalls) if recalls else float("nan"),
+        "label_hit_at_k": sum(hits) / len(hits) if hits else float("nan"),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+    }
+
+
+def print_report(results: List[dict]):
+    header = f"{'source':<10} {'size':>7} {'retriever':<24} {'k':>3} {'recall@k':>9} {'hit@k':>7} {'p50 ms':>9} {'p95 ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['source']:<10} {r['size']:>7} {r['retriever']:<24} {r['k']:>3} "
+            f"{r['recall_at_k']:>9.3f} {r['label_hit_at_k']:>7.3f} {r['p50_ms']:>9.2f} {r['p95_ms']:>9.2f}"
+        )
+
+
+def cleanup(session):
+    for (name,) in session.execute(
+        sqltext("SELECT indexname FROM pg_indexes WHERE indexname LIKE 'bench\\_%'")
+    ).fetchall():
+        session.execute(sqltext(f"DROP INDEX IF EXISTS {name}"))
+    session.execute(
+        sqltext("DELETE FROM reference_chunks WHERE assignment_id LIKE :prefix"),
+        {"prefix": BENCH_PREFIX + "%"},
+    )
+    session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reference-chunk retrieval.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--queries", type=int, default=50, help="Labelled queries per corpus.")
+    parser.add_argument("--k", type=int, nargs="+", default=[4, 6])
+    parser.add_argument(
+        "--sources", nargs="+", choices=["synthetic", "real"], default=["synthetic", "real"]
+    )
+    parser.add_argument("--dims", type=int, default=1024, help="Synthetic vector dimensions.")
+    parser.add_argument("--pdf", default=DEFAULT_PDF, help="Real reference document.")
+    parser.add_argument(
+        "--embedder", choices=["openai", "gemini", "gitee"], default="gitee",
+        help="Embedding model for the real corpus.",
+    )
+    parser.add_argument("--embed-cache", help="JSON file caching real-corpus embeddings.")
+    parser.add_argument(
+        "--retrievers", nargs="+", help="Subset of registered retrievers (default: all)."
+    )
+    parser.add_argument("--index", choices=["hnsw", "ivfflat"], help="Also benchmark an ANN index.")
+    parser.add_argument("--ef-search", type=int, help="hnsw.ef_search for the HNSW retriever.")
+    parser.add_argument("--probes", type=int, help="ivfflat.probes for the IVFFlat retriever.")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", help="Write results to this JSON file.")
+    parser.add_argument("--keep", action="store_true", help="Keep seeded rows and indexes.")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    session = get_db_session()
+    results = []
+    try:
+        cleanup(session)
+        for source in args.sources:
+            for size in args.sizes:
+                logging.info("Seeding %s corpus with %d chunks", source, size)
+                if source == "synthetic":
+                    corpus = seed_synthetic(session, size, args.dims, args.queries, rng)
+                else:
+                    corpus = seed_real(
+                        session, size, args.queries, args.pdf, args.embedder, args.embed_cache, rng
+                    )
+                session.execute(sqltext("ANALYZE reference_chunks"))
+                session.commit()
+
+                if args.index:
+                    create_index(session, corpus, args.index)
+                    register_index_retriever(args.index, corpus.dims, args.ef_search, args.probes)
+
+                names = args.retrievers or list(RETRIEVERS)
+                for name in names:
+                    retriever = RETRIEVERS.get(name)
+                    if retriever is None or retriever.dims not in (None, corpus.dims):
+                        continue
+                    for k in args.k:
+                        results.append(run_retriever(session, corpus, retriever, k))
+    finally:
+        if not args.keep:
+            cleanup(session)
+        session.close()
+
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Per-provider circuit breakers for the LLM provider chain.
+
+A provider that keeps failing is taken out of rotation ("open") for
+``LLM_BREAKER_RESET_S`` seconds; after that a single probe request is let
+through ("half_open"). The probe closing or re-opening the breaker decides
+whether the provider is routed to again.
+"""
+
+import os
+import time
+import threading
+
+BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+BREAKER_RESET_S = float(os.getenv("LLM_BREAKER_RESET_S", "30"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset_s: float = BREAKER_RESET_S):
+        self.name = name
+        self.failure_threshold = failures
+        self.reset_s = reset_s
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.probe_in_flight = False
+        self.last_error = None
+        # The API loop and the sync-wrapper loop run on different threads.
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now; claims the probe slot when half open."""
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_s:
+                self.state = HALF_OPEN
+                self.probe_in_flight = False
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self, error: Exception | None = None):
+        with self._lock:
+            self.last_error = (str(error) or type(error).__name__) if error else None
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.probe_in_flight = False
+
+    def release(self):
+        """Give back a claimed probe slot without a verdict (request was cancelled)."""
+        with self._lock:
+            self.probe_in_flight = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            retry_in = None
+            if self.state == OPEN:
+                retry_in = max(0.0, round(self.reset_s - (time.monotonic() - self.opened_at), 1))
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "retry_in_s": retry_in,
+                "last_error": self.last_error,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def breaker(provider: str) -> CircuitBreaker:
+    with _breakers_lock:
+        b = _breakers.get(provider)
+        if b is None:
+            b = _breakers[provider] = CircuitBreaker(provider)
+        return b
+
+
+def breaker_states() -> dict:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.snapshot() for b in breakers}
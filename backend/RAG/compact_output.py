@@ -0,0 +1,131 @@
+"""Compact wire format for the grading model's output.
+
+Output tokens dominate generation time, and the verbose feedback JSON spends
+many of them on key names and criterion names. In compact mode the model
+answers with short keys, criteria by position in a legend and marks as
+``[mark, maxMark]`` pairs::
+
+    {"w": 812, "i": "overall idea",
+     "m": [[3, 4], [5, 7], [4, 5], [3, 4]],
+     "e": ["evidence", ...], "j": ["justification", ...],
+     "b": ["borderline decision", ...], "f": "feedback for improvement"}
+
+The service expands it into the usual ``overall_details`` / ``criteria`` /
+``overall_evaluation`` shape (totals are summed here, not by the model)
+before the feedback is repaired, stored or returned.
+"""
+
+import os
+import json
+
+from feedback_json import GRADING_CRITERIA, loads_tolerant
+from token_budget import count_tokens
+import metrics as service_metrics
+
+# Opt-in (RAG_COMPACT_OUTPUT=1); requests can also ask for it with compact=true.
+COMPACT_OUTPUT = os.getenv("RAG_COMPACT_OUTPUT", "0") == "1"
+
+# Gemini response schema; every array is homogeneous so it can be expressed.
+COMPACT_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "w": {"type": "integer"},
+        "i": {"type": "string"},
+        "m": {"type": "array", "items": {"type": "array", "items": {"type": "number"}}},
+        "e": {"type": "array", "items": {"type": "string"}},
+        "j": {"type": "array", "items": {"type": "string"}},
+        "b": {"type": "array", "items": {"type": "string"}},
+        "f": {"type": "string"},
+    },
+    "required": ["w", "i", "m", "e", "j", "b", "f"],
+}
+
+
+def compact_instruction(criteria: list[str] | None = None) -> str:
+    """Replaces the system prompt's OUTPUT FORMAT for this request."""
+    criteria = criteria or GRADING_CRITERIA
+    legend = ", ".join(f"{i}={name}" for i, name in enumerate(criteria))
+    return (
+        "Ignore the OUTPUT FORMAT given earlier and reply with only this compact JSON:\n"
+        '{"w": word_count, "i": "overall idea", "m": [[mark, maxMark], ...], '
+        '"e": ["evidence", ...], "j": ["justification", ...], '
+        '"b": ["borderline decision", ...], "f": "feedback for improvement"}\n'
+        f"m, e and j have one entry per criterion in this order: {legend}. "
+        "Do not include a total. Provide holistic feedback for the following essay:"
+    )
+
+
+def is_compact(feedback) -> bool:
+    return isinstance(feedback, dict) and "m" in feedback and "criteria" not in feedback
+
+
+def _number(value) -> float:
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+
+def _at(values, index, default=""):
+    return values[index] if isinstance(values, list) and index < len(values) else default
+
+
+def expand_feedback(compact: dict, criteria: list[str] | None = None) -> dict:
+    """The verbose feedback document for a compact answer."""
+    criteria = criteria or GRADING_CRITERIA
+    marks = compact.get("m") if isinstance(compact.get("m"), list) else []
+    expanded = {}
+    for index, pair in enumerate(marks):
+        pair = pair if isinstance(pair, list) else [pair]
+        name = criteria[index] if index < len(criteria) else f"Criterion {index + 1}"
+        expanded[name] = {
+            "mark": _at(pair, 0, None),
+            "maxMark": _at(pair, 1, None),
+            "evidence": _at(compact.get("e"), index),
+            "justification": _at(compact.get("j"), index),
+        }
+    borderline = compact.get("b")
+    return {
+        "overall_details": {
+            "word_count": compact.get("w", 0),
+            "overall_idea": compact.get("i", ""),
+        },
+        "criteria": expanded,
+        "overall_evaluation": {
+            "total_mark": sum(_number(c["mark"]) for c in expanded.values()),
+            "maxMark": sum(_number(c["maxMark"]) for c in expanded.values()),
+            "marker_notes": {"borderline_decisions": borderline if isinstance(borderline, list) else []},
+            "feedback for improvement": compact.get("f", ""),
+        },
+    }
+
+
+def expand_text(text: str) -> str:
+    """``text`` as verbose feedback JSON if it is a compact answer, else unchanged."""
+    try:
+        compact = loads_tolerant(text)
+    except ValueError:
+        return text
+    if not is_compact(compact):
+        return text
+    return json.dumps(expand_feedback(compact))
+
+
+def expand_and_measure(text: str, model: str, metrics: dict) -> str:
+    """:func:`expand_text`, recording how many output tokens the compact form saved.
+
+    The saving is measured against the expanded document laid out the way
+    the system prompt's format shows it (two-space indent).
+    """
+    expanded = expand_text(text)
+    if expanded is text:
+        service_metrics.incr("compact_output.not_compact")
+        return text
+    tokens = count_tokens(text, model)
+    verbose_tokens = count_tokens(json.dumps(json.loads(expanded), indent=2), model)
+    metrics["compact_output"] = {
+        "tokens": tokens,
+        "expanded_tokens": verbose_tokens,
+        "saved_tokens": verbose_tokens - tokens,
+    }
+    service_metrics.observe("compact_output.saved_tokens", verbose_tokens - tokens)
+    if verbose_tokens:
+        service_metrics.observe("compact_output.saved_ratio", 1 - tokens / verbose_tokens)
+    return expanded
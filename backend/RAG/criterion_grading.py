@@ -0,0 +1,260 @@
+"""Per-criterion grading fan-out.
+
+The default pipeline marks every criterion in one long generation. In
+``per_criterion`` mode each criterion gets its own smaller call that sees only
+that criterion's rubric, plus one short call for the overview. The calls run
+concurrently, so latency follows the slowest criterion rather than the sum of
+all of them, and the answers are merged into the usual ``overall_details`` /
+``criteria`` / ``overall_evaluation`` document before repair and storage.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import Counter
+
+from rag_db import get_sessionmaker, topk_lexical
+from feedback_json import GRADING_CRITERIA, loads_tolerant
+from llm import (
+    ProviderChain,
+    _retrieve,
+    arepair_feedback,
+    budgeted_feedback_messages,
+    record_usage,
+    run_sync,
+    store_feedback,
+    sum_usage,
+)
+import metrics as service_metrics
+
+GRADING_MODES = ("single", "per_criterion")
+GRADING_MODE = os.getenv("RAG_GRADING_MODE", "single")
+CRITERION_RUBRIC_K = 2
+
+CRITERION_INSTRUCTION = (
+    'Mark ONLY the criterion "{criterion}" against the rubric above; this replaces the '
+    "OUTPUT FORMAT given earlier. Reply with a single JSON object and nothing else:\n"
+    '{{"mark": 0, "maxMark": 0, "evidence": "", "justification": "", '
+    '"borderline": "", "improvement": ""}}\n'
+    '"borderline" describes a close call between two mark bands (empty if there was none); '
+    '"improvement" is one or two sentences of advice on this criterion. The essay:'
+)
+OVERVIEW_INSTRUCTION = (
+    "Do not mark the essay; other markers grade the criteria. Reply with a single JSON "
+    'object and nothing else: {"overall_idea": ""} – two or three sentences on the '
+    "student's overall approach. The essay:"
+)
+
+# Gemini response schemas for the two kinds of call.
+CRITERION_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "mark": {"type": "number"},
+        "maxMark": {"type": "number"},
+        "evidence": {"type": "string"},
+        "justification": {"type": "string"},
+        "borderline": {"type": "string"},
+        "improvement": {"type": "string"},
+    },
+    "required": ["mark", "maxMark", "evidence", "justification"],
+}
+OVERVIEW_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {"overall_idea": {"type": "string"}},
+    "required": ["overall_idea"],
+}
+
+
+def cache_salt(criteria: list[str] | None = None) -> str:
+    """Appended to the system prompt in the feedback cache key for this mode."""
+    return "\n[per_criterion]\n" + CRITERION_INSTRUCTION + "\n" + ",".join(criteria or GRADING_CRITERIA)
+
+
+def criterion_rubrics(assignment_id: str, rubric_ctx: list[str], criteria: list[str]) -> dict:
+    """Rubric chunks for each criterion.
+
+    Chunks that name the criterion are taken from the prompt's rubric context;
+    a criterion none of them mentions is looked up by full-text search, and
+    failing that gets the whole rubric context.
+    """
+    rubrics = {
+        name: [chunk for chunk in rubric_ctx if name.lower() in chunk.lower()] for name in criteria
+    }
+    missing = [name for name, chunks in rubrics.items() if not chunks]
+    if missing:
+        Session = get_sessionmaker()
+        with Session() as session:
+            for name in missing:
+                rubrics[name] = (
+                    topk_lexical(session, assignment_id, name, k=CRITERION_RUBRIC_K, doc_type="rubric")
+                    or list(rubric_ctx)
+                )
+    return rubrics
+
+
+def _number(value) -> float:
+    return value if isinstance(value, (int, float)) and not isinstance(value, bool) else 0
+
+
+def merge_feedback(essay_text: str, overview: dict, results: dict, criteria: list[str]) -> dict:
+    """Assemble per-criterion answers into the single-call feedback shape."""
+    merged = {}
+    borderline, improvement = [], []
+    for name in criteria:
+        details = dict(results[name])
+        note = details.pop("borderline", "")
+        advice = details.pop("improvement", "")
+        if note:
+            borderline.append(f"{name}: {note}")
+        if advice:
+            improvement.append(f"{name}: {advice}")
+        merged[name] = details
+    feedback = {
+        "overall_details": {
+            "word_count": len(essay_text.split()),
+            "overall_idea": overview.get("overall_idea", ""),
+        },
+        "criteria": merged,
+        "overall_evaluation": {
+            "marker_notes": {"borderline_decisions": borderline},
+            "feedback for improvement": "\n".join(improvement),
+        },
+    }
+    return add_totals(feedback)
+
+
+def add_totals(feedback: dict) -> dict:
+    """(Re)compute the overall mark from the criteria."""
+    criteria = feedback["criteria"].values()
+    feedback["overall_evaluation"]["total_mark"] = sum(_number(c.get("mark")) for c in criteria)
+    feedback["overall_evaluation"]["maxMark"] = sum(_number(c.get("maxMark")) for c in criteria)
+    return feedback
+
+
+async def _grade_part(name, provider, messages, response_schema):
+    chain = ProviderChain(provider, response_schema=response_schema)
+    started = time.perf_counter()
+    used_provider, text = await chain.agenerate(messages)
+    try:
+        result = loads_tolerant(text)
+    except ValueError:
+        result = None
+    if not isinstance(result, dict):
+        # Keep the prose; the JSON repair step can still recover the mark from it.
+        logging.warning("Criterion %s answer is not a JSON object", name)
+        result = {"justification": text}
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    return name, used_provider, result, chain.usage, elapsed_ms
+
+
+async def astream_per_criterion(
+    student_id: str,
+    assignment_id: str,
+    course_id: str,
+    qvec: list[float] | None,
+    essay_text: str,
+    provider: str = "openai",
+    retrieval: str = "vector",
+    metrics: dict | None = None,
+    cache_key: str | None = None,
+    criteria: list[str] | None = None,
+):
+    """Grade each criterion concurrently and store the merged feedback.
+
+    Yields ``("criterion", (name, details))`` as each criterion finishes, then
+    ``("done", feedback_json)`` once the feedback is stored. If any call fails
+    on every provider the others are cancelled and the error propagates.
+    """
+    metrics = dict(metrics or {})
+    criteria = criteria or GRADING_CRITERIA
+    prompt, rubric_ctx, exemplar_ctx = await asyncio.to_thread(
+        _retrieve, course_id, assignment_id, qvec, essay_text, retrieval, metrics
+    )
+    rubrics = await asyncio.to_thread(criterion_rubrics, assignment_id, rubric_ctx, criteria)
+
+    budgets = {}
+    parts = {}
+    for name in criteria:
+        budgets[name] = {}
+        parts[name] = (
+            budgeted_feedback_messages(
+                prompt.text,
+                rubrics[name],
+                exemplar_ctx,
+                essay_text,
+                provider,
+                budgets[name],
+                instruction=CRITERION_INSTRUCTION.format(criterion=name),
+            ),
+            CRITERION_JSON_SCHEMA,
+        )
+    parts[None] = (
+        budgeted_feedback_messages(
+            prompt.text, [], [], essay_text, provider, {}, instruction=OVERVIEW_INSTRUCTION
+        ),
+        OVERVIEW_JSON_SCHEMA,
+    )
+    metrics["grading"] = "per_criterion"
+    metrics["token_budget"] = {name: budget["token_budget"] for name, budget in budgets.items()}
+
+    started = time.perf_counter()
+    tasks = [
+        asyncio.ensure_future(_grade_part(name, provider, messages, schema))
+        for name, (messages, schema) in parts.items()
+    ]
+    results, providers, usages, part_ms = {}, {}, [], {}
+    overview = {}
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            name, used_provider, result, usage, elapsed_ms = await next_done
+            usages.append(usage)
+            if name is None:
+                overview = result
+                continue
+            results[name], providers[name], part_ms[name] = result, used_provider, elapsed_ms
+            yield "criterion", (name, result)
+    finally:
+        for task in tasks:
+            task.cancel()
+    generation_ms = round((time.perf_counter() - started) * 1000, 1)
+
+    metrics["generation_ms"] = generation_ms
+    metrics["criteria_ms"] = part_ms
+    metrics["provider"] = Counter(providers.values()).most_common(1)[0][0]
+    if len(set(providers.values())) > 1:
+        metrics["criteria_providers"] = providers
+    record_usage(metrics, sum_usage(usages))
+    service_metrics.observe("per_criterion.generation_seconds", generation_ms / 1000)
+    service_metrics.observe("per_criterion.sequential_seconds", sum(part_ms.values()) / 1000)
+
+    feedback_json = json.dumps(merge_feedback(essay_text, overview, results, criteria))
+    feedback_json = await arepair_feedback(feedback_json, metrics["provider"], metrics)
+    # Repair may have changed a criterion's mark.
+    feedback_json = json.dumps(add_totals(loads_tolerant(feedback_json)))
+
+    await asyncio.to_thread(
+        store_feedback,
+        student_id,
+        assignment_id,
+        course_id,
+        feedback_json,
+        metrics,
+        cache_key,
+        qvec,
+    )
+    yield "done", feedback_json
+
+
+async def agenerate_per_criterion(**kwargs) -> str:
+    """Non-streaming :func:`astream_per_criterion`; returns the stored feedback JSON."""
+    feedback_json = None
+    async for kind, payload in astream_per_criterion(**kwargs):
+        if kind == "done":
+            feedback_json = payload
+    return feedback_json
+
+
+def generate_per_criterion(**kwargs) -> str:
+    return run_sync(agenerate_per_criterion(**kwargs))
@@ -0,0 +1,155 @@
+"""Exact-match feedback cache for resubmitted essays.
+
+Students often upload the same PDF twice (a timeout, a double click). The
+cache key covers everything that can change the generated feedback, so a hit
+can safely replay the stored ``Feedback`` row instead of re-running
+embedding, retrieval and generation:
+
+    (assignment_id, normalised essay hash, provider/model,
+     system prompt hash, reference-set version)
+
+Resubmissions that differ by a typo miss that key; with near-duplicate reuse
+enabled they are matched on the stored essay embedding instead
+(:func:`find_near_duplicate`).
+"""
+
+import os
+import json
+import hashlib
+import unicodedata
+
+from sqlalchemy import text as sqltext
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from rag_db import FeedbackCache, reference_set_version, compiled_rubric_row
+from feedback_json import parse_feedback
+
+# Cosine similarity above which an earlier essay counts as the same essay.
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv("RAG_NEAR_DUPLICATE_THRESHOLD", "0.97"))
+
+
+def _sha256(value: str) -> str:
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()
+
+
+def essay_fingerprint(essay_text: str) -> str:
+    """Hash of the essay with Unicode and whitespace differences normalised away.
+
+    PDF extraction of the same file is stable, but re-exports of the same
+    document often differ only in line breaks and spacing.
+    """
+    normalised = " ".join(unicodedata.normalize("NFKC", essay_text).split())
+    return _sha256(normalised)
+
+
+def reference_version_tag(session, assignment_id: str) -> str:
+    tag = ":".join(str(v) for v in reference_set_version(session, assignment_id))
+    # Compiling the rubric changes the prompt without touching the chunks.
+    compiled = compiled_rubric_row(session, assignment_id)
+    if compiled is not None:
+        tag += f":c{int(compiled.compiled_at.timestamp())}"
+    return tag
+
+
+def feedback_cache_key(
+    session, assignment_id: str, essay_text: str, provider: str, model: str, system_prompt: str
+) -> str:
+    parts = [
+        assignment_id,
+        essay_fingerprint(essay_text),
+        f"{provider}/{model}",
+        _sha256(system_prompt),
+        reference_version_tag(session, assignment_id),
+    ]
+    return _sha256("|".join(parts))
+
+
+def lookup_cached_feedback(session, cache_key: str) -> str | None:
+    """Return the stored feedback JSON for ``cache_key`` and count the hit."""
+    row = session.execute(
+        sqltext(
+            """
+            UPDATE feedback_cache AS c
+            SET    hits = c.hits + 1
+            FROM   feedback AS f
+            WHERE  c.cache_key = :key AND f.id = c.feedback_id
+            RETURNING f.data
+            """
+        ),
+        {"key": cache_key},
+    ).first()
+    return row[0] if row else None
+
+
+def remember_feedback(session, cache_key: str, assignment_id: str, feedback_id: int):
+    # Two identical submissions can race through generation; first one wins.
+    session.execute(
+        pg_insert(FeedbackCache)
+        .values(cache_key=cache_key, assignment_id=assignment_id, feedback_id=feedback_id, hits=0)
+        .on_conflict_do_nothing(index_elements=["cache_key"])
+    )
+
+
+def find_near_duplicate(
+    session,
+    assignment_id: str,
+    qvec: list[float],
+    embedder: str,
+    reference_version: str,
+    threshold: float = NEAR_DUPLICATE_THRESHOLD,
+) -> dict | None:
+    """Closest earlier graded essay for the assignment, if similar enough.
+
+    Only originals are candidates (reused rows would chain one reuse onto
+    another), and only ones embedded by the same model against the same
+    reference set. Returns ``{"feedback_id", "data", "similarity", "metrics"}``.
+    """
+    row = session.execute(
+        sqltext(
+            """
+            SELECT id, data, metrics,
+                   1 - (essay_embedding <=> CAST(:qvec AS VECTOR)) AS similarity
+            FROM   feedback
+            WHERE  assignment_id = :aid
+              AND  essay_embedding IS NOT NULL
+              AND  vector_dims(essay_embedding) = :dims
+              AND  metrics->>'embedder' = :embedder
+              AND  metrics->>'reference_version' = :version
+              AND  metrics->>'reused_from' IS NULL
+            ORDER  BY essay_embedding <=> CAST(:qvec AS VECTOR)
+            LIMIT  1
+            """
+        ),
+        {
+            "aid": assignment_id,
+            "qvec": str(qvec),
+            "dims": len(qvec),
+            "embedder": embedder,
+            "version": reference_version,
+        },
+    ).first()
+    if row is None or row.similarity < threshold:
+        return None
+    return {
+        "feedback_id": row.id,
+        "data": row.data,
+        "similarity": float(row.similarity),
+        "metrics": row.metrics or {},
+    }
+
+
+def reused_feedback_json(match: dict) -> str | None:
+    """Feedback JSON of ``match`` flagged as reused, or ``None`` if unparseable.
+
+    The ``reused_feedback`` key travels with the stored submission so teachers
+    can tell reused feedback from freshly generated feedback.
+    """
+    try:
+        feedback = parse_feedback(match["data"])
+    except ValueError:
+        return None
+    feedback["reused_feedback"] = {
+        "source_feedback_id": match["feedback_id"],
+        "similarity": round(match["similarity"], 4),
+    }
+    return json.dumps(feedback)
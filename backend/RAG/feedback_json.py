@@ -0,0 +1,442 @@
+"""Parsing of the feedback JSON produced by the grading LLM."""
+
+import os
+import re
+import json
+
+# The PSMT marking guide's criteria, in report order.
+GRADING_CRITERIA = [
+    c.strip()
+    for c in os.getenv(
+        "RAG_GRADING_CRITERIA", "Formulate,Solve,Evaluate and verify,Communicate"
+    ).split(",")
+    if c.strip()
+]
+
+_FENCE = re.compile(r"```(?:json|JSON)?\s*(.*?)```", re.DOTALL)
+_JSON_ESCAPES = set('"\\/bfnrtu')
+_HEX4 = re.compile(r"[0-9a-fA-F]{4}")
+
+
+def _extract_json_text(raw: str) -> str:
+    """The JSON part of a model response: inside code fences, from the first brace."""
+    fenced = _FENCE.search(raw)
+    text = fenced.group(1) if fenced else raw
+    start = text.find("{")
+    return text[start:] if start != -1 else text
+
+
+def _strip_trailing_comma(out: list):
+    i = len(out) - 1
+    while i >= 0 and out[i].isspace():
+        i -= 1
+    if i >= 0 and out[i] == ",":
+        del out[i]
+
+
+def repair_json_text(text: str) -> str:
+    """Best-effort syntactic repair of model-written JSON.
+
+    Escapes raw control characters and invalid backslashes inside strings
+    (LaTeX such as ``\\(x^2\\)`` is common in maths feedback), drops trailing
+    commas, ignores anything after the root value and closes strings and
+    containers left open by a truncated response.
+    """
+    out = []
+    stack = []
+    in_string = False
+    i = 0
+    while i < len(text):
+        ch = text[i]
+        if in_string:
+            if ch == "\\":
+                nxt = text[i + 1] if i + 1 < len(text) else ""
+                if nxt and nxt in _JSON_ESCAPES and (
+                    nxt != "u" or _HEX4.fullmatch(text[i + 2 : i + 6])
+                ):
+                    out.append(ch + nxt)
+                    i += 2
+                    continue
+                out.append("\\\\")
+            elif ch == '"':
+                in_string = False
+                out.append(ch)
+            elif ch == "\n":
+                out.append("\\n")
+            elif ch == "\t":
+                out.append("\\t")
+            elif ord(ch) < 0x20:
+                out.append(" ")
+            else:
+                out.append(ch)
+            i += 1
+            continue
+
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            _strip_trailing_comma(out)
+            if stack and ch in stack:
+                while stack[-1] != ch:  # close what the model forgot to
+                    out.append(stack.pop())
+                stack.pop()
+            elif not stack:
+                break
+            else:
+                i += 1
+                continue  # stray closer
+        out.append(ch)
+        i += 1
+        if not stack and ch in "}]":
+            break
+
+    if in_string:
+        if out and out[-1] == "\\":
+            out.pop()
+        out.append('"')
+    if stack:
+        # Truncated mid-value: drop a dangling separator or key before closing.
+        _strip_trailing_comma(out)
+        tail = "".join(out).rstrip()
+        if tail.endswith(":"):
+            out = list(tail) + ["null"]
+        elif stack[-1] == "}" and re.search(r'[{,]\s*"(?:[^"\\]|\\.)*"$', tail):
+            out = list(re.sub(r',?\s*"(?:[^"\\]|\\.)*"$', "", tail))
+        while stack:
+            _strip_trailing_comma(out)
+            out.append(stack.pop())
+    return "".join(out)
+
+
+def loads_tolerant(raw: str):
+    """``json.loads`` that survives code fences, prose and common model mistakes."""
+    try:
+        return json.loads(raw)
+    except json.JSONDecodeError:
+        pass
+    text = _extract_json_text(raw.strip())
+    for candidate in (text, repair_json_text(text)):
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    raise ValueError("Wrong JSON formatting")
+
+
+def parse_feedback(raw: str) -> dict:
+    """Parse a model response into the feedback dict.
+
+    Tolerates Markdown code fences, prose around the JSON object and the
+    syntax slips handled by :func:`repair_json_text`. Raises ``ValueError``
+    when no JSON object can be recovered.
+    """
+    feedback = loads_tolerant(raw)
+    if not isinstance(feedback, dict):
+        raise ValueError("Wrong JSON formatting")
+    return feedback
+
+
+# ---------------------------------------------------------------------
+# Compiled schema validation
+# ---------------------------------------------------------------------
+_TYPES = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "number": (int, float),
+    "integer": int,
+    "boolean": bool,
+}
+
+
+def compile_schema(schema: dict):
+    """Compile a JSON-Schema subset into ``validate(value) -> [(path, message), ...]``.
+
+    Supports ``type``, ``properties``, ``required``, ``additionalProperties``
+    (as a schema), ``items`` and ``anyOf`` – enough for the feedback format,
+    without a jsonschema dependency or re-walking the schema per document.
+    """
+    checks = []
+    if "type" in schema:
+        name = schema["type"]
+        expected = _TYPES[name]
+
+        def check_type(value, path):
+            # bool is an int subclass; JSON booleans are not numbers.
+            if not isinstance(value, expected) or (
+                isinstance(value, bool) and name != "boolean"
+            ):
+                return [(path, f"expected {name}, got {type(value).__name__}")]
+            return []
+
+        checks.append(check_type)
+    if "required" in schema:
+        required = list(schema["required"])
+
+        def check_required(value, path):
+            if not isinstance(value, dict):
+                return []
+            return [(path + (key,), "missing") for key in required if key not in value]
+
+        checks.append(check_required)
+    if "properties" in schema:
+        properties = {key: compile_schema(sub) for key, sub in schema["properties"].items()}
+
+        def check_properties(value, path):
+            if not isinstance(value, dict):
+                return []
+            errors = []
+            for key, validate in properties.items():
+                if key in value:
+                    errors += validate(value[key], path + (key,))
+            return errors
+
+        checks.append(check_properties)
+    if isinstance(schema.get("additionalProperties"), dict):
+        known = set(schema.get("properties", {}))
+        validate_extra = compile_schema(schema["additionalProperties"])
+
+        def check_additional(value, path):
+            if not isinstance(value, dict):
+                return []
+            errors = []
+            for key, item in value.items():
+                if key not in known:
+                    errors += validate_extra(item, path + (key,))
+            return errors
+
+        checks.append(check_additional)
+    if "items" in schema:
+        validate_item = compile_schema(schema["items"])
+
+        def check_items(value, path):
+            if not isinstance(value, list):
+                return []
+            errors = []
+            for index, item in enumerate(value):
+                errors += validate_item(item, path + (index,))
+            return errors
+
+        checks.append(check_items)
+    if "anyOf" in schema:
+        options = [compile_schema(sub) for sub in schema["anyOf"]]
+
+        def check_any_of(value, path):
+            # Report against the branch that fits best: one whose type matched
+            # (no error on the value itself), then the fewest errors.
+            best = None
+            for validate in options:
+                errors = validate(value, path)
+                if not errors:
+                    return []
+                score = (any(p == path for p, _ in errors), len(errors))
+                if best is None or score < best[0]:
+                    best = (score, errors)
+            return best[1]
+
+        checks.append(check_any_of)
+
+    def validate(value, path=()):
+        errors = []
+        for check in checks:
+            errors += check(value, path)
+        return errors
+
+    return validate
+
+
+CRITERION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "criterion": {"type": "string"},
+        "mark": {"type": "number"},
+        "maxMark": {"type": "number"},
+        "evidence": {"type": "string"},
+        "justification": {"type": "string"},
+    },
+    "required": ["mark", "maxMark", "justification"],
+}
+
+# Both shapes the models produce are valid: criteria keyed by name (the
+# system prompt's format) or a list with a "criterion" field (Gemini's
+# response schema). The frontend reads either total field, and the
+# improvement text comes as "feedback for improvement" (system prompt) or
+# "feedback_for_improvement" (Gemini).
+FEEDBACK_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "overall_details": {"type": "object"},
+        "criteria": {
+            "anyOf": [
+                {"type": "object", "additionalProperties": CRITERION_SCHEMA},
+                {"type": "array", "items": CRITERION_SCHEMA},
+            ]
+        },
+        "overall_evaluation": {
+            "type": "object",
+            "properties": {
+                "mark_out_of_20": {"type": "number"},
+                "total_mark": {"type": "number"},
+                "feedback for improvement": {"type": "string"},
+                "feedback_for_improvement": {"type": "string"},
+            },
+            "anyOf": [{"required": ["mark_out_of_20"]}, {"required": ["total_mark"]}],
+        },
+    },
+    "required": ["criteria", "overall_evaluation"],
+}
+
+validate_feedback = compile_schema(FEEDBACK_SCHEMA)
+validate_criterion = compile_schema(CRITERION_SCHEMA)
+
+
+def format_errors(errors) -> list[str]:
+    return [f"{'.'.join(str(p) for p in path) or '<root>'}: {message}" for path, message in errors]
+
+
+# ---------------------------------------------------------------------
+# Targeted repair
+# ---------------------------------------------------------------------
+def broken_fragments(feedback: dict, errors) -> list[tuple[tuple, object, list]]:
+    """Group schema errors by the smallest fragment worth re-asking for.
+
+    A bad criterion is repaired on its own; anything else by top-level
+    member. Returns ``(path, current_value_or_None, errors)`` triples.
+    """
+    grouped = {}
+    for path, message in errors:
+        if not path:
+            continue
+        key = path[:2] if path[0] == "criteria" and len(path) > 2 else path[:1]
+        grouped.setdefault(key, []).append((path, message))
+    fragments = []
+    for key, fragment_errors in grouped.items():
+        value = feedback
+        for part in key:
+            try:
+                value = value[part]
+            except (KeyError, IndexError, TypeError):
+                value = None
+                break
+        fragments.append((key, value, fragment_errors))
+    return fragments
+
+
+def _fragment_schema(path: tuple) -> dict:
+    if path[0] == "criteria" and len(path) == 2:
+        return CRITERION_SCHEMA
+    return FEEDBACK_SCHEMA["properties"].get(path[0], {})
+
+
+def repair_messages(path: tuple, value, errors) -> list[dict]:
+    """A short prompt asking to fix one fragment – not to regenerate the feedback."""
+    location = ".".join(str(p) for p in path)
+    current = "(missing)" if value is None else json.dumps(value, ensure_ascii=False)
+    return [
+        {
+            "role": "system",
+            "content": "You repair JSON fragments of a marking report. Reply with only the "
+            "corrected JSON value for the fragment – no prose, no code fences. Keep all "
+            "existing wording and marks unless the problem requires a change.",
+        },
+        {
+            "role": "user",
+            "content": f"Fragment `{location}` is invalid:\n"
+            + "\n".join(format_errors(errors))
+            + f"\n\nRequired schema:\n{json.dumps(_fragment_schema(path))}"
+            + f"\n\nCurrent value:\n{current}",
+        },
+    ]
+
+
+def set_fragment(feedback: dict, path: tuple, value) -> dict:
+    target = feedback
+    for part in path[:-1]:
+        target = target[part]
+    target[path[-1]] = value
+    return feedback
+
+
+_CRITERIA_START = re.compile(r'"criteria"\s*:\s*([\[{])')
+
+
+class CriteriaStreamParser:
+    """Pull completed criteria out of a JSON document while it is still streaming.
+
+    ``feed(text)`` returns the criteria whose objects closed in ``text`` as
+    ``(name, criterion_dict)`` pairs. Both shapes the models produce are
+    handled: ``"criteria": {"Formulate": {...}, ...}`` (name from the key) and
+    ``"criteria": [{"criterion": "Formulate", ...}, ...]``.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.pos = 0  # next unscanned index into buffer
+        self.started = False
+        self.finished = False
+        self.depth = 0  # 0 = directly inside the criteria container
+        self.in_string = False
+        self.escape = False
+        self.key_start = None
+        self.last_key = None
+        self.item_start = None
+        self.count = 0
+
+    def feed(self, text: str) -> list[tuple[str, dict]]:
+        self.buffer += text
+        if self.finished:
+            return []
+        if not self.started:
+            match = _CRITERIA_START.search(self.buffer)
+            if not match:
+                return []
+            self.started = True
+            self.pos = match.end()
+
+        completed = []
+        buf = self.buffer
+        i = self.pos
+        while i < len(buf):
+            ch = buf[i]
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == "\\":
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if self.depth == 0 and self.key_start is not None:
+                        try:
+                            self.last_key = json.loads(buf[self.key_start : i + 1])
+                        except json.JSONDecodeError:
+                            self.last_key = None  # a malformed key names nothing
+                        self.key_start = None
+            elif ch == '"':
+                self.in_string = True
+                if self.depth == 0:
+                    self.key_start = i
+            elif ch in "{[":
+                if self.depth == 0:
+                    self.item_start = i
+                self.depth += 1
+            elif ch in "}]":
+                if self.depth == 0:
+                    self.finished = True
+                    break
+                self.depth -= 1
+                if self.depth == 0 and self.item_start is not None:
+                    try:
+                        item = json.loads(buf[self.item_start : i + 1])
+                    except json.JSONDecodeError:
+                        item = None
+                    if isinstance(item, dict):
+                        self.count += 1
+                        name = item.get("criterion") or self.last_key or f"criterion_{self.count}"
+                        completed.append((name, item))
+                    self.item_start = None
+                    self.last_key = None
+            i += 1
+        self.pos = i
+        return completed
@@ -0,0 +1,220 @@
+"""Durable grading work queue in Postgres (``grading_jobs``).
+
+The API enqueues an extracted essay and returns at once; any number of
+``grading_worker`` processes, on any node, claim jobs with
+``SELECT ... FOR UPDATE SKIP LOCKED`` so no two workers take the same job and
+none of them waits on another's row locks.
+
+- A claimed job holds a lease (``GRADING_JOB_LEASE_S``) that its worker keeps
+  extending while it runs. A job whose lease expired (its worker died) is
+  claimed again by the next worker.
+- A failed attempt requeues the job after an exponential backoff; once
+  ``max_attempts`` are used up the job is dead-lettered (``status = 'dead'``)
+  with its last error, for an operator to inspect or :func:`requeue`.
+"""
+
+import os
+import logging
+
+from sqlalchemy import text as sqltext
+
+from rag_db import GradingJob, get_sessionmaker
+import metrics as service_metrics
+
+GRADING_JOB_LEASE_S = float(os.getenv("GRADING_JOB_LEASE_S", "120"))
+GRADING_JOB_MAX_ATTEMPTS = int(os.getenv("GRADING_JOB_MAX_ATTEMPTS", "3"))
+# Retry n waits BACKOFF_S * 2**(n-1), capped at MAX_BACKOFF_S.
+GRADING_JOB_BACKOFF_S = float(os.getenv("GRADING_JOB_BACKOFF_S", "30"))
+GRADING_JOB_MAX_BACKOFF_S = float(os.getenv("GRADING_JOB_MAX_BACKOFF_S", "900"))
+
+
+def enqueue(
+    student_id: str,
+    assignment_id: str,
+    course_id: str,
+    essay_text: str,
+    options: dict,
+    max_attempts: int = GRADING_JOB_MAX_ATTEMPTS,
+) -> GradingJob:
+    Session = get_sessionmaker()
+    with Session.begin() as session:
+        job = GradingJob(
+            student_id=student_id,
+            assignment_id=assignment_id,
+            course_id=course_id,
+            essay_text=essay_text,
+            options=options,
+            max_attempts=max_attempts,
+        )
+        session.add(job)
+        session.flush()
+        session.refresh(job)
+        session.expunge(job)
+    service_metrics.incr("grading_queue.enqueued")
+    return job
+
+
+def get_job(job_id: int) -> GradingJob | None:
+    Session = get_sessionmaker()
+    with Session() as session:
+        job = session.get(GradingJob, job_id)
+        if job is not None:
+            session.expunge(job)
+        return job
+
+
+def claim(worker_id: str, lease_s: float = GRADING_JOB_LEASE_S) -> GradingJob | None:
+    """Lease the oldest runnable job to ``worker_id``; ``None`` when the queue is empty.
+
+    Runnable means queued and due, or running with an expired lease. Expired
+    jobs with no attempts left are dead-lettered instead.
+    """
+    Session = get_sessionmaker()
+    with Session.begin() as session:
+        dead = session.execute(
+            sqltext(
+                """
+                UPDATE grading_jobs
+                SET    status = 'dead', finished_at = now(), lease_expires_at = NULL,
+                       last_error = COALESCE(last_error || E'\\n', '') || 'lease expired'
+                WHERE  status = 'running'
+                  AND  lease_expires_at < now()
+                  AND  attempts >= max_attempts
+                """
+            )
+        ).rowcount
+        if dead:
+            service_metrics.incr("grading_queue.dead", dead)
+        job = (
+            session.query(GradingJob)
+            .filter(
+                sqltext(
+                    "(status = 'queued' AND run_after <= now())"
+                    " OR (status = 'running' AND lease_expires_at < now())"
+                )
+            )
+            .order_by(GradingJob.run_after, GradingJob.id)
+            .with_for_update(skip_locked=True)
+            .first()
+        )
+        if job is None:
+            return None
+        if job.status == "running":
+            logging.warning("Grading job %s: lease of %s expired, reclaiming", job.id, job.worker_id)
+            service_metrics.incr("grading_queue.lease_expired")
+        session.execute(
+            sqltext(
+                """
+                UPDATE grading_jobs
+                SET    status = 'running', attempts = attempts + 1, worker_id = :worker,
+                       lease_expires_at = now() + make_interval(secs => :lease)
+                WHERE  id = :id
+                """
+            ),
+            {"id": job.id, "worker": worker_id, "lease": lease_s},
+        )
+        session.refresh(job)
+        session.expunge(job)
+    service_metrics.incr("grading_queue.claimed")
+    return job
+
+
+def extend_lease(job_id: int, worker_id: str, lease_s: float = GRADING_JOB_LEASE_S) -> bool:
+    """Heartbeat; ``False`` if the job is no longer leased to ``worker_id``."""
+    Session = get_sessionmaker()
+    with Session.begin() as session:
+        return bool(
+            session.execute(
+                sqltext(
+                    """
+                    UPDATE grading_jobs
+                    SET    lease_expires_at = now() + make_interval(secs => :lease)
+                    WHERE  id = :id AND worker_id = :worker AND status = 'running'
+                    """
+                ),
+                {"id": job_id, "worker": worker_id, "lease": lease_s},
+            ).rowcount
+        )
+
+
+def complete(job_id: int, worker_id: str, feedback_json: str) -> bool:
+    Session = get_sessionmaker()
+    with Session.begin() as session:
+        done = session.execute(
+            sqltext(
+                """
+                UPDATE grading_jobs
+                SET    status = 'done', feedback_json = :feedback, finished_at = now(),
+                       lease_expires_at = NULL, last_error = NULL
+                WHERE  id = :id AND worker_id = :worker AND status = 'running'
+                """
+            ),
+            {"id": job_id, "worker": worker_id, "feedback": feedback_json},
+        ).rowcount
+    if done:
+        service_metrics.incr("grading_queue.done")
+    return bool(done)
+
+
+def fail(job_id: int, worker_id: str, error: str) -> str | None:
+    """Record a failed attempt: requeue with backoff, or dead-letter the job.
+
+    Returns the job's new status (``None`` if the lease was lost meanwhile).
+    """
+    Session = get_sessionmaker()
+    with Session.begin() as session:
+        status = session.execute(
+            sqltext(
+                """
+                UPDATE grading_jobs
+                SET    last_error = :error,
+                       lease_expires_at = NULL,
+                       status = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'queued' END,
+                       finished_at = CASE WHEN attempts >= max_attempts THEN now() END,
+                       run_after = now() + make_interval(
+                           secs => LEAST(:backoff * power(2, attempts - 1), :max_backoff)
+                       )
+                WHERE  id = :id AND worker_id = :worker AND status = 'running'
+                RETURNING status
+                """
+            ),
+            {
+                "id": job_id,
+                "worker": worker_id,
+                "error": error,
+                "backoff": GRADING_JOB_BACKOFF_S,
+                "max_backoff": GRADING_JOB_MAX_BACKOFF_S,
+            },
+        ).scalar()
+    if status:
+        service_metrics.incr("grading_queue.dead" if status == "dead" else "grading_queue.retried")
+    return status
+
+
+def requeue(job_id: int) -> bool:
+    """Give a dead-lettered job a fresh set of attempts."""
+    Session = get_sessionmaker()
+    with Session.begin() as session:
+        return bool(
+            session.execute(
+                sqltext(
+                    """
+                    UPDATE grading_jobs
+                    SET    status = 'queued', attempts = 0, run_after = now(),
+                           finished_at = NULL, worker_id = NULL
+                    WHERE  id = :id AND status = 'dead'
+                    """
+                ),
+                {"id": job_id},
+            ).rowcount
+        )
+
+
+def queue_depth() -> dict:
+    """Jobs per status, for ``/metrics``."""
+    Session = get_sessionmaker()
+    with Session() as session:
+        rows = session.execute(
+            sqltext("SELECT status, count(*) FROM grading_jobs GROUP BY status")
+        ).fetchall()
+    return {status: count for status, count in rows}
@@ -0,0 +1,113 @@
+"""Grading queue worker: ``python grading_worker.py [--concurrency N]``.
+
+Claims jobs from ``grading_jobs`` (see ``grading_queue``) and grades them
+with the same pipeline as ``/get-feedback/``. Run as many worker processes,
+on as many nodes, as grading needs; they only share the database. Each
+process grades up to ``--concurrency`` essays at once, which mostly wait
+on the LLM provider.
+
+Each slot claims and leases jobs under its own id (``host:pid:run/slot``), so
+a slot only ever extends or completes its own jobs, even after a restart
+reuses the pid. The schema is created/upgraded at start unless
+``RAG_MIGRATE_ON_STARTUP=0``, as for the API.
+
+SIGTERM/SIGINT stop claiming; jobs in flight finish first.
+"""
+
+import os
+import sys
+import uuid
+import socket
+import asyncio
+import argparse
+import logging
+import signal
+
+# Add project root to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
+
+import grading_queue
+from grading_queue import GRADING_JOB_LEASE_S
+from rag_db import init_schema
+from rag_api import MIGRATE_ON_STARTUP, grade_essay
+
+logging.basicConfig(level=logging.INFO)
+
+GRADING_WORKER_CONCURRENCY = int(os.getenv("GRADING_WORKER_CONCURRENCY", "4"))
+# Sleep between polls while the queue is empty.
+GRADING_WORKER_IDLE_S = float(os.getenv("GRADING_WORKER_IDLE_S", "1"))
+
+
+async def _heartbeat(job_id: int, worker_id: str):
+    while True:
+        await asyncio.sleep(GRADING_JOB_LEASE_S / 3)
+        if not await asyncio.to_thread(grading_queue.extend_lease, job_id, worker_id):
+            logging.warning("Grading job %s: lease lost", job_id)
+            return
+
+
+async def run_job(job, worker_id: str):
+    logging.info("Grading job %s (attempt %s/%s)", job.id, job.attempts, job.max_attempts)
+    heartbeat = asyncio.ensure_future(_heartbeat(job.id, worker_id))
+    try:
+        feedback_json, _ = await grade_essay(
+            job.student_id, job.assignment_id, job.course_id, job.essay_text, **job.options
+        )
+    except Exception as e:
+        error = str(e) or type(e).__name__
+        status = await asyncio.to_thread(grading_queue.fail, job.id, worker_id, error)
+        logging.error("Grading job %s failed (%s): %s", job.id, status or "lease lost", error)
+        return
+    finally:
+        heartbeat.cancel()
+    if not await asyncio.to_thread(grading_queue.complete, job.id, worker_id, feedback_json):
+        logging.warning("Grading job %s finished after its lease was lost", job.id)
+
+
+async def run_worker(concurrency: int, worker_id: str, stop: asyncio.Event):
+    async def slot(slot_id: str):
+        while not stop.is_set():
+            try:
+                job = await asyncio.to_thread(grading_queue.claim, slot_id)
+            except Exception as e:
+                logging.error("Claiming a grading job failed: %s", e)
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(stop.wait(), timeout=GRADING_WORKER_IDLE_S)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await run_job(job, slot_id)
+
+    logging.info("Grading worker %s started with %s slots", worker_id, concurrency)
+    await asyncio.gather(*(slot(f"{worker_id}/{i}") for i in range(concurrency)))
+    logging.info("Grading worker %s stopped", worker_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Grading queue worker.")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=GRADING_WORKER_CONCURRENCY,
+        help="Jobs graded at once by this process.",
+    )
+    args = parser.parse_args()
+    # Unique per run: a restarted container may get its predecessor's pid.
+    worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+    if MIGRATE_ON_STARTUP:
+        init_schema()
+
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+        await run_worker(max(1, args.concurrency), worker_id, stop)
+
+    asyncio.run(serve())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,205 +1,1074 @@
 import os
 import sys
 import json
+import time
+import asyncio
 import logging
-import requests
+import threading
+import weakref
+import httpx
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI
 import google.generativeai as genai
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 
 # Add project root to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
 
-from rag_db import topk_rubric, topk_reference_chunks, Feedback
+from rag_db import retrieve_context, stable_rubric, compiled_rubric, get_sessionmaker, Feedback
+from prompts import resolve_prompt
+from token_budget import fit_prompt
+from feedback_json import (
+    parse_feedback,
+    loads_tolerant,
+    validate_feedback,
+    broken_fragments,
+    repair_messages,
+    set_fragment,
+    format_errors,
+)
+from feedback_cache import remember_feedback
+import teacher_analytics
+from compact_output import COMPACT_JSON_SCHEMA, compact_instruction, expand_text, expand_and_measure
+from circuit_breaker import breaker
+from rate_limit import aacquire, settle
+import metrics as service_metrics
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
-DB_URL = os.getenv("DATABASE_URL")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 GITEE_API_KEY = os.getenv("GITEE_API_KEY")
 
+# Per-request generation deadline and connection-pool size per provider.
+LLM_TIMEOUT_S = float(os.getenv("LLM_TIMEOUT_S", "120"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+# Output tokens reserved from the tokens/min bucket until real usage is known.
+LLM_OUTPUT_TOKEN_ESTIMATE = int(os.getenv("LLM_OUTPUT_TOKEN_ESTIMATE", "2000"))
+
+# Providers tried after the requested one, in order; only those with an API key.
+LLM_PROVIDER_CHAIN = [
+    p.strip()
+    for p in os.getenv("LLM_PROVIDER_CHAIN", "deepseek,openai,gemini,gitee").split(",")
+    if p.strip()
+]
+# Hedge delay until a provider has latency samples of its own.
+LLM_HEDGE_AFTER_S = float(os.getenv("LLM_HEDGE_AFTER_S", "60"))
+
+# Fast, cheap models: the draft tier of the grading cascade and the fixer of
+# malformed fragments of the feedback JSON.
+FAST_MODELS = {
+    "openai": "gpt-4.1-mini",
+    "gemini": "gemini-2.5-flash",
+    "deepseek": "deepseek-chat",
+}
+JSON_REPAIR_MODELS = FAST_MODELS
+JSON_REPAIR_TIMEOUT_S = float(os.getenv("JSON_REPAIR_TIMEOUT_S", "30"))
+
+# Cheap-model-first cascade. A draft grade is redone by the full model when
+# its total (scaled to 20) lies within CASCADE_BOUNDARY_MARGIN marks below or
+# at a grade boundary, or when it reports borderline decisions. Opt-in
+# (RAG_CASCADE=1): it only applies to single grading with one sample, so on by
+# default it would reject per-criterion and multi-sample requests.
+CASCADE = os.getenv("RAG_CASCADE", "0") == "1"
+GRADE_BOUNDARIES = [
+    float(b) for b in os.getenv("RAG_GRADE_BOUNDARIES", "5,9,13,17").split(",") if b.strip()
+]
+CASCADE_BOUNDARY_MARGIN = float(os.getenv("RAG_CASCADE_BOUNDARY_MARGIN", "1"))
+
+GITEE_API_URL = "https://ai.gitee.com/api/v1/chat/completions"
+DEEPSEEK_BASE_URL = "https://api.deepseek.com/v1"
+
+# Structured JSON output for Gemini that matches backend expectations
+FEEDBACK_JSON_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "overall_details": {
+            "type": "object",
+            "properties": {
+                "word_count": {"type": "integer"},
+                "overall_idea": {"type": "string"}
+            },
+            "required": ["word_count", "overall_idea"]
+        },
+        "criteria": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "criterion": {"type": "string"},
+                    "mark": {"type": "number"},
+                    "maxMark": {"type": "number"},
+                    "evidence": {"type": "string"},
+                    "justification": {"type": "string"}
+                },
+                "required": ["criterion", "mark", "maxMark", "evidence", "justification"]
+            }
+        },
+        "overall_evaluation": {
+            "type": "object",
+            "properties": {
+                "mark_out_of_20": {"type": "number"},
+                "maxMark": {"type": "number"},
+                "marker_notes": {
+                    "type": "object",
+                    "properties": {
+                        "borderline_decisions": {
+                            "type": "array",
+                            "items": {"type": "string"}
+                        }
+                    },
+                    "required": ["borderline_decisions"]
+                },
+                "feedback_for_improvement": {"type": "string"}
+            },
+            "required": ["mark_out_of_20", "maxMark"]
+        }
+    },
+    "required": ["overall_details", "criteria", "overall_evaluation"]
+}
+
+
+# ---------------------------------------------------------------------
+# Shared async clients
+# ---------------------------------------------------------------------
+# httpx pools are bound to the event loop that opened their connections, so
+# there is one client per provider *per loop*: the API worker's loop, plus the
+# private loop that backs the synchronous wrappers below.
+
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+_gemini_models = {}
+
+
+def _http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS
+    )
+
+
+def _async_client(provider: str):
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(provider)
+    if client is None:
+        if provider == "openai":
+            client = AsyncOpenAI(
+                api_key=OPENAI_API_KEY, http_client=httpx.AsyncClient(limits=_http_limits())
+            )
+        elif provider == "deepseek":
+            client = AsyncOpenAI(
+                api_key=DEEPSEEK_API_KEY,
+                base_url=DEEPSEEK_BASE_URL,
+                http_client=httpx.AsyncClient(limits=_http_limits()),
+            )
+        elif provider == "gitee":
+            client = httpx.AsyncClient(
+                limits=_http_limits(),
+                headers={
+                    "Authorization": f"Bearer {GITEE_API_KEY}",
+                    "Content-Type": "application/json",
+                },
+            )
+        else:
+            raise ValueError(f"No async client for provider: {provider}")
+        clients[provider] = client
+    return client
+
+
+def _gemini_model(name: str):
+    # The SDK keeps its own channel; share one model object per process.
+    model = _gemini_models.get(name)
+    if model is None:
+        genai.configure(api_key=GEMINI_API_KEY)
+        model = _gemini_models[name] = genai.GenerativeModel(name)
+    return model
+
+
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+
+def run_sync(coro):
+    """Run a coroutine to completion from synchronous code.
+
+    Uses one long-lived background loop instead of ``asyncio.run`` so the
+    pooled clients created on it are reused across calls.
+    """
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_sync_loop.run_forever, name="llm-sync-loop", daemon=True
+            ).start()
+    return asyncio.run_coroutine_threadsafe(coro, _sync_loop).result()
+
+
+def _gemini_messages(messages: list[dict]) -> list[dict]:
+    # Gemini has a different message format
+    gemini_messages = []
+    system_prompt = ""
+    for msg in messages:
+        if msg["role"] == "system":
+            system_prompt = msg["content"]
+        elif msg["role"] == "assistant":
+            gemini_messages.append({"role": "model", "parts": [msg["content"]]})
+        else:
+            # Map non-assistant messages to user role per Gemini SDK expectations
+            gemini_messages.append({"role": "user", "parts": [msg["content"]]})
+
+    # Older versions of google-generativeai do not support system_instruction.
+    # Inline the system prompt as the first user message to preserve behavior.
+    if system_prompt:
+        gemini_messages = [{"role": "user", "parts": [system_prompt]}] + gemini_messages
+    return gemini_messages
+
+
+def _gemini_generation_config(response_schema=FEEDBACK_JSON_SCHEMA):
+    return genai.types.GenerationConfig(
+        temperature=0.2,
+        max_output_tokens=8192,
+        response_mime_type="application/json",
+        response_schema=response_schema,
+    )
+
+
+def _gemini_text(response) -> str:
+    # Extract robustly; response.text may be missing if blocked or structured
+    if getattr(response, "text", None):
+        return response.text
+    candidates = getattr(response, "candidates", []) or []
+    if candidates:
+        content = getattr(candidates[0], "content", None) or candidates[0]
+        parts = getattr(content, "parts", None) or []
+        for p in parts:
+            if hasattr(p, "text") and p.text:
+                return p.text
+    raise RuntimeError("Gemini returned no text")
+
+
+def _usage(prompt_tokens, completion_tokens, cached_tokens) -> dict:
+    return {
+        "prompt_tokens": prompt_tokens or 0,
+        "completion_tokens": completion_tokens or 0,
+        "cached_tokens": cached_tokens or 0,
+    }
+
+
+def _openai_usage(usage) -> dict | None:
+    # OpenAI reports prompt-cache hits in prompt_tokens_details.cached_tokens,
+    # DeepSeek in prompt_cache_hit_tokens; Gitee follows the OpenAI shape.
+    if not usage:
+        return None
+    if not isinstance(usage, dict):
+        usage = usage.model_dump()
+    details = usage.get("prompt_tokens_details") or {}
+    return _usage(
+        usage.get("prompt_tokens"),
+        usage.get("completion_tokens"),
+        details.get("cached_tokens") or usage.get("prompt_cache_hit_tokens"),
+    )
+
+
+def _gemini_usage(response) -> dict | None:
+    meta = getattr(response, "usage_metadata", None)
+    if not meta:
+        return None
+    return _usage(
+        getattr(meta, "prompt_token_count", 0),
+        getattr(meta, "candidates_token_count", 0),
+        getattr(meta, "cached_content_token_count", 0),
+    )
+
 
 class LLM:
-    """Factory that hides vendor differences. Call .generate(messages: list[dict])."""
+    """Factory that hides vendor differences.
 
-    def __init__(self, provider: str):
+    ``await .agenerate(messages)`` from async code; ``.generate(messages)`` is a
+    blocking wrapper around it for scripts and worker threads. Token usage of
+    the last call (including prompt-cache hits) is left in ``.usage``.
+    """
+
+    def __init__(self, provider: str, timeout: float | None = None, model: str | None = None):
         provider = provider.lower()
         self.provider = provider
+        self.timeout = timeout or LLM_TIMEOUT_S
+        self.usage = None
+        # Gemini is constrained to the full feedback schema unless told otherwise.
+        self.response_schema = FEEDBACK_JSON_SCHEMA
         if provider == "openai":
-            self.client = OpenAI(api_key=OPENAI_API_KEY)
             self.model = "gpt-4.1"
         elif provider == "gemini":
-            genai.configure(api_key=GEMINI_API_KEY)
             # Use Gemini 2.5 Pro (reasoning-capable)
-            self.model = genai.GenerativeModel("gemini-2.5-pro")
+            self.model = "gemini-2.5-pro"
         elif provider == "gitee":
             self.model = "Qwen3-235B-A22B"
-            self.api_url = "https://ai.gitee.com/api/v1/chat/completions"
+            self.api_url = GITEE_API_URL
         elif provider == "deepseek":
-            self.client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url="https://api.deepseek.com/v1")
             self.model = "deepseek-reasoner"
         else:
             raise ValueError(f"Unsupported LLM provider: {provider}")
+        if model:
+            self.model = model
 
     def generate(self, messages: list[dict]) -> str:
+        return run_sync(self.agenerate(messages))
+
+    def _token_estimate(self, messages: list[dict]) -> int:
+        return sum(len(m["content"]) for m in messages) // 4 + LLM_OUTPUT_TOKEN_ESTIMATE
+
+    async def _settle_usage(self, estimate: int):
+        if self.usage:
+            used = self.usage["prompt_tokens"] + self.usage["completion_tokens"]
+            await asyncio.to_thread(settle, self.provider, used - estimate)
+
+    async def agenerate(self, messages: list[dict], timeout: float | None = None) -> str:
+        """Generate a completion, giving up after ``timeout`` seconds.
+
+        Waits for the provider's shared rate limit first (not counted against
+        ``timeout``). Cancelling the awaiting task (e.g. the client
+        disconnected) cancels the in-flight provider request as well.
+        """
+        estimate = self._token_estimate(messages)
+        await aacquire(self.provider, tokens=estimate)
+        try:
+            text = await asyncio.wait_for(self._agenerate(messages), timeout or self.timeout)
+        except asyncio.CancelledError:
+            # Cancelled (e.g. a losing hedge): usage is never reported, so give the
+            # reservation back. Not awaited, as the task is already being cancelled.
+            asyncio.get_running_loop().run_in_executor(None, settle, self.provider, -estimate)
+            raise
+        await self._settle_usage(estimate)
+        return text
+
+    async def _agenerate(self, messages: list[dict]) -> str:
         if self.provider == "openai" or self.provider == "deepseek":
-            resp = self.client.chat.completions.create(
+            resp = await _async_client(self.provider).chat.completions.create(
                 model=self.model, messages=messages, temperature=0.2
             )
+            self.usage = _openai_usage(resp.usage)
             return resp.choices[0].message.content
         elif self.provider == "gemini":
-            # Gemini has a different message format
-            gemini_messages = []
-            system_prompt = ""
-            for msg in messages:
-                if msg["role"] == "system":
-                    system_prompt = msg["content"]
-                elif msg["role"] == "assistant":
-                    gemini_messages.append({"role": "model", "parts": [msg["content"]]})
-                else:
-                    # Map non-assistant messages to user role per Gemini SDK expectations
-                    gemini_messages.append({"role": "user", "parts": [msg["content"]]})
-
-            # Enforce structured JSON output that matches backend expectations
-            json_schema = {
-                "type": "object",
-                "properties": {
-                    "overall_details": {
-                        "type": "object",
-                        "properties": {
-                            "word_count": {"type": "integer"},
-                            "overall_idea": {"type": "string"}
-                        },
-                        "required": ["word_count", "overall_idea"]
-                    },
-                    "criteria": {
-                        "type": "array",
-                        "items": {
-                            "type": "object",
-                            "properties": {
-                                "criterion": {"type": "string"},
-                                "mark": {"type": "number"},
-                                "maxMark": {"type": "number"},
-                                "evidence": {"type": "string"},
-                                "justification": {"type": "string"}
-                            },
-                            "required": ["criterion", "mark", "maxMark", "evidence", "justification"]
-                        }
-                    },
-                    "overall_evaluation": {
-                        "type": "object",
-                        "properties": {
-                            "mark_out_of_20": {"type": "number"},
-                            "maxMark": {"type": "number"},
-                            "marker_notes": {
-                                "type": "object",
-                                "properties": {
-                                    "borderline_decisions": {
-                                        "type": "array",
-                                        "items": {"type": "string"}
-                                    }
-                                },
-                                "required": ["borderline_decisions"]
-                            },
-                            "feedback_for_improvement": {"type": "string"}
-                        },
-                        "required": ["mark_out_of_20", "maxMark"]
-                    }
-                },
-                "required": ["overall_details", "criteria", "overall_evaluation"]
-            }
+            response = await _gemini_model(self.model).generate_content_async(
+                _gemini_messages(messages),
+                generation_config=_gemini_generation_config(self.response_schema),
+            )
+            self.usage = _gemini_usage(response)
+            return _gemini_text(response)
+        elif self.provider == "gitee":
+            payload = {"model": self.model, "messages": messages, "temperature": 0.2}
+            resp = await _async_client("gitee").post(
+                self.api_url, json=payload, timeout=self.timeout
+            )
+            resp.raise_for_status()
+            body = resp.json()
+            self.usage = _openai_usage(body.get("usage"))
+            return body["choices"][0]["message"]["content"]
+
+    async def astream(self, messages: list[dict], timeout: float | None = None):
+        """Yield text deltas as the provider produces them.
+
+        ``timeout`` bounds the whole stream, not each delta.
+        """
+        estimate = self._token_estimate(messages)
+        await aacquire(self.provider, tokens=estimate)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.timeout)
+        stream = self._astream(messages)
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                try:
+                    delta = await asyncio.wait_for(stream.__anext__(), remaining)
+                except StopAsyncIteration:
+                    break
+                if delta:
+                    yield delta
+        finally:
+            await stream.aclose()
+        await self._settle_usage(estimate)
 
-            generation_config = genai.types.GenerationConfig(
+    async def _astream(self, messages: list[dict]):
+        if self.provider == "openai" or self.provider == "deepseek":
+            stream = await _async_client(self.provider).chat.completions.create(
+                model=self.model,
+                messages=messages,
                 temperature=0.2,
-                max_output_tokens=8192,
-                response_mime_type="application/json",
-                response_schema=json_schema,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            async for chunk in stream:
+                if chunk.usage:
+                    self.usage = _openai_usage(chunk.usage)
+                # deepseek-reasoner streams reasoning_content first; only content is feedback
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        elif self.provider == "gemini":
+            response = await _gemini_model(self.model).generate_content_async(
+                _gemini_messages(messages),
+                generation_config=_gemini_generation_config(self.response_schema),
+                stream=True,
             )
+            async for chunk in response:
+                self.usage = _gemini_usage(chunk) or self.usage
+                try:
+                    yield chunk.text
+                except ValueError:
+                    continue  # chunk without text parts (e.g. safety metadata)
+        elif self.provider == "gitee":
+            payload = {"model": self.model, "messages": messages, "temperature": 0.2, "stream": True}
+            async with _async_client("gitee").stream(
+                "POST", self.api_url, json=payload, timeout=self.timeout
+            ) as resp:
+                resp.raise_for_status()
+                async for line in resp.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    data = line[len("data:") :].strip()
+                    if data == "[DONE]":
+                        break
+                    event = json.loads(data)
+                    self.usage = _openai_usage(event.get("usage")) or self.usage
+                    choices = event.get("choices") or [{}]
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        yield delta
+
+
+# ---------------------------------------------------------------------
+# Provider chain – hedged requests and circuit breakers
+# ---------------------------------------------------------------------
+_PROVIDER_KEYS = {
+    "openai": OPENAI_API_KEY,
+    "gemini": GEMINI_API_KEY,
+    "gitee": GITEE_API_KEY,
+    "deepseek": DEEPSEEK_API_KEY,
+}
+
+
+def _is_valid_feedback(text: str) -> bool:
+    # Schema problems are cheaper to repair (arepair_feedback) than to regenerate.
+    try:
+        parse_feedback(text)
+        return True
+    except ValueError:
+        return False
+
+
+class ProviderChain:
+    """The requested provider first, then the configured fallbacks.
+
+    ``agenerate`` sends the request to the first provider whose breaker is
+    closed. If it has not answered within that provider's observed p95
+    latency, the same request is hedged to the next provider, and so on; the
+    first response that parses as feedback wins and the others are cancelled.
+    Errors fail over immediately.
+
+    ``tier="draft"`` uses each provider's fast model (``FAST_MODELS``) and
+    skips providers that have none.
+    """
+
+    def __init__(
+        self,
+        provider: str,
+        fallbacks: list[str] | None = None,
+        response_schema: dict | None = FEEDBACK_JSON_SCHEMA,
+        tier: str = "full",
+    ):
+        provider = provider.lower()
+        if fallbacks is None:
+            fallbacks = [p for p in LLM_PROVIDER_CHAIN if _PROVIDER_KEYS.get(p)]
+        self.providers = [provider] + [p for p in fallbacks if p != provider]
+        if tier == "draft":
+            self.providers = [p for p in self.providers if p in FAST_MODELS]
+        self.tier = tier
+        self.response_schema = response_schema  # Gemini's output constraint
+        self.usage = None  # token usage reported by the provider that answered
+
+    def _llm(self, provider: str) -> "LLM":
+        llm = LLM(provider, model=FAST_MODELS[provider] if self.tier == "draft" else None)
+        llm.response_schema = self.response_schema
+        return llm
+
+    def _latency_metric(self, provider: str) -> str:
+        # Fast models must not drag down the full models' hedge delay.
+        if self.tier == "draft":
+            return f"llm.{provider}.draft.seconds"
+        return f"llm.{provider}.seconds"
 
-            # Older versions of google-generativeai do not support system_instruction.
-            # Inline the system prompt as the first user message to preserve behavior.
-            if system_prompt:
-                gemini_messages = (
-                    [{"role": "user", "parts": [system_prompt]}] + gemini_messages
+    def hedge_delay(self, provider: str) -> float:
+        return service_metrics.percentile(self._latency_metric(provider), 95, LLM_HEDGE_AFTER_S)
+
+    def _next_provider(self, remaining: list[str], first: bool) -> str | None:
+        """Pop the next provider whose breaker lets a request through."""
+        while remaining:
+            provider = remaining.pop(0)
+            if breaker(provider).allow():
+                return provider
+        # Every breaker open: better to try the requested provider than to fail outright.
+        return self.providers[0] if first else None
+
+    async def _attempt(self, provider: str, messages: list[dict]) -> tuple[str, dict | None]:
+        started = time.perf_counter()
+        llm = self._llm(provider)
+        try:
+            text = await llm.agenerate(messages)
+        except asyncio.CancelledError:
+            breaker(provider).release()
+            raise
+        except Exception as e:
+            breaker(provider).record_failure(e)
+            service_metrics.incr(f"llm.{provider}.error")
+            raise
+        breaker(provider).record_success()
+        service_metrics.observe(self._latency_metric(provider), time.perf_counter() - started)
+        return text, llm.usage
+
+    async def agenerate(self, messages: list[dict]) -> tuple[str, str]:
+        """Return ``(provider, text)`` from the first provider with valid feedback."""
+        loop = asyncio.get_running_loop()
+        remaining = list(self.providers)
+        running = {}  # task -> provider
+        invalid = None  # (provider, text, usage) fallback when nothing parses
+        last_error = None
+
+        def launch(reason: str | None = None) -> float | None:
+            """Start the next attempt; return when to hedge it, or None when out of providers."""
+            provider = self._next_provider(remaining, first=reason is None)
+            if provider is None:
+                return None
+            task = asyncio.ensure_future(self._attempt(provider, messages))
+            running[task] = provider
+            if reason:
+                service_metrics.incr(f"llm.{reason}.{provider}")
+                logging.warning("LLM %s to %s", reason, provider)
+            return loop.time() + self.hedge_delay(provider)
+
+        hedge_at = launch()
+        try:
+            while running:
+                timeout = None
+                if hedge_at is not None and remaining:
+                    timeout = max(0.0, hedge_at - loop.time())
+                done, _ = await asyncio.wait(
+                    running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    hedge_at = launch("hedge")
+                    continue
+                for task in done:
+                    provider = running.pop(task)
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        logging.warning(
+                            "LLM provider %s failed: %s",
+                            provider,
+                            str(last_error) or type(last_error).__name__,
+                        )
+                        continue
+                    text, usage = task.result()
+                    if _is_valid_feedback(text):
+                        self.usage = usage
+                        return provider, text
+                    invalid = invalid or (provider, text, usage)
+                # Nothing usable yet: fail over without waiting for the hedge delay.
+                if not running:
+                    hedge_at = launch("failover")
+        finally:
+            for task in running:
+                task.cancel()
+        if invalid:
+            provider, text, self.usage = invalid
+            return provider, text
+        raise last_error
+
+    async def astream(self, messages: list[dict]):
+        """Stream from the first healthy provider, failing over until the first token.
+
+        Yields ``(provider, delta)``; a ``(provider, None)`` marker precedes the
+        first delta. Once text has been yielded the stream is committed to that
+        provider, so there is no hedging here – only failover.
+        """
+        last_error = None
+        remaining = list(self.providers)
+        provider = self._next_provider(remaining, first=True)
+        while provider is not None:
+            started = time.perf_counter()
+            yielded = False
+            llm = self._llm(provider)
+            try:
+                async for delta in llm.astream(messages):
+                    if not yielded:
+                        yielded = True
+                        yield provider, None
+                    yield provider, delta
+            except asyncio.CancelledError:
+                breaker(provider).release()
+                raise
+            except Exception as e:
+                breaker(provider).record_failure(e)
+                service_metrics.incr(f"llm.{provider}.error")
+                if yielded:
+                    raise
+                last_error = e
+                logging.warning(
+                    "LLM provider %s failed before streaming: %s", provider, str(e) or type(e).__name__
                 )
+                provider = self._next_provider(remaining, first=False)
+                continue
+            breaker(provider).record_success()
+            service_metrics.observe(self._latency_metric(provider), time.perf_counter() - started)
+            self.usage = llm.usage
+            return
+        raise last_error
+
+
+def _retrieve(course_id, assignment_id, qvec, essay_text, retrieval, metrics):
+    """Return ``(prompt, rubric_ctx, exemplar_ctx)`` for one essay."""
+    Session = get_sessionmaker()
+
+    started = time.perf_counter()
+    with Session.begin() as session:
+        prompt = resolve_prompt(session, course_id, assignment_id)
+        # A compiled rubric, or a raw one small enough to send whole, stays out
+        # of retrieval so the prompt prefix is the same for every essay of the
+        # assignment.
+        compiled = compiled_rubric(session, assignment_id)
+        rubric = compiled
+        if rubric is None and retrieval != "full":
+            rubric = stable_rubric(session, assignment_id)
+        # quick retrieval for instant feedback; lexical when there is no query vector,
+        # the whole reference set when the assignment is small enough ("full")
+        rubric_ctx, exemplar_ctx = retrieve_context(
+            session,
+            assignment_id,
+            qvec,
+            essay_text,
+            mode=retrieval,
+            rubric_k=0 if rubric is not None else 4,
+        )
+        if rubric is not None:
+            rubric_ctx = rubric
+    metrics["retrieval_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    metrics["context_chunks"] = len(rubric_ctx) + len(exemplar_ctx)
+    metrics["prompt_version"] = prompt.version
+    metrics["rubric_in_prefix"] = rubric is not None or retrieval == "full"
+    metrics["rubric_compiled"] = compiled is not None
+    return prompt, rubric_ctx, exemplar_ctx
+
+
+FEEDBACK_INSTRUCTION = "Provide holistic feedback and a mark out of 20 for the following essay:"
+
+
+def build_feedback_messages(
+    system_prompt, rubric_ctx, exemplar_ctx, essay_text, instruction=FEEDBACK_INSTRUCTION
+) -> list[dict]:
+    """Static parts first: provider prompt caches match on the longest shared prefix.
+
+    The system message (prompt + rubric) is identical for every essay of an
+    assignment whose rubric is sent whole; exemplars and the essay vary and
+    go last.
+    """
+    system = system_prompt + "\n\n[RUBRIC]\n" + "\n".join(rubric_ctx)
+    user = (
+        "[EXEMPLAR]\n"
+        + "\n".join(exemplar_ctx)
+        + "\n\n"
+        + instruction
+        + "\n\n"
+        + essay_text
+    )
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user},
+    ]
+
+
+def budgeted_feedback_messages(
+    system_prompt,
+    rubric_ctx,
+    exemplar_ctx,
+    essay_text,
+    provider,
+    metrics,
+    instruction=FEEDBACK_INSTRUCTION,
+) -> list[dict]:
+    """:func:`build_feedback_messages` trimmed to the provider model's token budget.
+
+    What had to be dropped is recorded under ``metrics["token_budget"]``.
+    """
+    rubric_ctx, exemplar_ctx, essay_text, report = fit_prompt(
+        system_prompt, rubric_ctx, exemplar_ctx, essay_text, LLM(provider).model
+    )
+    metrics["token_budget"] = report
+    if report["prompt_tokens"] < report["requested_tokens"]:
+        service_metrics.incr("token_budget.trimmed")
+        logging.info("Prompt trimmed to token budget: %s", report)
+    return build_feedback_messages(system_prompt, rubric_ctx, exemplar_ctx, essay_text, instruction)
+
+
+async def arepair_feedback(feedback_json: str, provider: str, metrics: dict) -> str:
+    """Return ``feedback_json`` made schema-valid with as little model work as possible.
 
-            response = self.model.generate_content(
-                gemini_messages, generation_config=generation_config
+    Syntax slips are fixed locally (see ``feedback_json.repair_json_text``).
+    Schema violations are fixed by sending only the offending fragment – one
+    criterion or one top-level section – to a fast model and splicing the
+    answer back in. Unrepairable output is returned as it came.
+    """
+    try:
+        feedback = parse_feedback(feedback_json)
+    except ValueError:
+        feedback = None
+    if feedback is None:
+        service_metrics.incr("json_repair.unparseable")
+        metrics["json_repair"] = {"ok": False, "reason": "unparseable"}
+        return feedback_json
+
+    errors = validate_feedback(feedback)
+    if not errors:
+        try:
+            json.loads(feedback_json)
+            return feedback_json
+        except json.JSONDecodeError:
+            # Only syntax needed fixing; store the cleaned document.
+            service_metrics.incr("json_repair.syntax")
+            metrics["json_repair"] = {"ok": True, "fragments": 0}
+            return json.dumps(feedback)
+
+    started = time.perf_counter()
+    fragments = broken_fragments(feedback, errors)
+    llm = LLM(provider, timeout=JSON_REPAIR_TIMEOUT_S, model=JSON_REPAIR_MODELS.get(provider))
+    llm.response_schema = None
+    for path, value, fragment_errors in fragments:
+        try:
+            repaired = loads_tolerant(
+                await llm.agenerate(repair_messages(path, value, fragment_errors))
             )
-            # Extract robustly; response.text may be missing if blocked or structured
-            if getattr(response, "text", None):
-                return response.text
-            candidates = getattr(response, "candidates", []) or []
-            if candidates:
-                content = getattr(candidates[0], "content", None) or candidates[0]
-                parts = getattr(content, "parts", None) or []
-                for p in parts:
-                    if hasattr(p, "text") and p.text:
-                        return p.text
-            raise RuntimeError("Gemini returned no text")
-        elif self.provider == "gitee":
-            headers = {
-                "Authorization": f"Bearer {GITEE_API_KEY}",
-                "Content-Type": "application/json",
-            }
-            payload = {"model": self.model, "messages": messages, "temperature": 0.2}
-            resp = requests.post(self.api_url, json=payload, headers=headers, timeout=60)
-            resp.raise_for_status()
-            return resp.json()["choices"][0]["message"]["content"]
+            set_fragment(feedback, path, repaired)
+        except Exception as e:
+            logging.warning(
+                "JSON repair of %s failed: %s", ".".join(map(str, path)), str(e) or type(e).__name__
+            )
+    remaining = validate_feedback(feedback)
+    metrics["json_repair"] = {
+        "ok": not remaining,
+        "fragments": len(fragments),
+        "repair_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    if remaining:
+        metrics["json_repair"]["errors"] = format_errors(remaining)[:10]
+    service_metrics.incr("json_repair.repaired" if not remaining else "json_repair.failed")
+    return json.dumps(feedback)
 
 
-def generate_and_store_feedback(
+def escalation_reasons(feedback_json: str) -> list[str]:
+    """Why a draft grade must be redone by the full model; empty means keep it."""
+    try:
+        feedback = parse_feedback(feedback_json)
+    except ValueError:
+        return ["unparseable"]
+    if validate_feedback(feedback):
+        return ["invalid"]
+    reasons = []
+    overall = feedback["overall_evaluation"]
+    notes = overall.get("marker_notes")
+    if isinstance(notes, dict) and notes.get("borderline_decisions"):
+        reasons.append("borderline_decisions")
+    total = overall.get("total_mark", overall.get("mark_out_of_20"))
+    max_mark = overall.get("maxMark") if "total_mark" in overall else 20
+    if isinstance(total, (int, float)) and isinstance(max_mark, (int, float)) and max_mark > 0:
+        scaled = total * 20.0 / max_mark
+        for boundary in GRADE_BOUNDARIES:
+            if boundary - CASCADE_BOUNDARY_MARGIN <= scaled <= boundary:
+                reasons.append(f"near_boundary:{boundary:g}")
+                break
+    return reasons
+
+
+def _cascade_report(chain, provider, started, reasons=None) -> dict:
+    elapsed_ms = round((time.perf_counter() - started) * 1000, 1)
+    service_metrics.observe(f"cascade.{chain.tier}_seconds", elapsed_ms / 1000)
+    report = {f"{chain.tier}_provider": provider, f"{chain.tier}_ms": elapsed_ms}
+    if chain.tier == "draft":
+        report["draft_model"] = FAST_MODELS.get(provider)
+        report["escalated"] = bool(reasons)
+        if reasons:
+            report["reasons"] = reasons
+        service_metrics.incr("cascade.escalated" if reasons else "cascade.accepted")
+    return report
+
+
+def _output_contract(compact: bool):
+    """``(instruction, gemini_response_schema)`` for verbose or compact model output."""
+    if compact:
+        return compact_instruction(), COMPACT_JSON_SCHEMA
+    return FEEDBACK_INSTRUCTION, FEEDBACK_JSON_SCHEMA
+
+
+async def acascade(
+    messages: list[dict], provider: str, metrics: dict, compact: bool = False
+) -> tuple[str, str, dict | None]:
+    """Draft with the fast model; escalate to the full model only when the draft is unsure.
+
+    Returns ``(provider, feedback_json, usage)`` where usage covers both tiers.
+    Per-tier latency and the escalation decision go to ``metrics["cascade"]``.
+    """
+    _, response_schema = _output_contract(compact)
+    draft_chain = ProviderChain(provider, response_schema=response_schema, tier="draft")
+    report = {}
+    usages = []
+    if draft_chain.providers:
+        started = time.perf_counter()
+        try:
+            draft_provider, draft = await draft_chain.agenerate(messages)
+            reasons = escalation_reasons(expand_text(draft) if compact else draft)
+        except Exception as e:
+            logging.warning("Draft grade failed: %s", str(e) or type(e).__name__)
+            draft_provider, draft, reasons = None, None, ["draft_failed"]
+        usages.append(draft_chain.usage)
+        report = _cascade_report(draft_chain, draft_provider, started, reasons)
+        if not reasons:
+            metrics["cascade"] = report
+            return draft_provider, draft, draft_chain.usage
+
+    chain = ProviderChain(provider, response_schema=response_schema)
+    started = time.perf_counter()
+    used_provider, feedback_json = await chain.agenerate(messages)
+    usages.append(chain.usage)
+    metrics["cascade"] = {**report, **_cascade_report(chain, used_provider, started)}
+    return used_provider, feedback_json, sum_usage(usages)
+
+
+def sum_usage(usages) -> dict | None:
+    """Token usage of several calls added up."""
+    usages = [u for u in usages if u]
+    if not usages:
+        return None
+    return {key: sum(u.get(key, 0) for u in usages) for key in usages[0]}
+
+
+def record_usage(metrics: dict, usage: dict | None):
+    """Copy provider-reported token usage into ``metrics`` and the service counters."""
+    if not usage:
+        return
+    metrics["usage"] = usage
+    for name, value in usage.items():
+        service_metrics.incr(f"llm.{name}", value or 0)
+
+
+def store_feedback(
+    student_id, assignment_id, course_id, feedback_json, metrics, cache_key=None, essay_embedding=None
+):
+    Session = get_sessionmaker()
+    with Session.begin() as session:
+        feedback = Feedback(
+            student_id=student_id,
+            assignment_id=assignment_id,
+            course_id=course_id,
+            data=feedback_json,
+            metrics=metrics,
+            essay_embedding=essay_embedding,
+        )
+        session.add(feedback)
+        session.flush()
+        feedback_id = feedback.id
+        # Only well-formed feedback is worth replaying to a resubmission or
+        # counting in the teacher's analytics; malformed feedback still
+        # replaces the earlier feedback's marks there, as one without marks.
+        try:
+            parsed = parse_feedback(feedback_json)
+        except ValueError:
+            parsed = None
+        if parsed is not None and cache_key:
+            remember_feedback(session, cache_key, assignment_id, feedback_id)
+        teacher_analytics.record_feedback(
+            session, feedback_id, student_id, assignment_id, course_id, parsed or {}
+        )
+    logging.info("Feedback stored successfully → %s", feedback_json[:80] + "…")
+    return feedback_id
+
+
+async def agenerate_and_store_feedback(
     student_id: str,
     assignment_id: str,
     course_id: str,
-    qvec: list[float],
+    qvec: list[float] | None,
     essay_text: str,
     provider: str = "openai",
+    retrieval: str = "vector",
+    metrics: dict | None = None,
+    cache_key: str | None = None,
+    cascade: bool = False,
+    compact: bool = False,
 ):
-    engine = create_engine(DB_URL)
-    Session = sessionmaker(bind=engine)
+    metrics = dict(metrics or {})
+    # DB work is synchronous SQLAlchemy; keep it off the event loop.
+    prompt, rubric_ctx, exemplar_ctx = await asyncio.to_thread(
+        _retrieve, course_id, assignment_id, qvec, essay_text, retrieval, metrics
+    )
+    instruction, response_schema = _output_contract(compact)
+    messages = budgeted_feedback_messages(
+        prompt.text, rubric_ctx, exemplar_ctx, essay_text, provider, metrics, instruction
+    )
 
-    with Session.begin() as session:
-        # quick retrieval for instant feedback
-        rubric_ctx = topk_rubric(session, assignment_id, qvec, k=4)
-        exemplar_ctx = topk_reference_chunks(session, assignment_id, qvec, k=6)
-
-    prompt_file_path = os.path.join(os.path.dirname(__file__), "SYSTEM_PROMPT.txt")
-    with open(prompt_file_path, "r") as f:
-        SYSTEM_PROMPT = f.read().strip()
-
-    ctx_block = (
-        "[RUBRIC]\\n"
-        + "\\n".join(rubric_ctx)
-        + "\\n\\n[EXEMPLAR]\\n"
-        + "\\n".join(exemplar_ctx)
+    started = time.perf_counter()
+    if cascade:
+        metrics["provider"], feedback_json, usage = await acascade(
+            messages, provider, metrics, compact
+        )
+    else:
+        chain = ProviderChain(provider, response_schema=response_schema)
+        metrics["provider"], feedback_json = await chain.agenerate(messages)
+        usage = chain.usage
+    metrics["generation_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    record_usage(metrics, usage)
+    if compact:
+        feedback_json = expand_and_measure(
+            feedback_json, LLM(metrics["provider"]).model, metrics
+        )
+    feedback_json = await arepair_feedback(feedback_json, metrics["provider"], metrics)
+
+    await asyncio.to_thread(
+        store_feedback,
+        student_id,
+        assignment_id,
+        course_id,
+        feedback_json,
+        metrics,
+        cache_key,
+        qvec,
     )
-    messages = [
-        {"role": "system", "content": SYSTEM_PROMPT},
-        {"role": "assistant", "content": ctx_block},
-        {
-            "role": "user",
-            "content": f"Provide holistic feedback and a mark out of 20 for the following essay:\\n\\n{essay_text}",
-        },
-    ]
+    return feedback_json
 
-    llm = LLM(provider)
-    feedback_json = llm.generate(messages)
 
-    with Session.begin() as session:
-        session.add(
-            Feedback(
-                student_id=student_id,
-                assignment_id=assignment_id,
-                course_id=course_id,
-                data=feedback_json,
-            )
+async def astream_and_store_feedback(
+    student_id: str,
+    assignment_id: str,
+    course_id: str,
+    qvec: list[float] | None,
+    essay_text: str,
+    provider: str = "openai",
+    retrieval: str = "vector",
+    metrics: dict | None = None,
+    cache_key: str | None = None,
+    cascade: bool = False,
+    compact: bool = False,
+):
+    """Streaming counterpart of :func:`agenerate_and_store_feedback`.
+
+    Yields ``("token", delta)`` while the model generates, stores the feedback
+    once the stream completes and finishes with ``("done", feedback_json)``.
+    With ``cascade`` the fast model's draft is streamed first; if it is
+    escalated, ``("escalate", reasons)`` tells the client to discard the
+    tokens so far and the full model's answer streams after it. With
+    ``compact`` the tokens are the compact wire format; the expanded criteria
+    follow as ``("criterion", (name, details))`` before ``done``.
+    """
+    metrics = dict(metrics or {})
+    prompt, rubric_ctx, exemplar_ctx = await asyncio.to_thread(
+        _retrieve, course_id, assignment_id, qvec, essay_text, retrieval, metrics
+    )
+    instruction, response_schema = _output_contract(compact)
+    messages = budgeted_feedback_messages(
+        prompt.text, rubric_ctx, exemplar_ctx, essay_text, provider, metrics, instruction
+    )
+
+    chains = [ProviderChain(provider, response_schema=response_schema)]
+    if cascade:
+        draft_chain = ProviderChain(provider, response_schema=response_schema, tier="draft")
+        if draft_chain.providers:
+            chains.insert(0, draft_chain)
+    started = time.perf_counter()
+    usages, report = [], {}
+    for chain in chains:
+        tier_started = time.perf_counter()
+        parts = []
+        try:
+            async for used_provider, delta in chain.astream(messages):
+                if delta is None:
+                    metrics["provider"] = used_provider
+                    metrics.setdefault(
+                        "first_token_ms", round((time.perf_counter() - started) * 1000, 1)
+                    )
+                    continue
+                parts.append(delta)
+                yield "token", delta
+        except Exception as e:
+            if chain.tier != "draft":
+                raise
+            logging.warning("Draft grade failed: %s", str(e) or type(e).__name__)
+            reasons = ["draft_failed"]
+        else:
+            draft = "".join(parts)
+            if chain.tier != "draft":
+                reasons = None
+            else:
+                reasons = escalation_reasons(expand_text(draft) if compact else draft)
+        usages.append(chain.usage)
+        if cascade:
+            report.update(_cascade_report(chain, metrics.get("provider"), tier_started, reasons))
+            metrics["cascade"] = report
+        if chain.tier == "draft":
+            if not reasons:
+                break
+            yield "escalate", reasons
+    metrics["generation_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    record_usage(metrics, sum_usage(usages))
+    feedback_json = "".join(parts)
+    if compact:
+        feedback_json = expand_and_measure(
+            feedback_json, LLM(metrics.get("provider", provider)).model, metrics
         )
-    logging.info("Feedback stored successfully → %s", feedback_json[:80] + "…")
+    feedback_json = await arepair_feedback(feedback_json, metrics.get("provider", provider), metrics)
+    if compact:
+        try:
+            for name, details in parse_feedback(feedback_json).get("criteria", {}).items():
+                yield "criterion", (name, details)
+        except (ValueError, AttributeError):
+            pass
 
-    return feedback_json
+    await asyncio.to_thread(
+        store_feedback,
+        student_id,
+        assignment_id,
+        course_id,
+        feedback_json,
+        metrics,
+        cache_key,
+        qvec,
+    )
+    yield "done", feedback_json
+
+
+def generate_and_store_feedback(
+    student_id: str,
+    assignment_id: str,
+    course_id: str,
+    qvec: list[float] | None,
+    essay_text: str,
+    provider: str = "openai",
+    retrieval: str = "vector",
+    metrics: dict | None = None,
+    cache_key: str | None = None,
+    cascade: bool = False,
+    compact: bool = False,
+):
+    return run_sync(
+        agenerate_and_store_feedback(
+            student_id=student_id,
+            assignment_id=assignment_id,
+            course_id=course_id,
+            qvec=qvec,
+            essay_text=essay_text,
+            provider=provider,
+            retrieval=retrieval,
+            metrics=metrics,
+            cache_key=cache_key,
+            cascade=cascade,
+            compact=compact,
+        )
+    )
@@ -0,0 +1,57 @@
+"""Process-wide counters and latency samples for the RAG service.
+
+Per-submission numbers are stored on the ``Feedback`` row (``metrics``
+column); this module only keeps the aggregate view served by ``/metrics``.
+"""
+
+import threading
+from collections import defaultdict, deque
+
+MAX_SAMPLES = 1000
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+
+
+def incr(name: str, n: int = 1):
+    with _lock:
+        _counters[name] += n
+
+
+def observe(name: str, value: float):
+    """Record one latency (or size) sample; only the latest MAX_SAMPLES are kept."""
+    with _lock:
+        _samples[name].append(value)
+
+
+def percentile(name: str, pct: float, default: float | None = None) -> float | None:
+    with _lock:
+        values = sorted(_samples.get(name, ()))
+    if not values:
+        return default
+    return values[min(len(values) - 1, int(round((len(values) - 1) * pct / 100.0)))]
+
+
+def mean(name: str, default: float | None = None) -> float | None:
+    with _lock:
+        values = list(_samples.get(name, ()))
+    return sum(values) / len(values) if values else default
+
+
+def snapshot() -> dict:
+    with _lock:
+        counters = dict(_counters)
+        names = list(_samples)
+    return {
+        "counters": counters,
+        "samples": {
+            name: {
+                "count": len(_samples[name]),
+                "mean": mean(name),
+                "p50": percentile(name, 50),
+                "p95": percentile(name, 95),
+            }
+            for name in names
+        },
+    }
@@ -0,0 +1,112 @@
+"""Versioned system-prompt registry.
+
+Resolution order for a submission: the latest version registered for its
+assignment, then for its course, then ``SYSTEM_PROMPT.txt`` (the PSMT marker
+prompt the service shipped with). Resolved prompts are held in memory for
+``PROMPT_CACHE_TTL_S`` seconds so grading does not touch the disk or the
+database per request; prompts registered through this process are visible
+immediately, other workers pick them up when their entry expires.
+"""
+
+import os
+import time
+import hashlib
+import threading
+from dataclasses import dataclass
+
+from sqlalchemy import func, select
+
+from rag_db import PromptTemplate
+
+PROMPT_CACHE_TTL_S = float(os.getenv("PROMPT_CACHE_TTL_S", "60"))
+SCOPES = ("assignment", "course")
+
+
+@dataclass(frozen=True)
+class Prompt:
+    text: str
+    version: str  # "assignment:A1:v3", "course:MATH101:v1" or "default:<sha>"
+
+    @property
+    def sha256(self) -> str:
+        return hashlib.sha256(self.text.encode("utf-8")).hexdigest()
+
+
+_default_prompt = None
+_resolved = {}  # (course_id, assignment_id) -> (expires_at, Prompt)
+_lock = threading.Lock()
+
+
+def default_prompt() -> Prompt:
+    global _default_prompt
+    if _default_prompt is None:
+        prompt_file_path = os.path.join(os.path.dirname(__file__), "SYSTEM_PROMPT.txt")
+        with open(prompt_file_path, "r") as f:
+            text = f.read().strip()
+        _default_prompt = Prompt(text, "default:" + hashlib.sha256(text.encode()).hexdigest()[:12])
+    return _default_prompt
+
+
+def _latest(session, scope: str, scope_id: str):
+    return session.scalars(
+        select(PromptTemplate)
+        .where(PromptTemplate.scope == scope, PromptTemplate.scope_id == scope_id)
+        .order_by(PromptTemplate.version.desc())
+        .limit(1)
+    ).first()
+
+
+def resolve_prompt(session, course_id: str | None, assignment_id: str | None) -> Prompt:
+    key = (course_id, assignment_id)
+    now = time.monotonic()
+    with _lock:
+        cached = _resolved.get(key)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    prompt = default_prompt()
+    for scope, scope_id in (("assignment", assignment_id), ("course", course_id)):
+        if not scope_id:
+            continue
+        row = _latest(session, scope, scope_id)
+        if row is not None:
+            prompt = Prompt(row.body.strip(), f"{scope}:{scope_id}:v{row.version}")
+            break
+    with _lock:
+        _resolved[key] = (now + PROMPT_CACHE_TTL_S, prompt)
+    return prompt
+
+
+def register_prompt(session, scope: str, scope_id: str, text: str) -> PromptTemplate:
+    """Add a new version for ``scope``/``scope_id``; the caller commits."""
+    if scope not in SCOPES:
+        raise ValueError(f"scope must be one of {SCOPES}")
+    if not text.strip():
+        raise ValueError("prompt text is empty")
+    current = session.scalar(
+        select(func.max(PromptTemplate.version)).where(
+            PromptTemplate.scope == scope, PromptTemplate.scope_id == scope_id
+        )
+    )
+    row = PromptTemplate(scope=scope, scope_id=scope_id, version=(current or 0) + 1, body=text)
+    session.add(row)
+    session.flush()
+    invalidate(scope, scope_id)
+    return row
+
+
+def list_prompts(session, scope: str, scope_id: str) -> list[PromptTemplate]:
+    return list(
+        session.scalars(
+            select(PromptTemplate)
+            .where(PromptTemplate.scope == scope, PromptTemplate.scope_id == scope_id)
+            .order_by(PromptTemplate.version.desc())
+        )
+    )
+
+
+def invalidate(scope: str, scope_id: str):
+    index = 1 if scope == "assignment" else 0
+    with _lock:
+        for key in [k for k in _resolved if k[index] == scope_id]:
+            del _resolved[key]
@@ -1,10 +1,24 @@
 import os
 import sys
+import time
+import asyncio
 import tempfile
 import logging
+from dataclasses import dataclass, asdict
 from datetime import datetime
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, status
-from fastapi.responses import JSONResponse
+from fastapi import (
+    FastAPI,
+    UploadFile,
+    File,
+    Form,
+    HTTPException,
+    Depends,
+    BackgroundTasks,
+    status,
+)
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel
+from typing import Optional
 from sqlalchemy.orm import Session
 from sqlalchemy import text
 import uvicorn
@@ -17,13 +31,66 @@ from rag_db import (
     ingest_reference_file,
     extract_text,
     EmbeddingModel,
+    AssignmentSettings,
+    plan_retrieval,
+    reference_set_version,
+    CompiledRubric,
+    rubric_version,
+    render_compiled_rubric,
+    init_schema,
+    pool_status,
     get_db_session as get_db,
 )
-from llm import generate_and_store_feedback
+from llm import (
+    LLM,
+    CASCADE,
+    store_feedback,
+    agenerate_and_store_feedback,
+    astream_and_store_feedback,
+)
+from criterion_grading import (
+    GRADING_MODE,
+    GRADING_MODES,
+    agenerate_per_criterion,
+    astream_per_criterion,
+    cache_salt as per_criterion_salt,
+)
+from self_consistency import (
+    SELF_CONSISTENCY_SAMPLES,
+    SELF_CONSISTENCY_MAX_SAMPLES,
+    agenerate_self_consistent,
+    astream_self_consistent,
+    cache_salt as self_consistency_salt,
+)
+from compact_output import COMPACT_OUTPUT
+import grading_queue
+import teacher_analytics
+from rubric_compiler import compile_rubric, compile_rubric_in_background
+from feedback_cache import (
+    NEAR_DUPLICATE_THRESHOLD,
+    feedback_cache_key,
+    lookup_cached_feedback,
+    reference_version_tag,
+    find_near_duplicate,
+    reused_feedback_json,
+)
+from feedback_json import parse_feedback, validate_criterion, format_errors, CriteriaStreamParser
 from statistics_api import router as statistics_router
+from circuit_breaker import breaker_states
+from prompts import SCOPES as PROMPT_SCOPES, resolve_prompt, register_prompt, list_prompts
+import metrics as service_metrics
 
 logging.basicConfig(level=logging.INFO)
 
+# Past this deadline the essay is graded with lexical retrieval instead of
+# waiting on the embedding provider.
+EMBED_DEADLINE_S = float(os.getenv("RAG_EMBED_DEADLINE_S", "10"))
+# Default for the per-request ``reuse_similar`` switch.
+REUSE_SIMILAR = os.getenv("RAG_REUSE_SIMILAR", "0") == "1"
+# Create/upgrade the schema when the worker starts. Disable when migrations
+# are run separately (``python rag_cli.py migrate``) before a rollout.
+MIGRATE_ON_STARTUP = os.getenv("RAG_MIGRATE_ON_STARTUP", "1") == "1"
+
 app = FastAPI(
     title="Feedback RAG API",
     description="API for interacting with the RAG backend for student feedback.",
@@ -32,6 +99,26 @@ app = FastAPI(
 
 app.include_router(statistics_router)
 
+
+@app.on_event("startup")
+def migrate_schema():
+    if MIGRATE_ON_STARTUP:
+        init_schema()
+
+
+class RetrievalPolicyPayload(BaseModel):
+    policy: str = "auto"
+    full_context_char_budget: Optional[int] = None
+
+
+class PromptPayload(BaseModel):
+    text: str
+
+
+class RubricCompilePayload(BaseModel):
+    provider: Optional[str] = None
+
+
 @app.get("/health")
 async def health_check(db: Session = Depends(get_db)):
     try:
@@ -40,6 +127,7 @@ async def health_check(db: Session = Depends(get_db)):
         return {
             "status": "healthy",
             "database": "connected",
+            "llm_providers": breaker_states(),
             "timestamp": datetime.utcnow().isoformat()
         }
     except Exception as e:
@@ -52,9 +140,129 @@ async def health_check(db: Session = Depends(get_db)):
                 "timestamp": datetime.utcnow().isoformat()
             }
         )
+    finally:
+        db.close()
+
+
+def _plan_retrieval(assignment_id: str, requested: str) -> str:
+    db = get_db()
+    try:
+        return plan_retrieval(db, assignment_id, requested)
+    finally:
+        db.close()
+
+
+@app.get("/metrics", summary="Aggregate pipeline metrics for this worker")
+async def get_metrics():
+    snapshot = service_metrics.snapshot()
+    counters = snapshot["counters"]
+    drafts = counters.get("cascade.accepted", 0) + counters.get("cascade.escalated", 0)
+    if drafts:
+        snapshot["cascade_escalation_rate"] = round(counters.get("cascade.escalated", 0) / drafts, 3)
+    snapshot["db_pool"] = pool_status()
+    try:
+        snapshot["grading_queue"] = await asyncio.to_thread(grading_queue.queue_depth)
+    except Exception as e:
+        logging.warning("Grading queue depth unavailable: %s", e)
+    return snapshot
+
+
+@app.put(
+    "/assignments/{assignment_id}/retrieval-policy",
+    summary="Choose between full reference context and ranked retrieval",
+)
+def set_retrieval_policy(
+    assignment_id: str, payload: RetrievalPolicyPayload, db: Session = Depends(get_db)
+):
+    if payload.policy not in ("auto", "full", "retrieve"):
+        raise HTTPException(status_code=400, detail="policy must be 'auto', 'full' or 'retrieve'")
+    try:
+        settings = db.get(AssignmentSettings, assignment_id) or AssignmentSettings(
+            assignment_id=assignment_id
+        )
+        settings.retrieval_policy = payload.policy
+        settings.full_context_char_budget = payload.full_context_char_budget
+        db.add(settings)
+        db.commit()
+        count, _, total_chars = reference_set_version(db, assignment_id)
+        return {
+            "assignment_id": assignment_id,
+            "policy": settings.retrieval_policy,
+            "full_context_char_budget": settings.full_context_char_budget,
+            "reference_chunks": count,
+            "reference_chars": total_chars,
+            "retrieval_path": plan_retrieval(db, assignment_id),
+        }
+    finally:
+        db.close()
+
+
+def _prompt_row(row) -> dict:
+    return {
+        "scope": row.scope,
+        "scope_id": row.scope_id,
+        "version": row.version,
+        "text": row.body,
+        "created_at": row.created_at.isoformat() if row.created_at else None,
+    }
+
+
+@app.put("/prompts/{scope}/{scope_id}", summary="Register a new system-prompt version")
+def put_prompt(scope: str, scope_id: str, payload: PromptPayload, db: Session = Depends(get_db)):
+    """``scope`` is ``course`` or ``assignment``; assignment prompts override course prompts."""
+    try:
+        row = register_prompt(db, scope, scope_id, payload.text)
+        db.commit()
+        return _prompt_row(row)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        db.close()
+
+
+@app.get("/prompts/{scope}/{scope_id}", summary="List system-prompt versions, newest first")
+def get_prompts(scope: str, scope_id: str, db: Session = Depends(get_db)):
+    if scope not in PROMPT_SCOPES:
+        raise HTTPException(status_code=400, detail=f"scope must be one of {PROMPT_SCOPES}")
+    try:
+        return [_prompt_row(row) for row in list_prompts(db, scope, scope_id)]
+    finally:
+        db.close()
+
+
+@app.get("/rubrics/{assignment_id}", summary="Show the assignment's compiled rubric")
+def get_compiled_rubric(assignment_id: str, db: Session = Depends(get_db)):
+    try:
+        row = db.get(CompiledRubric, assignment_id)
+        if row is None:
+            raise HTTPException(status_code=404, detail="Rubric has not been compiled")
+        return {
+            "assignment_id": assignment_id,
+            "criteria": row.criteria,
+            "prompt": render_compiled_rubric(row.criteria),
+            "model": row.model,
+            "compiled_at": row.compiled_at.isoformat() if row.compiled_at else None,
+            # Stale rows are not used; grading falls back to the raw rubric.
+            "stale": row.source_version != rubric_version(db, assignment_id),
+        }
+    finally:
+        db.close()
+
+
+@app.post("/rubrics/{assignment_id}/compile", summary="(Re)compile the assignment's rubric")
+async def post_compile_rubric(assignment_id: str, payload: RubricCompilePayload):
+    try:
+        compiled = await asyncio.to_thread(compile_rubric, assignment_id, payload.provider)
+    except ValueError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    if compiled is None:
+        raise HTTPException(status_code=404, detail="Assignment has no rubric documents")
+    return compiled
+
 
 @app.post("/upload-reference/", summary="Upload a reference document")
 async def upload_reference(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(..., description="The reference PDF file (e.g., rubric, exemplar)."),
     assignment_id: str = Form(..., description="Assignment ID, e.g. 'A1'."),
     doc_type: str = Form(..., description="Type of document (e.g., 'rubric', 'exemplar')."),
@@ -68,6 +276,7 @@ async def upload_reference(
     """
     Uploads a reference document, processes it, and stores it in the vector database.
     This is used to provide context (like rubrics or exemplars) for feedback generation.
+    Rubrics are additionally compiled into a criteria table in the background.
     """
     try:
         # Save uploaded file to a temporary file
@@ -92,99 +301,548 @@ async def upload_reference(
         if "tmp_path" in locals() and os.path.exists(tmp_path):
             os.remove(tmp_path)
 
-    return {
-        "message": f"Reference document '{file.filename}' uploaded successfully for assignment '{assignment_id}'."
+    message = f"Reference document '{file.filename}' uploaded successfully for assignment '{assignment_id}'."
+    if doc_type == "rubric":
+        background_tasks.add_task(compile_rubric_in_background, assignment_id)
+        message += " Rubric compilation started."
+    return {"message": message}
+
+
+async def _extract_essay(pdf_bytes: bytes, filename: str) -> str:
+    tmp_path = None
+    try:
+        # Save uploaded file to a temporary file
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
+            tmp.write(pdf_bytes)
+            tmp_path = tmp.name
+
+        logging.info(f"Extracting text from assignment: {filename}")
+        return await asyncio.to_thread(extract_text, tmp_path)
+    finally:
+        # Clean up the temporary file
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+async def _plan_query(
+    assignment_id: str, essay_text: str, embedder: str, retrieval: str, need_vector: bool = False
+):
+    """Return ``(qvec, retrieval_path, pipeline_metrics)`` for one essay.
+
+    Small reference sets go to the model whole; otherwise get a query vector
+    for the whole essay (skipped for lexical retrieval unless ``need_vector``).
+    """
+    retrieval_path = await asyncio.to_thread(_plan_retrieval, assignment_id, retrieval)
+
+    qvec = None
+    pipeline_metrics = {"retrieval_path": retrieval_path}
+    needs_ranking = retrieval_path not in ("full", "lexical")
+    if needs_ranking or need_vector:
+        logging.info("Creating a query vector for the essay.")
+        embed_started = time.perf_counter()
+        try:
+            qvec = await asyncio.wait_for(
+                asyncio.to_thread(lambda: EmbeddingModel(embedder).embed([essay_text])[0]),
+                timeout=EMBED_DEADLINE_S,
+            )
+        except Exception as e:
+            logging.warning(
+                "Embedding unavailable (%s); falling back to lexical retrieval.",
+                str(e) or type(e).__name__,
+            )
+        pipeline_metrics["embed_ms"] = round((time.perf_counter() - embed_started) * 1000, 1)
+        qvec = qvec or None
+        if qvec is not None:
+            pipeline_metrics["embedder"] = embedder
+        elif needs_ranking:
+            retrieval_path = pipeline_metrics["retrieval_path"] = "lexical_fallback"
+    service_metrics.incr(f"retrieval_path.{retrieval_path}")
+    return qvec, retrieval_path, pipeline_metrics
+
+
+def _grading_salt(grading: str, samples: int, cascade: bool, compact: bool) -> str:
+    """What, besides the prompt, makes one grading mode's output differ from another's."""
+    if grading == "per_criterion":
+        return per_criterion_salt()
+    salt = "\n[compact]" if compact else ""
+    if samples > 1:
+        return salt + self_consistency_salt(samples)
+    return salt + ("\n[cascade]" if cascade else "")
+
+
+def _grading_pipeline(grading: str, samples: int, cascade: bool, compact: bool, stream: bool):
+    """The generator for a request's grading mode, with its extra keyword arguments.
+
+    ``compact`` does not apply to per-criterion calls, whose answers are small already.
+    """
+    if grading == "per_criterion" or samples > 1:
+        if grading == "per_criterion" and samples > 1:
+            raise HTTPException(status_code=400, detail="samples > 1 requires grading=single")
+        if cascade:
+            raise HTTPException(
+                status_code=400, detail="cascade requires grading=single and samples=1"
+            )
+    if grading == "per_criterion":
+        return (astream_per_criterion if stream else agenerate_per_criterion), {}
+    if samples > 1:
+        return (astream_self_consistent if stream else agenerate_self_consistent), {
+            "samples": samples,
+            "compact": compact,
+        }
+    return (astream_and_store_feedback if stream else agenerate_and_store_feedback), {
+        "cascade": cascade,
+        "compact": compact,
     }
 
 
-@app.post("/get-feedback/", summary="Get feedback for an assignment")
-async def get_feedback(
-    file: UploadFile = File(..., description="The assignment PDF file to get feedback on."),
-    student_id: str = Form(..., description="Student ID."),
-    assignment_id: str = Form(..., description="Assignment ID or name."),
-    course_id: str = Form(..., description="Course ID, e.g. 'MATH101'."),
+def _lookup_feedback_cache(
+    course_id: str, assignment_id: str, essay_text: str, provider: str, salt: str = ""
+):
+    """Return ``(cache_key, cached_feedback_json_or_None, reference_version)``.
+
+    ``salt`` keeps feedback from different grading modes apart.
+    """
+    db = get_db()
+    try:
+        prompt = resolve_prompt(db, course_id, assignment_id)
+        system_prompt = prompt.text + salt
+        cache_key = feedback_cache_key(
+            db, assignment_id, essay_text, provider, LLM(provider).model, system_prompt
+        )
+        cached = lookup_cached_feedback(db, cache_key)
+        reference_version = reference_version_tag(db, assignment_id)
+        db.commit()
+    finally:
+        db.close()
+    service_metrics.incr("feedback_cache.hit" if cached else "feedback_cache.miss")
+    return cache_key, cached, reference_version
+
+
+def _reuse_near_duplicate(
+    student_id: str,
+    assignment_id: str,
+    course_id: str,
+    qvec: list[float],
+    cache_key: str,
+    pipeline_metrics: dict,
+    threshold: float,
+) -> str | None:
+    """Store and return flagged feedback copied from a near-identical earlier essay.
+
+    Returns ``None`` when no earlier essay is similar enough.
+    """
+    db = get_db()
+    try:
+        match = find_near_duplicate(
+            db,
+            assignment_id,
+            qvec,
+            pipeline_metrics["embedder"],
+            pipeline_metrics["reference_version"],
+            threshold,
+        )
+    finally:
+        db.close()
+    feedback_json = reused_feedback_json(match) if match else None
+    if feedback_json is None:
+        service_metrics.incr("near_duplicate.miss")
+        return None
+
+    # What the source submission paid for retrieval and generation is what
+    # this one saves.
+    source = match["metrics"]
+    saved_ms = round(source.get("retrieval_ms", 0) + source.get("generation_ms", 0), 1)
+    metrics = {
+        **pipeline_metrics,
+        "reused_from": match["feedback_id"],
+        "similarity": round(match["similarity"], 4),
+        "saved_ms": saved_ms,
+    }
+    store_feedback(student_id, assignment_id, course_id, feedback_json, metrics, cache_key, qvec)
+    service_metrics.incr("near_duplicate.hit")
+    service_metrics.observe("near_duplicate.saved_ms", saved_ms)
+    logging.info("Reused feedback %s (similarity %.4f)", match["feedback_id"], match["similarity"])
+    return feedback_json
+
+
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def _criterion_event(name: str, details: dict) -> dict:
+    event = {"criterion": name, **details}
+    errors = validate_criterion(details)
+    if errors:
+        # Repaired before the result event; flag it for the UI now.
+        event["errors"] = format_errors(errors)
+    return event
+
+
+@dataclass
+class GradingForm:
+    """Form fields shared by ``/get-feedback/``, its stream and ``/grading-jobs/``."""
+
+    student_id: str = Form(..., description="Student ID.")
+    assignment_id: str = Form(..., description="Assignment ID or name.")
+    course_id: str = Form(..., description="Course ID, e.g. 'MATH101'.")
     embedder: str = Form(
         "gitee",
         enum=["openai", "gemini", "gitee"],
         description="Embedding model for document ingestion.",
-    ),
+    )
     provider: str = Form(
         "deepseek",
         enum=["openai", "gemini", "gitee", "deepseek"],
         description="LLM provider for feedback generation.",
-    ),
+    )
+    retrieval: str = Form(
+        "vector",
+        enum=["vector", "lexical", "hybrid"],
+        description="Context retrieval: embeddings, full-text, or both fused.",
+    )
+    reuse_similar: bool = Form(
+        REUSE_SIMILAR,
+        description="Reuse the feedback of a near-identical earlier essay for this assignment.",
+    )
+    similarity_threshold: float = Form(
+        NEAR_DUPLICATE_THRESHOLD,
+        description="Cosine similarity needed for near-duplicate reuse.",
+    )
+    grading: str = Form(
+        GRADING_MODE,
+        enum=list(GRADING_MODES),
+        description="One call for the whole report, or one concurrent call per criterion.",
+    )
+    samples: int = Form(
+        SELF_CONSISTENCY_SAMPLES,
+        ge=1,
+        le=SELF_CONSISTENCY_MAX_SAMPLES,
+        description="Concurrent grading samples aggregated per criterion (single grading only).",
+    )
+    cascade: bool = Form(
+        CASCADE,
+        description="Draft with a fast model; escalate to the full model only near grade "
+        "boundaries or on borderline decisions (single grading, one sample).",
+    )
+    compact: bool = Form(
+        COMPACT_OUTPUT,
+        description="Have the model answer in the compact wire format; the response "
+        "is expanded to the usual shape.",
+    )
+    teacher_id: Optional[int] = Form(
+        None, description="Teacher of the course; with course_name, feeds their analytics."
+    )
+    course_name: Optional[str] = Form(None, description="Course name shown in teacher analytics.")
+
+    def options(self) -> dict:
+        """The grading options: ``grade_essay`` keyword arguments, stored with a queued job."""
+        options = asdict(self)
+        for key in ("student_id", "assignment_id", "course_id"):
+            del options[key]
+        return options
+
+
+@app.post("/get-feedback/", summary="Get feedback for an assignment")
+async def get_feedback(
+    file: UploadFile = File(..., description="The assignment PDF file to get feedback on."),
+    form: GradingForm = Depends(),
 ):
     """
     Uploads a student's assignment, processes it, retrieves relevant context,
     generates feedback using an LLM, and stores it.
     """
-    tmp_path = None
+    started = time.perf_counter()
+    # Reject invalid mode combinations with a 400 before reading the upload.
+    _grading_pipeline(form.grading, form.samples, form.cascade, form.compact, stream=False)
     try:
-        # Save uploaded file to a temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp:
-            tmp.write(await file.read())
-            tmp_path = tmp.name
-
         # 1. Extract text from the assignment
-        logging.info(f"Extracting text from assignment: {file.filename}")
-        essay_text = extract_text(tmp_path)
+        essay_text = await _extract_essay(await file.read(), file.filename)
         if not essay_text.strip():
             raise HTTPException(status_code=400, detail="The submitted document is empty.")
 
-        # 2. Get a query vector for the whole essay
-        logging.info("Creating a query vector for the essay.")
-        embedder_model = EmbeddingModel(embedder)
-        qvec = embedder_model.embed([essay_text])[0]
-
-        if not qvec:
-            raise HTTPException(
-                status_code=500, detail="Failed to create a query vector for the essay."
-            )
-
-        # 3. Generate feedback
-        logging.info("Generating feedback...")
-        feedback_raw = generate_and_store_feedback(
-            student_id=student_id,
-            assignment_id=assignment_id,
-            course_id=course_id,
-            qvec=qvec,
-            essay_text=essay_text,
-            provider=provider,
+        feedback_raw, headers = await grade_essay(
+            form.student_id, form.assignment_id, form.course_id, essay_text, **form.options()
         )
+        service_metrics.observe("get_feedback_seconds", time.perf_counter() - started)
 
-        # The feedback is stored as a JSON string in the DB; parse and return a JSON object.
-        # If the model wrapped JSON in code fences, extract and parse.
         try:
-            feedback_dict = json.loads(feedback_raw)
-        except json.JSONDecodeError:
-            cleaned = feedback_raw.strip()
-            # Strip Markdown code fences if present
-            if cleaned.startswith("```") and cleaned.endswith("```"):
-                cleaned = cleaned.strip("`")  # remove all backticks
-                # Drop optional leading language label like 'json' on first line
-                parts = cleaned.split("\n", 1)
-                if len(parts) == 2 and parts[0].lower().startswith("json"):
-                    cleaned = parts[1]
-            else:
-                # Try to extract the largest JSON object substring
-                start = cleaned.find("{")
-                end = cleaned.rfind("}")
-                if start != -1 and end != -1 and end > start:
-                    cleaned = cleaned[start : end + 1]
-            try:
-                feedback_dict = json.loads(cleaned)
-            except Exception:
-                raise HTTPException(status_code=400, detail="Wrong JSON formatting")
-
-        return JSONResponse(content=feedback_dict)
+            feedback_dict = parse_feedback(feedback_raw)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Wrong JSON formatting")
+
+        return JSONResponse(content=feedback_dict, headers=headers)
 
     except Exception as e:
         logging.error(f"Error getting feedback: {e}")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        # Clean up the temporary file
-        if tmp_path and os.path.exists(tmp_path):
-            os.remove(tmp_path)
+
+
+async def _register_course(course_id: str, teacher_id: int | None, course_name: str | None):
+    if teacher_id is not None and course_name:
+        await asyncio.to_thread(teacher_analytics.register_course, course_id, teacher_id, course_name)
+
+
+async def grade_essay(
+    student_id: str,
+    assignment_id: str,
+    course_id: str,
+    essay_text: str,
+    embedder: str = "gitee",
+    provider: str = "deepseek",
+    retrieval: str = "vector",
+    reuse_similar: bool = REUSE_SIMILAR,
+    similarity_threshold: float = NEAR_DUPLICATE_THRESHOLD,
+    grading: str = GRADING_MODE,
+    samples: int = SELF_CONSISTENCY_SAMPLES,
+    cascade: bool = CASCADE,
+    compact: bool = COMPACT_OUTPUT,
+    teacher_id: int | None = None,
+    course_name: str | None = None,
+) -> tuple[str, dict]:
+    """Grade an extracted essay and store the feedback: cache, near-duplicate reuse, generation.
+
+    Returns ``(feedback_json, response_headers)``. Shared by ``/get-feedback/``
+    and the queue worker (``grading_worker``).
+    """
+    generate, grading_options = _grading_pipeline(grading, samples, cascade, compact, stream=False)
+    await _register_course(course_id, teacher_id, course_name)
+
+    # 2. Identical resubmissions replay the stored feedback
+    cache_key, cached, reference_version = await asyncio.to_thread(
+        _lookup_feedback_cache,
+        course_id,
+        assignment_id,
+        essay_text,
+        provider,
+        _grading_salt(grading, samples, cascade, compact),
+    )
+    if cached is not None:
+        return cached, {"X-Feedback-Cache": "hit"}
+
+    # 3. Plan retrieval and embed the essay if ranking (or reuse) needs it
+    qvec, retrieval_path, pipeline_metrics = await _plan_query(
+        assignment_id, essay_text, embedder, retrieval, need_vector=reuse_similar
+    )
+    pipeline_metrics["reference_version"] = reference_version
+
+    # Essays that differ from an earlier one by a typo reuse its feedback
+    if reuse_similar and qvec is not None:
+        reused = await asyncio.to_thread(
+            _reuse_near_duplicate,
+            student_id,
+            assignment_id,
+            course_id,
+            qvec,
+            cache_key,
+            pipeline_metrics,
+            similarity_threshold,
+        )
+        if reused is not None:
+            return reused, {"X-Feedback-Cache": "near-duplicate"}
+
+    # 4. Generate feedback
+    logging.info("Generating feedback...")
+    feedback_raw = await generate(
+        student_id=student_id,
+        assignment_id=assignment_id,
+        course_id=course_id,
+        qvec=qvec,
+        essay_text=essay_text,
+        provider=provider,
+        retrieval=retrieval_path,
+        metrics=pipeline_metrics,
+        cache_key=cache_key,
+        **grading_options,
+    )
+    return feedback_raw, {"X-Retrieval-Path": retrieval_path, "X-Feedback-Cache": "miss"}
+
+
+def _grading_job(job) -> dict:
+    body = {
+        "job_id": job.id,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "last_error": job.last_error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.status == "done":
+        body["feedback"] = parse_feedback(job.feedback_json)
+    return body
+
+
+@app.post(
+    "/grading-jobs/",
+    status_code=status.HTTP_202_ACCEPTED,
+    summary="Queue an assignment for grading by a grading worker",
+)
+async def enqueue_grading_job(
+    file: UploadFile = File(..., description="The assignment PDF file to get feedback on."),
+    form: GradingForm = Depends(),
+):
+    """
+    Same inputs as ``/get-feedback/``, but the essay is only extracted and queued;
+    a ``grading_worker`` process grades it. Poll ``GET /grading-jobs/{job_id}``.
+    """
+    _grading_pipeline(form.grading, form.samples, form.cascade, form.compact, stream=False)
+    essay_text = await _extract_essay(await file.read(), file.filename)
+    if not essay_text.strip():
+        raise HTTPException(status_code=400, detail="The submitted document is empty.")
+    job = await asyncio.to_thread(
+        grading_queue.enqueue,
+        form.student_id,
+        form.assignment_id,
+        form.course_id,
+        essay_text,
+        form.options(),
+    )
+    return _grading_job(job)
+
+
+@app.get("/grading-jobs/{job_id}", summary="Status (and, once done, feedback) of a grading job")
+async def get_grading_job(job_id: int):
+    job = await asyncio.to_thread(grading_queue.get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Grading job not found")
+    return _grading_job(job)
+
+
+@app.post("/grading-jobs/{job_id}/requeue", summary="Retry a dead-lettered grading job")
+async def requeue_grading_job(job_id: int):
+    if not await asyncio.to_thread(grading_queue.requeue, job_id):
+        raise HTTPException(status_code=409, detail="Only dead-lettered jobs can be requeued")
+    return _grading_job(await asyncio.to_thread(grading_queue.get_job, job_id))
+
+
+@app.post("/get-feedback/stream/", summary="Stream feedback for an assignment (SSE)")
+async def get_feedback_stream(
+    file: UploadFile = File(..., description="The assignment PDF file to get feedback on."),
+    form: GradingForm = Depends(),
+):
+    """
+    Same pipeline as ``/get-feedback/`` but answers with Server-Sent Events:
+
+    - ``status``    – pipeline progress (``{"stage": ..., ...}``); ``cached`` and
+                      ``reused`` (near-duplicate) mean ``result`` follows directly;
+                      with ``samples > 1`` a ``sample`` stage reports each sample;
+                      with ``cascade`` an ``escalating`` stage means the draft
+                      streamed so far is discarded and the full model follows
+    - ``token``     – raw model output as it is generated (``{"text": ...}``);
+                      not sent with ``grading=per_criterion`` or ``samples > 1``;
+                      in the compact wire format with ``compact``
+    - ``criterion`` – each criterion as soon as its JSON object is complete (or
+                      its call returns), with ``errors`` if it fails the schema
+                      (the result is repaired)
+    - ``result``    – the final parsed feedback (already stored)
+    - ``error``     – ``{"status_code": ..., "detail": ...}``; ends the stream
+    """
+    pdf_bytes = await file.read()
+    filename = file.filename
+    student_id, assignment_id, course_id = form.student_id, form.assignment_id, form.course_id
+    provider, grading = form.provider, form.grading
+    stream, grading_options = _grading_pipeline(
+        grading, form.samples, form.cascade, form.compact, stream=True
+    )
+
+    async def events():
+        started = time.perf_counter()
+        try:
+            yield _sse("status", {"stage": "extracting"})
+            essay_text = await _extract_essay(pdf_bytes, filename)
+            if not essay_text.strip():
+                yield _sse("error", {"status_code": 400, "detail": "The submitted document is empty."})
+                return
+            await _register_course(course_id, form.teacher_id, form.course_name)
+
+            cache_key, cached, reference_version = await asyncio.to_thread(
+                _lookup_feedback_cache,
+                course_id,
+                assignment_id,
+                essay_text,
+                provider,
+                _grading_salt(grading, form.samples, form.cascade, form.compact),
+            )
+            if cached is not None:
+                yield _sse("status", {"stage": "cached"})
+                service_metrics.observe("get_feedback_seconds", time.perf_counter() - started)
+                yield _sse("result", parse_feedback(cached))
+                return
+
+            qvec, retrieval_path, pipeline_metrics = await _plan_query(
+                assignment_id,
+                essay_text,
+                form.embedder,
+                form.retrieval,
+                need_vector=form.reuse_similar,
+            )
+            pipeline_metrics["reference_version"] = reference_version
+
+            if form.reuse_similar and qvec is not None:
+                reused = await asyncio.to_thread(
+                    _reuse_near_duplicate,
+                    student_id,
+                    assignment_id,
+                    course_id,
+                    qvec,
+                    cache_key,
+                    pipeline_metrics,
+                    form.similarity_threshold,
+                )
+                if reused is not None:
+                    yield _sse("status", {"stage": "reused"})
+                    service_metrics.observe("get_feedback_seconds", time.perf_counter() - started)
+                    yield _sse("result", parse_feedback(reused))
+                    return
+            yield _sse(
+                "status",
+                {"stage": "generating", "retrieval_path": retrieval_path, "grading": grading},
+            )
+
+            criteria = CriteriaStreamParser()
+            async for kind, payload in stream(
+                student_id=student_id,
+                assignment_id=assignment_id,
+                course_id=course_id,
+                qvec=qvec,
+                essay_text=essay_text,
+                provider=provider,
+                retrieval=retrieval_path,
+                metrics=pipeline_metrics,
+                cache_key=cache_key,
+                **grading_options,
+            ):
+                if kind == "token":
+                    yield _sse("token", {"text": payload})
+                    for name, details in criteria.feed(payload):
+                        yield _sse("criterion", _criterion_event(name, details))
+                    continue
+                if kind == "criterion":
+                    yield _sse("criterion", _criterion_event(*payload))
+                    continue
+                if kind == "sample":
+                    yield _sse("status", {"stage": "sample", **payload})
+                    continue
+                if kind == "escalate":
+                    # The draft's tokens and criteria are superseded.
+                    criteria = CriteriaStreamParser()
+                    yield _sse("status", {"stage": "escalating", "reasons": payload})
+                    continue
+
+                service_metrics.observe("get_feedback_seconds", time.perf_counter() - started)
+                try:
+                    yield _sse("result", parse_feedback(payload))
+                except ValueError:
+                    yield _sse("error", {"status_code": 400, "detail": "Wrong JSON formatting"})
+        except Exception as e:
+            logging.error(f"Error streaming feedback: {e}")
+            yield _sse("error", {"status_code": 500, "detail": str(e)})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 if __name__ == "__main__":
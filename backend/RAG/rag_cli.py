@@ -1,13 +1,16 @@
 import os
 import sys
+import random
 import argparse
 import logging
 
 # Add project root to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..")))
 
-from rag_db import ingest_reference_file
+from rag_db import ingest_reference_file, init_schema
 from llm import generate_and_store_feedback
+from rubric_compiler import compile_rubric
+from stats_check import check_stats, check_stats_concurrency
 
 logging.basicConfig(level=logging.INFO)
 
@@ -23,6 +26,35 @@ def handle_upload_reference(args):
         embedder_name=args.embedder,
     )
     logging.info("Reference file ingestion complete.")
+    if args.doctype == "rubric":
+        handle_compile_rubric(args)
+
+
+def handle_compile_rubric(args):
+    """Handler for the 'compile-rubric' command."""
+    compiled = compile_rubric(args.assignment, getattr(args, "provider", None))
+    if compiled is None:
+        logging.warning("Assignment %s has no rubric documents.", args.assignment)
+        return
+    for criterion in compiled["criteria"]:
+        logging.info(
+            "%s (max %s): %d bands", criterion["name"], criterion["max_mark"], len(criterion["bands"])
+        )
+
+
+def handle_migrate(args):
+    """Handler for the 'migrate' command."""
+    init_schema()
+    logging.info("Schema is up to date.")
+
+
+def handle_check_stats(args):
+    """Handler for the 'check-stats' command; exits non-zero on a mismatch."""
+    if args.concurrency:
+        ok = check_stats_concurrency(args.concurrency, args.workers, random.Random(args.seed))
+    else:
+        ok = check_stats()
+    sys.exit(0 if ok else 1)
 
 
 def main():
@@ -52,6 +84,41 @@ def main():
     )
     parser_upload.set_defaults(func=handle_upload_reference)
 
+    # --- Sub-parser for compiling a rubric into a criteria table ---
+    parser_compile = subparsers.add_parser(
+        "compile-rubric", help="Compile an assignment's uploaded rubric into a criteria table."
+    )
+    parser_compile.add_argument("--assignment", required=True, help="Assignment ID, e.g. 'A1'.")
+    parser_compile.add_argument(
+        "--provider",
+        choices=["openai", "gemini", "gitee", "deepseek"],
+        default=None,
+        help="LLM provider used for compilation.",
+    )
+    parser_compile.set_defaults(func=handle_compile_rubric)
+
+    # --- Sub-parser for creating/upgrading the schema ---
+    parser_migrate = subparsers.add_parser(
+        "migrate", help="Create the pgvector extension, tables and schema upgrades."
+    )
+    parser_migrate.set_defaults(func=handle_migrate)
+
+    # --- Sub-parser for checking the statistics running sums ---
+    parser_check_stats = subparsers.add_parser(
+        "check-stats", help="Verify the statistics running sums against the stored grades."
+    )
+    parser_check_stats.add_argument(
+        "--concurrency",
+        type=int,
+        metavar="N",
+        help="Instead fire N parallel updates for a test student and check that student.",
+    )
+    parser_check_stats.add_argument(
+        "--workers", type=int, default=16, help="Threads for --concurrency."
+    )
+    parser_check_stats.add_argument("--seed", type=int, default=7)
+    parser_check_stats.set_defaults(func=handle_check_stats)
+
     args = parser.parse_args()
     args.func(args)
 
@@ -1,10 +1,13 @@
 import os, sys
+import re
+import json
 import logging
+import threading
+from collections import Counter
 import fitz  # PyMuPDF
 from dotenv import load_dotenv
 from typing import List
 from sqlalchemy.orm import declarative_base, sessionmaker
-from sqlalchemy.exc import ProgrammingError
 import pgvector.sqlalchemy
 from sqlalchemy import (
     create_engine,
@@ -16,12 +19,17 @@ from sqlalchemy import (
     select,
     insert,
     DECIMAL,
+    Numeric,
     DateTime,
     ForeignKey,
     UniqueConstraint,
     String,
+    Computed,
+    Index,
+    Float,
 )
-from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql import JSONB, TSVECTOR
 from sqlalchemy.sql import func
 import pgvector.sqlalchemy
 from preprocessing.preprocessing import run as recursive_chunker
@@ -32,6 +40,8 @@ from sqlalchemy import text as sqltext
 # Always import the OpenAI implementation – tests patch the *origin* library path.
 from langchain_openai import OpenAIEmbeddings
 from gitee_embeddings import GiteeAIEmbeddings
+from rate_limit import acquire
+import metrics as service_metrics
 # from langchain_google_genai import GoogleGenerativeAIEmbeddings  # gemini
 
 # Import the HuggingFace implementation **only if** it has not been monkey-patched already.
@@ -51,6 +61,12 @@ OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 GITEE_API_KEY = os.getenv("GITEE_API_KEY")
 
+# Connection pool of the process-wide engine (see get_engine).
+DB_POOL_SIZE = int(os.getenv("RAG_DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("RAG_DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT_S = float(os.getenv("RAG_DB_POOL_TIMEOUT_S", "30"))
+DB_POOL_RECYCLE_S = int(os.getenv("RAG_DB_POOL_RECYCLE_S", "1800"))
+
 
 Base = declarative_base(metadata=MetaData())
 
@@ -63,6 +79,11 @@ class ReferenceChunk(Base):
     heading_path = Column(Text)
     content = Column(Text, nullable=False)
     embedding = Column(pgvector.sqlalchemy.Vector(), nullable=False)
+    content_tsv = Column(TSVECTOR, Computed("to_tsvector('english', content)", persisted=True))
+    __table_args__ = (
+        Index("ix_reference_chunks_content_tsv", "content_tsv", postgresql_using="gin"),
+        Index("ix_reference_chunks_assignment", "assignment_id", "doc_type"),
+    )
 
 
 class Feedback(Base):
@@ -72,6 +93,111 @@ class Feedback(Base):
     assignment_id = Column(Text, nullable=False)
     course_id = Column(Text, nullable=False)
     data = Column(Text, nullable=False)
+    # Per-submission pipeline metrics: retrieval path taken, stage timings, ...
+    metrics = Column(JSONB)
+    # Query vector of the graded essay, kept for near-duplicate reuse
+    essay_embedding = Column(pgvector.sqlalchemy.Vector())
+
+
+class FeedbackCache(Base):
+    """Exact-match cache: a resubmitted identical essay reuses its stored feedback.
+
+    ``cache_key`` already folds in everything that may change the output (see
+    ``feedback_cache.feedback_cache_key``), so entries never need updating –
+    a changed rubric or prompt simply produces a different key.
+    """
+
+    __tablename__ = "feedback_cache"
+    cache_key = Column(Text, primary_key=True)
+    assignment_id = Column(Text, nullable=False)
+    feedback_id = Column(BigInteger, ForeignKey("feedback.id", ondelete="CASCADE"), nullable=False)
+    hits = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), default=func.now())
+
+
+class AssignmentSettings(Base):
+    """Per-assignment grading knobs.
+
+    ``retrieval_policy``: ``"auto"`` sends the whole reference set when it fits
+    ``full_context_char_budget`` (falling back to ``FULL_CONTEXT_CHAR_BUDGET``),
+    ``"full"`` always sends it, ``"retrieve"`` always ranks chunks.
+    """
+
+    __tablename__ = "assignment_settings"
+    assignment_id = Column(Text, primary_key=True)
+    retrieval_policy = Column(Text, nullable=False, default="auto")
+    full_context_char_budget = Column(Integer)
+    updated_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+
+class CompiledRubric(Base):
+    """An assignment's rubric compiled once into a criteria table (see ``rubric_compiler``).
+
+    ``criteria`` is ``[{"name", "max_mark", "bands": [{"marks", "descriptor"}]}]``.
+    ``source_version`` is the version of the rubric chunks it was compiled
+    from; re-uploading the rubric leaves the row stale until it is recompiled.
+    """
+
+    __tablename__ = "compiled_rubrics"
+    assignment_id = Column(Text, primary_key=True)
+    source_version = Column(Text, nullable=False)
+    criteria = Column(JSONB, nullable=False)
+    model = Column(Text)
+    compiled_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+
+class RateLimitBucket(Base):
+    """Shared token bucket, see ``rate_limit``; ``tokens`` is the level at ``updated_at``."""
+
+    __tablename__ = "rate_limit_buckets"
+    bucket = Column(Text, primary_key=True)  # "<provider>:requests" | "<provider>:tokens"
+    tokens = Column(Float, nullable=False)
+    updated_at = Column(DateTime(timezone=True), nullable=False)
+
+
+class GradingJob(Base):
+    """A queued grading request, consumed by ``grading_worker`` (see ``grading_queue``).
+
+    ``status`` is queued -> running -> done, or back to queued with a later
+    ``run_after`` after a failure, or dead once ``max_attempts`` are used up.
+    """
+
+    __tablename__ = "grading_jobs"
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    status = Column(Text, nullable=False, default="queued")
+    student_id = Column(Text, nullable=False)
+    assignment_id = Column(Text, nullable=False)
+    course_id = Column(Text, nullable=False)
+    essay_text = Column(Text, nullable=False)
+    # embedder, provider, retrieval, grading, samples, cascade, compact, reuse_similar
+    options = Column(JSONB, nullable=False, default=dict)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False)
+    run_after = Column(DateTime(timezone=True), nullable=False, default=func.now())
+    lease_expires_at = Column(DateTime(timezone=True))
+    worker_id = Column(Text)
+    last_error = Column(Text)
+    feedback_json = Column(Text)
+    created_at = Column(DateTime(timezone=True), default=func.now())
+    finished_at = Column(DateTime(timezone=True))
+
+    __table_args__ = (Index("ix_grading_jobs_claim", "status", "run_after"),)
+
+
+class PromptTemplate(Base):
+    """Versioned system prompts scoped to a course or an assignment (see ``prompts``).
+
+    Versions are append-only; the highest version of the narrowest scope wins.
+    """
+
+    __tablename__ = "prompt_templates"
+    id = Column(BigInteger, primary_key=True)
+    scope = Column(Text, nullable=False)  # "course" | "assignment"
+    scope_id = Column(Text, nullable=False)
+    version = Column(Integer, nullable=False)
+    body = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), default=func.now())
+    __table_args__ = (UniqueConstraint("scope", "scope_id", "version"),)
 
 
 # New Statistics Schema Models
@@ -80,6 +206,10 @@ class StudentStatistic(Base):
     student_id = Column(Integer, primary_key=True)
     total_submissions = Column(Integer, default=0)
     average_grade_overall = Column(DECIMAL(5, 2))
+    # Running sum and count of the subject grades, kept so a new grade updates
+    # the average without re-reading every subject.
+    grade_sum = Column(Numeric, nullable=False, default=0, server_default="0")
+    graded_courses = Column(Integer, nullable=False, default=0, server_default="0")
     last_updated = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
 
 
@@ -89,6 +219,9 @@ class SubjectGrade(Base):
     student_id = Column(Integer, ForeignKey("student_statistics.student_id", ondelete="CASCADE"))
     course_name = Column(String(255), nullable=False)
     grade = Column(DECIMAL(5, 2))
+    # The grade this row replaced (NULL for a first grade), read back by the
+    # upsert to derive the change to the running sums.
+    previous_grade = Column(DECIMAL(5, 2))
     updated_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
     __table_args__ = (UniqueConstraint("student_id", "course_name", name="_student_course_uc"),)
 
@@ -116,51 +249,260 @@ class TeacherAnalytic(Base):
     __table_args__ = (UniqueConstraint("teacher_id", "course_name", name="_teacher_course_uc"),)
 
 
-def get_db_session():
-    engine = create_engine(DB_URL)
-    from sqlalchemy import text
+class CourseTeacher(Base):
+    """The teacher and name of a course, sent with grading requests by the app.
+
+    Feedback only carries ``course_id``; this says whose ``teacher_analytics``
+    it counts towards.
+    """
+
+    __tablename__ = "course_teachers"
+    course_id = Column(Text, primary_key=True)
+    teacher_id = Column(Integer, nullable=False)
+    course_name = Column(String(255), nullable=False)
+    updated_at = Column(DateTime(timezone=True), default=func.now(), onupdate=func.now())
+
+
+class TeacherCriterionMarks(Base):
+    """Running mark sums of one criterion over a teacher's course (see ``teacher_analytics``)."""
 
-    with engine.connect() as conn:
-        conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
-        conn.commit()
+    __tablename__ = "teacher_criterion_marks"
+    teacher_id = Column(Integer, primary_key=True)
+    course_name = Column(String(255), primary_key=True)
+    criterion = Column(Text, primary_key=True)
+    mark_sum = Column(Numeric, nullable=False, default=0)
+    max_mark_sum = Column(Numeric, nullable=False, default=0)
+    marks = Column(Integer, nullable=False, default=0)
+
+
+class TeacherGradeBucket(Base):
+    """Students of a teacher's course whose overall mark falls in one histogram bucket."""
+
+    __tablename__ = "teacher_grade_buckets"
+    teacher_id = Column(Integer, primary_key=True)
+    course_name = Column(String(255), primary_key=True)
+    bucket = Column(Integer, primary_key=True)
+    students = Column(Integer, nullable=False, default=0)
+
+
+class TeacherAnalyticsFeedback(Base):
+    """What each student's latest feedback for an assignment added to the analytics.
+
+    A newer feedback for the same student and assignment (a re-grade or
+    resubmission) replaces it, after taking its contribution back out.
+    """
+
+    __tablename__ = "teacher_analytics_feedback"
+    course_id = Column(Text, primary_key=True)
+    student_id = Column(Text, primary_key=True)
+    assignment_id = Column(Text, primary_key=True)
+    feedback_id = Column(BigInteger, nullable=False)
+    teacher_id = Column(Integer, nullable=False)
+    course_name = Column(String(255), nullable=False)
+    criterion_marks = Column(JSONB, nullable=False)
+    grade_bucket = Column(Integer)
+
+
+class StatsIdempotencyKey(Base):
+    """Statistics updates already applied, keyed by the sender's ``Idempotency-Key``."""
+
+    __tablename__ = "stats_idempotency_keys"
+    key = Column(Text, primary_key=True)
+    applied_at = Column(DateTime(timezone=True), default=func.now())
+
+
+# create_all only creates missing tables; columns added to existing tables
+# after the first deployment are brought in here. Every statement must be
+# idempotent.
+SCHEMA_UPGRADES = [
+    """
+    ALTER TABLE reference_chunks
+    ADD COLUMN IF NOT EXISTS content_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', content)) STORED
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_reference_chunks_content_tsv
+    ON reference_chunks USING gin (content_tsv)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS ix_reference_chunks_assignment
+    ON reference_chunks (assignment_id, doc_type)
+    """,
+    "ALTER TABLE feedback ADD COLUMN IF NOT EXISTS metrics JSONB",
+    "ALTER TABLE feedback ADD COLUMN IF NOT EXISTS essay_embedding vector",
+    """
+    ALTER TABLE student_statistics
+    ADD COLUMN IF NOT EXISTS grade_sum NUMERIC NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS graded_courses INTEGER NOT NULL DEFAULT 0
+    """,
+    "ALTER TABLE subject_grades ADD COLUMN IF NOT EXISTS previous_grade DECIMAL(5, 2)",
+    # Seed the running sums of students graded before they existed.
+    """
+    UPDATE student_statistics AS s
+    SET    grade_sum = a.grade_sum, graded_courses = a.graded_courses
+    FROM   (SELECT student_id, sum(grade) AS grade_sum, count(grade) AS graded_courses
+            FROM   subject_grades
+            GROUP  BY student_id) AS a
+    WHERE  s.student_id = a.student_id AND s.graded_courses = 0 AND a.graded_courses > 0
+    """,
+]
+
+
+def init_schema(engine=None):
+    """Create the extension, tables and schema upgrades.
+
+    Run once per process or deployment (the API's startup hook or
+    ``rag_cli.py migrate``), never per request.
+    """
+    engine = engine or get_engine()
+    with engine.begin() as conn:
+        conn.execute(sqltext("CREATE EXTENSION IF NOT EXISTS vector"))
     Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    return Session()
+    with engine.begin() as conn:
+        for stmt in SCHEMA_UPGRADES:
+            conn.execute(sqltext(stmt))
+
+
+_engine = None
+_engine_lock = threading.Lock()
+_Session = sessionmaker()
+
+
+def get_engine():
+    """The process-wide pooled engine, created on first use."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(
+                DB_URL,
+                pool_size=DB_POOL_SIZE,
+                max_overflow=DB_MAX_OVERFLOW,
+                pool_timeout=DB_POOL_TIMEOUT_S,
+                pool_recycle=DB_POOL_RECYCLE_S,
+                pool_pre_ping=True,
+            )
+            event.listen(_engine, "connect", lambda *_: service_metrics.incr("db_pool.connects"))
+            event.listen(_engine, "checkout", lambda *_: service_metrics.incr("db_pool.checkouts"))
+            _Session.configure(bind=_engine)
+        return _engine
 
 
-def update_student_submission_stats(student_id: int, course_name: str, grade: float):
-    session = get_db_session()
-    try:
-        # Check if student exists, if not create one
-        student_stat = session.query(StudentStatistic).filter_by(student_id=student_id).first()
-        if not student_stat:
-            student_stat = StudentStatistic(student_id=student_id, total_submissions=0)
-            session.add(student_stat)
-            session.flush()  # to get the id
-
-        # Increment submissions
-        student_stat.total_submissions += 1
-
-        # Update subject grade
-        subject_grade = (
-            session.query(SubjectGrade)
-            .filter_by(student_id=student_id, course_name=course_name)
-            .first()
-        )
-        if not subject_grade:
-            subject_grade = SubjectGrade(student_id=student_id, course_name=course_name)
-            session.add(subject_grade)
-        subject_grade.grade = grade
+def get_sessionmaker():
+    get_engine()
+    return _Session
 
-        session.commit()
 
-        # Recalculate average grade
-        grades = session.query(SubjectGrade.grade).filter_by(student_id=student_id).all()
-        if grades:
-            average = sum(g[0] for g in grades) / len(grades)
-            student_stat.average_grade_overall = average
+def get_db_session():
+    return get_sessionmaker()()
+
+
+def pool_status() -> dict:
+    """Current connection usage of the shared engine's pool."""
+    if _engine is None:
+        return {"initialised": False}
+    pool = _engine.pool
+    return {
+        "initialised": True,
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "checked_in": pool.checkedin(),
+        "overflow": pool.overflow(),
+        "max_overflow": DB_MAX_OVERFLOW,
+        "timeout_s": DB_POOL_TIMEOUT_S,
+    }
+
+
+def _first_delivery(session, idempotency_key: str | None) -> bool:
+    """Record ``idempotency_key`` in the caller's transaction; ``False`` if it was applied before."""
+    if idempotency_key is None:
+        return True
+    return (
+        session.execute(
+            sqltext(
+                """
+                INSERT INTO stats_idempotency_keys (key, applied_at) VALUES (:key, now())
+                ON CONFLICT (key) DO NOTHING
+                RETURNING key
+                """
+            ),
+            {"key": idempotency_key},
+        ).first()
+        is not None
+    )
+
+
+# Upserts the latest grade per student/course, then folds the change into each
+# student's running sum and count in the same statement. ``previous_grade`` is
+# set under the row lock ON CONFLICT takes, so concurrent updates of a student
+# each see the grade they replaced and the sums stay exact without re-reading
+# the student's other subjects. Only non-NULL grades count, in the sum and in
+# ``graded_courses`` alike (as in the seed above).
+_SUBMISSION_STATS_UPSERT = """
+    WITH e AS (
+        SELECT *
+        FROM   unnest(CAST(:ids AS integer[]), CAST(:courses AS text[]),
+                      CAST(:grades AS numeric[]))
+               WITH ORDINALITY AS e(student_id, course_name, grade, ord)
+    ),
+    g AS (
+        INSERT INTO subject_grades (student_id, course_name, grade, updated_at)
+        SELECT DISTINCT ON (student_id, course_name) student_id, course_name, grade, now()
+        FROM   e
+        ORDER  BY student_id, course_name, ord DESC
+        ON CONFLICT (student_id, course_name)
+        DO UPDATE SET previous_grade = subject_grades.grade,
+                      grade = EXCLUDED.grade,
+                      updated_at = now()
+        RETURNING student_id,
+                  COALESCE(grade, 0) - COALESCE(previous_grade, 0) AS sum_delta,
+                  CAST(grade IS NOT NULL AS integer)
+                  - CAST(previous_grade IS NOT NULL AS integer) AS count_delta
+    ),
+    d AS (
+        SELECT student_id, sum(sum_delta) AS sum_delta, sum(count_delta) AS count_delta
+        FROM   g
+        GROUP  BY student_id
+    ),
+    c AS (
+        SELECT student_id, count(*) AS n FROM e GROUP BY student_id
+    )
+    INSERT INTO student_statistics (student_id, total_submissions, grade_sum, graded_courses,
+                                    average_grade_overall, last_updated)
+    SELECT c.student_id, c.n, d.sum_delta, d.count_delta,
+           d.sum_delta / NULLIF(d.count_delta, 0), now()
+    FROM   c JOIN d USING (student_id)
+    ORDER  BY c.student_id
+    ON CONFLICT (student_id) DO UPDATE
+    SET    total_submissions = COALESCE(student_statistics.total_submissions, 0)
+                               + EXCLUDED.total_submissions,
+           grade_sum = student_statistics.grade_sum + EXCLUDED.grade_sum,
+           graded_courses = student_statistics.graded_courses + EXCLUDED.graded_courses,
+           average_grade_overall = (student_statistics.grade_sum + EXCLUDED.grade_sum)
+                                   / NULLIF(student_statistics.graded_courses
+                                            + EXCLUDED.graded_courses, 0),
+           last_updated = now()
+"""
+
+
+def _apply_submission_grades(session, student_ids: list, course_names: list, grades: list):
+    """Count each submission and set its student's grade for the course, in order."""
+    session.execute(
+        sqltext(_SUBMISSION_STATS_UPSERT),
+        {"ids": student_ids, "courses": course_names, "grades": grades},
+    )
+
 
+def update_student_submission_stats(
+    student_id: int, course_name: str, grade: float, idempotency_key: str | None = None
+) -> bool:
+    """Count a graded submission; returns ``False`` for a repeated ``idempotency_key``."""
+    session = get_db_session()
+    try:
+        if not _first_delivery(session, idempotency_key):
+            return False
+        _apply_submission_grades(session, [student_id], [course_name], [grade])
         session.commit()
+        return True
     except Exception as e:
         session.rollback()
         logging.error(f"Error updating student stats: {e}")
@@ -169,9 +511,14 @@ def update_student_submission_stats(student_id: int, course_name: str, grade: fl
         session.close()
 
 
-def update_subject_feedback(student_id: int, course_name: str, feedback: str):
+def update_subject_feedback(
+    student_id: int, course_name: str, feedback: str, idempotency_key: str | None = None
+) -> bool:
     session = get_db_session()
     try:
+        if not _first_delivery(session, idempotency_key):
+            return False
+
         feedback_record = (
             session.query(SubjectFeedback)
             .filter_by(student_id=student_id, course_name=course_name)
@@ -190,6 +537,7 @@ def update_subject_feedback(student_id: int, course_name: str, feedback: str):
         feedback_record.last_feedback = feedback
         feedback_record.last_feedback_date = func.now()
         session.commit()
+        return True
     except Exception as e:
         session.rollback()
         logging.error(f"Error updating subject feedback: {e}")
@@ -201,6 +549,7 @@ def update_subject_feedback(student_id: int, course_name: str, feedback: str):
 def update_teacher_analytics(
     teacher_id: int, course_name: str, worst_criteria: dict, grade_distribution: dict
 ):
+    """Overwrite a course's analytics; the next stored feedback for it rebuilds them."""
     session = get_db_session()
     try:
         analytic_record = (
@@ -223,6 +572,136 @@ def update_teacher_analytics(
         session.close()
 
 
+def apply_statistics_batch(events: list[dict]) -> dict:
+    """Apply a batch of statistics updates in one transaction with set-based statements.
+
+    Each event is ``{"type": "submission" | "feedback" | "teacher_analytics", ...}``
+    with the fields of the matching single-update function, plus an optional
+    ``idempotency_key``. Events whose key was applied before (or repeats within
+    the batch) are skipped. Within the batch the last event for a
+    student/course (or teacher/course) sets the grade, feedback or analytics,
+    as applying the events one by one would.
+    """
+    session = get_db_session()
+    try:
+        keys = list({e["idempotency_key"] for e in events if e.get("idempotency_key")})
+        new_keys = set()
+        if keys:
+            new_keys = {
+                row[0]
+                for row in session.execute(
+                    sqltext(
+                        """
+                        INSERT INTO stats_idempotency_keys (key, applied_at)
+                        SELECT k, now() FROM unnest(CAST(:keys AS text[])) AS k
+                        ON CONFLICT (key) DO NOTHING
+                        RETURNING key
+                        """
+                    ),
+                    {"keys": keys},
+                )
+            }
+        fresh = []
+        for event in events:
+            key = event.get("idempotency_key")
+            if key:
+                if key not in new_keys:
+                    continue
+                new_keys.discard(key)
+            fresh.append(event)
+
+        submissions = [e for e in fresh if e["type"] == "submission"]
+        feedback = [e for e in fresh if e["type"] == "feedback"]
+        analytics = [e for e in fresh if e["type"] == "teacher_analytics"]
+
+        # Submissions first: their upsert locks subject_grades before
+        # student_statistics, as the single update does.
+        if submissions:
+            _apply_submission_grades(
+                session,
+                [e["student_id"] for e in submissions],
+                [e["course_name"] for e in submissions],
+                [e["grade"] for e in submissions],
+            )
+
+        student_ids = list({e["student_id"] for e in feedback})
+        if student_ids:
+            session.execute(
+                sqltext(
+                    """
+                    INSERT INTO student_statistics (student_id, total_submissions, last_updated)
+                    SELECT s, 0, now() FROM unnest(CAST(:ids AS integer[])) AS s
+                    ON CONFLICT (student_id) DO NOTHING
+                    """
+                ),
+                {"ids": student_ids},
+            )
+
+        if feedback:
+            session.execute(
+                sqltext(
+                    """
+                    INSERT INTO subject_feedback
+                           (student_id, course_name, last_feedback, last_feedback_date)
+                    SELECT DISTINCT ON (e.student_id, e.course_name)
+                           e.student_id, e.course_name, e.feedback, now()
+                    FROM   unnest(CAST(:ids AS integer[]), CAST(:courses AS text[]),
+                                  CAST(:feedback AS text[]))
+                           WITH ORDINALITY AS e(student_id, course_name, feedback, ord)
+                    ORDER  BY e.student_id, e.course_name, e.ord DESC
+                    ON CONFLICT (student_id, course_name)
+                    DO UPDATE SET last_feedback = EXCLUDED.last_feedback,
+                                  last_feedback_date = now()
+                    """
+                ),
+                {
+                    "ids": [e["student_id"] for e in feedback],
+                    "courses": [e["course_name"] for e in feedback],
+                    "feedback": [e["feedback"] for e in feedback],
+                },
+            )
+
+        if analytics:
+            session.execute(
+                sqltext(
+                    """
+                    INSERT INTO teacher_analytics (teacher_id, course_name, worst_marked_criteria,
+                                                   student_grade_distribution, last_updated)
+                    SELECT DISTINCT ON (e.teacher_id, e.course_name)
+                           e.teacher_id, e.course_name, CAST(e.worst AS jsonb),
+                           CAST(e.distribution AS jsonb), now()
+                    FROM   unnest(CAST(:ids AS integer[]), CAST(:courses AS text[]),
+                                  CAST(:worst AS text[]), CAST(:distribution AS text[]))
+                           WITH ORDINALITY AS e(teacher_id, course_name, worst, distribution, ord)
+                    ORDER  BY e.teacher_id, e.course_name, e.ord DESC
+                    ON CONFLICT (teacher_id, course_name)
+                    DO UPDATE SET worst_marked_criteria = EXCLUDED.worst_marked_criteria,
+                                  student_grade_distribution = EXCLUDED.student_grade_distribution,
+                                  last_updated = now()
+                    """
+                ),
+                {
+                    "ids": [e["teacher_id"] for e in analytics],
+                    "courses": [e["course_name"] for e in analytics],
+                    "worst": [json.dumps(e["worst_criteria"]) for e in analytics],
+                    "distribution": [json.dumps(e["grade_distribution"]) for e in analytics],
+                },
+            )
+
+        session.commit()
+        return {
+            "received": len(events),
+            "applied": len(fresh),
+            "duplicates": len(events) - len(fresh),
+        }
+    except Exception as e:
+        session.rollback()
+        logging.error(f"Error applying statistics batch: {e}")
+        raise
+    finally:
+        session.close()
+
+
 def get_student_statistics(student_id: int):
     session = get_db_session()
     try:
@@ -271,6 +750,8 @@ class EmbeddingModel:
 
     # unified API ------------------------------------------------------
     def embed(self, texts: List[str]) -> List[List[float]]:
+        # Remote providers share a rate limit across workers; local models have none.
+        acquire(f"embed:{self.provider}", requests=1, tokens=sum(len(t) for t in texts) / 4)
         if hasattr(self.model, "embed_documents"):
             return self.model.embed_documents(texts)
         elif hasattr(self.model, "embed"):
@@ -359,21 +840,233 @@ def topk_rubric(
     return [r[0] for r in rows]
 
 
-def ingest_reference_file(
-    file_path: str, assignment_id: str, doc_type: str, chunker: str, embedder_name: str
+# ---------------------------------------------------------------------
+# 6.  Lexical (full-text) retrieval – no embedding call required
+# ---------------------------------------------------------------------
+
+LEXICAL_MAX_TERMS = 128
+
+
+def lexical_query_terms(query_text: str, limit: int = LEXICAL_MAX_TERMS) -> str:
+    """Reduce an essay to its most frequent content words.
+
+    Whole essays make enormous tsqueries; the most frequent words carry most of
+    the signal for ranking rubric/exemplar chunks.
+    """
+    words = re.findall(r"[a-z][a-z0-9'-]{3,}", query_text.lower())
+    return " ".join(w for w, _ in Counter(words).most_common(limit))
+
+
+def topk_lexical(
+    session, assignment_id: str, query_text: str, k: int = 6, doc_type: str | None = None
 ):
-    # -- setup DB session
-    engine = create_engine(DB_URL)
+    # plainto_tsquery ANDs every term, which almost never matches a short
+    # chunk; rewrite it as an OR query and let ts_rank_cd do the ordering.
+    stmt = sqltext(
+        """
+        WITH q AS (
+            SELECT CAST(
+                replace(CAST(plainto_tsquery('english', :qtext) AS TEXT), ' & ', ' | ')
+                AS tsquery
+            ) AS query
+        )
+        SELECT content
+        FROM   reference_chunks, q
+        WHERE  assignment_id = :aid
+          AND  (CAST(:dtype AS TEXT) IS NULL OR doc_type = :dtype)
+          AND  content_tsv @@ q.query
+        ORDER  BY ts_rank_cd(content_tsv, q.query) DESC
+        LIMIT  :limit;
+        """
+    )
+    rows = session.execute(
+        stmt,
+        {
+            "aid": assignment_id,
+            "qtext": lexical_query_terms(query_text),
+            "limit": k,
+            "dtype": doc_type,
+        },
+    ).fetchall()
+    return [r[0] for r in rows]
 
-    with engine.begin() as conn:
-        try:
-            conn.execute(sqltext("CREATE EXTENSION IF NOT EXISTS vector"))
-        except ProgrammingError:
-            raise
 
-    Base.metadata.create_all(engine)
+def fuse_rrf(rankings: List[List[str]], k: int, c: int = 60) -> List[str]:
+    """Reciprocal rank fusion of several ranked content lists."""
+    scores = {}
+    for ranking in rankings:
+        for rank, content in enumerate(ranking):
+            scores[content] = scores.get(content, 0.0) + 1.0 / (c + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)[:k]
+
+
+def retrieve_context(
+    session,
+    assignment_id: str,
+    qvec: List[float] | None,
+    query_text: str,
+    mode: str = "vector",
+    rubric_k: int = 4,
+    exemplar_k: int = 6,
+):
+    """Return ``(rubric_ctx, exemplar_ctx)`` for the grading prompt.
+
+    ``mode`` is ``"full"``, ``"vector"``, ``"lexical"`` or ``"hybrid"``. Without
+    a query vector (embedding failed or timed out) ranking is always lexical.
+    """
+    if mode == "full":
+        return load_reference_set(session, assignment_id)
+    if qvec is None or mode == "lexical":
+        return (
+            topk_lexical(session, assignment_id, query_text, k=rubric_k, doc_type="rubric"),
+            topk_lexical(session, assignment_id, query_text, k=exemplar_k),
+        )
+    rubric_ctx = topk_rubric(session, assignment_id, qvec, k=rubric_k)
+    exemplar_ctx = topk_reference_chunks(session, assignment_id, qvec, k=exemplar_k)
+    if mode == "hybrid":
+        rubric_ctx = fuse_rrf(
+            [
+                rubric_ctx,
+                topk_lexical(session, assignment_id, query_text, k=rubric_k, doc_type="rubric"),
+            ],
+            k=rubric_k,
+        )
+        exemplar_ctx = fuse_rrf(
+            [exemplar_ctx, topk_lexical(session, assignment_id, query_text, k=exemplar_k)],
+            k=exemplar_k,
+        )
+    return rubric_ctx, exemplar_ctx
+
+
+# ---------------------------------------------------------------------
+# 7.  Small-corpus bypass – send the whole reference set, skip embedding
+# ---------------------------------------------------------------------
+
+FULL_CONTEXT_CHAR_BUDGET = int(os.getenv("RAG_FULL_CONTEXT_CHAR_BUDGET", "24000"))
+# Rubrics up to this size go into the cached prompt prefix whole.
+RUBRIC_PREFIX_CHAR_BUDGET = int(os.getenv("RAG_RUBRIC_PREFIX_CHAR_BUDGET", "12000"))
+
+_reference_sets = {}
+_reference_sets_lock = threading.Lock()
+
+
+def reference_set_version(session, assignment_id: str):
+    """``(chunk_count, max_chunk_id, total_chars)`` – changes whenever chunks are added or removed."""
+    row = session.execute(
+        sqltext(
+            """
+            SELECT count(*), coalesce(max(id), 0), coalesce(sum(length(content)), 0)
+            FROM   reference_chunks
+            WHERE  assignment_id = :aid
+            """
+        ),
+        {"aid": assignment_id},
+    ).one()
+    return int(row[0]), int(row[1]), int(row[2])
+
+
+def load_reference_set(session, assignment_id: str):
+    """Every chunk of the assignment as ``(rubric_ctx, exemplar_ctx)``, cached per version."""
+    version = reference_set_version(session, assignment_id)
+    with _reference_sets_lock:
+        cached = _reference_sets.get(assignment_id)
+    if cached and cached[0] == version:
+        return cached[1]
 
-    Session = sessionmaker(bind=engine)
+    rows = session.execute(
+        sqltext(
+            """
+            SELECT doc_type, content
+            FROM   reference_chunks
+            WHERE  assignment_id = :aid
+            ORDER  BY id
+            """
+        ),
+        {"aid": assignment_id},
+    ).fetchall()
+    context = (
+        [content for doc_type, content in rows if doc_type == "rubric"],
+        [content for doc_type, content in rows if doc_type != "rubric"],
+    )
+    with _reference_sets_lock:
+        _reference_sets[assignment_id] = (version, context)
+    return context
+
+
+def stable_rubric(session, assignment_id: str, budget: int | None = None) -> list[str] | None:
+    """The whole rubric in document order when it fits ``budget`` characters.
+
+    A rubric that does not depend on the essay keeps the prompt prefix
+    identical across submissions, which is what provider prompt caching keys
+    on. ``None`` means the rubric is too large and must be retrieved per essay.
+    """
+    rubric_ctx, _ = load_reference_set(session, assignment_id)
+    if not rubric_ctx:
+        return None
+    budget = RUBRIC_PREFIX_CHAR_BUDGET if budget is None else budget
+    return rubric_ctx if sum(len(c) for c in rubric_ctx) <= budget else None
+
+
+def rubric_version(session, assignment_id: str) -> str:
+    """Version of the assignment's rubric chunks alone, in the form of ``reference_set_version``."""
+    row = session.execute(
+        sqltext(
+            """
+            SELECT count(*), coalesce(max(id), 0), coalesce(sum(length(content)), 0)
+            FROM   reference_chunks
+            WHERE  assignment_id = :aid AND doc_type = 'rubric'
+            """
+        ),
+        {"aid": assignment_id},
+    ).one()
+    return f"{int(row[0])}:{int(row[1])}:{int(row[2])}"
+
+
+def render_compiled_rubric(criteria: list[dict]) -> list[str]:
+    """One compact prompt chunk per criterion: its name, maximum and mark bands."""
+    chunks = []
+    for criterion in criteria:
+        lines = [f"{criterion['name']} (max {criterion['max_mark']:g})"]
+        lines += [f"- {band['marks']}: {band['descriptor']}" for band in criterion["bands"]]
+        chunks.append("\n".join(lines))
+    return chunks
+
+
+def compiled_rubric_row(session, assignment_id: str):
+    """The assignment's :class:`CompiledRubric` if it matches the current rubric, else ``None``."""
+    row = session.get(CompiledRubric, assignment_id)
+    if row is None or row.source_version != rubric_version(session, assignment_id):
+        return None
+    return row
+
+
+def compiled_rubric(session, assignment_id: str) -> list[str] | None:
+    """The compiled rubric as prompt chunks, or ``None`` when there is no current one."""
+    row = compiled_rubric_row(session, assignment_id)
+    return render_compiled_rubric(row.criteria) if row is not None else None
+
+
+def plan_retrieval(session, assignment_id: str, requested: str = "vector") -> str:
+    """Decide between sending the full reference set and ranked retrieval.
+
+    Returns ``"full"`` or ``requested``.
+    """
+    settings = session.get(AssignmentSettings, assignment_id)
+    policy = settings.retrieval_policy if settings else "auto"
+    if policy == "full":
+        return "full"
+    if policy == "retrieve":
+        return requested
+
+    budget = (settings and settings.full_context_char_budget) or FULL_CONTEXT_CHAR_BUDGET
+    count, _, total_chars = reference_set_version(session, assignment_id)
+    return "full" if count and total_chars <= budget else requested
+
+
+def ingest_reference_file(
+    file_path: str, assignment_id: str, doc_type: str, chunker: str, embedder_name: str
+):
+    Session = get_sessionmaker()
     embedder = EmbeddingModel(embedder_name)
     splitter_texts: List[str] = run_chunker(file_path, chunker)
     if isinstance(splitter_texts, list) and isinstance(splitter_texts[0], str):
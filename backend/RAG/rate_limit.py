@@ -0,0 +1,182 @@
+"""Per-provider token buckets shared by every RAG worker process.
+
+Each provider has a requests-per-minute and a tokens-per-minute bucket in
+Postgres (``rate_limit_buckets``), so all workers draw from one budget
+instead of each discovering the provider's limit through 429s. Callers wait
+for capacity (up to ``RATE_LIMIT_MAX_WAIT_S``) rather than fail.
+
+Limits are ``provider=rpm/tpm`` pairs; ``RATE_LIMITS`` overrides the
+defaults, e.g. ``RATE_LIMITS="deepseek=120/2000000,embed:gitee=60/0"``
+(0 disables that dimension). Embedding providers are named ``embed:<name>``.
+"""
+
+import os
+import time
+import asyncio
+import logging
+
+from sqlalchemy import text as sqltext
+
+import metrics as service_metrics
+
+DEFAULT_LIMITS = {
+    "deepseek": (60, 1_000_000),
+    "openai": (500, 200_000),
+    "gemini": (60, 1_000_000),
+    "gitee": (30, 200_000),
+    "embed:openai": (1000, 1_000_000),
+    "embed:gitee": (120, 500_000),
+}
+RATE_LIMIT_MAX_WAIT_S = float(os.getenv("RATE_LIMIT_MAX_WAIT_S", "300"))
+# Never sleep longer than this between checks; other workers may refund capacity.
+MAX_POLL_S = 5.0
+
+
+def _parse_limits(spec: str) -> dict:
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, values = item.partition("=")
+        rpm, _, tpm = values.partition("/")
+        limits[name.strip()] = (float(rpm or 0), float(tpm or 0))
+    return limits
+
+
+LIMITS = {**DEFAULT_LIMITS, **_parse_limits(os.getenv("RATE_LIMITS", ""))}
+
+
+def _get_engine():
+    """The service's shared engine, or ``None`` when no database is configured."""
+    if not os.getenv("DATABASE_URL"):
+        return None
+    from rag_db import get_engine  # rag_db imports this module
+
+    return get_engine()
+
+
+def _buckets(name: str, requests: float, tokens: float):
+    """``(bucket, capacity_per_minute, cost)`` for each limited dimension."""
+    rpm, tpm = LIMITS.get(name, (0, 0))
+    wanted = [(f"{name}:requests", rpm, requests), (f"{name}:tokens", tpm, tokens)]
+    # A single call larger than a whole minute's budget waits for a full bucket.
+    return [(bucket, per_min, min(cost, per_min)) for bucket, per_min, cost in wanted if per_min and cost]
+
+
+def try_acquire(name: str, requests: float = 1, tokens: float = 0) -> float:
+    """Take capacity from ``name``'s buckets if all have enough.
+
+    Returns ``0.0`` when granted, otherwise the seconds until there should
+    be enough. All buckets are checked and debited in one transaction.
+    """
+    buckets = _buckets(name, requests, tokens)
+    engine = _get_engine()
+    if not buckets or engine is None:
+        return 0.0
+    with engine.begin() as conn:
+        conn.execute(
+            sqltext(
+                """
+                INSERT INTO rate_limit_buckets (bucket, tokens, updated_at)
+                VALUES (:bucket, :tokens, clock_timestamp())
+                ON CONFLICT (bucket) DO NOTHING
+                """
+            ),
+            [{"bucket": bucket, "tokens": per_min} for bucket, per_min, _ in buckets],
+        )
+        rows = conn.execute(
+            sqltext(
+                """
+                SELECT bucket, tokens, EXTRACT(EPOCH FROM clock_timestamp() - updated_at)
+                FROM   rate_limit_buckets
+                WHERE  bucket = ANY(:buckets)
+                ORDER  BY bucket
+                FOR UPDATE
+                """
+            ),
+            {"buckets": [bucket for bucket, _, _ in buckets]},
+        ).fetchall()
+        state = {bucket: (float(level), float(elapsed)) for bucket, level, elapsed in rows}
+
+        wait, updates = 0.0, []
+        for bucket, per_min, cost in buckets:
+            level, elapsed = state[bucket]
+            per_second = per_min / 60.0
+            available = min(per_min, level + elapsed * per_second)
+            if available < cost:
+                wait = max(wait, (cost - available) / per_second)
+            updates.append({"bucket": bucket, "tokens": available - cost})
+        if wait:
+            return wait
+        conn.execute(
+            sqltext(
+                """
+                UPDATE rate_limit_buckets
+                SET    tokens = :tokens, updated_at = clock_timestamp()
+                WHERE  bucket = :bucket
+                """
+            ),
+            updates,
+        )
+    return 0.0
+
+
+def settle(name: str, tokens_delta: float):
+    """Correct the token bucket once the real usage is known (negative refunds)."""
+    rpm, tpm = LIMITS.get(name, (0, 0))
+    engine = _get_engine()
+    if not tpm or not tokens_delta or engine is None:
+        return
+    try:
+        with engine.begin() as conn:
+            conn.execute(
+                sqltext(
+                    """
+                    UPDATE rate_limit_buckets
+                    SET    tokens = LEAST(:capacity, tokens - :delta)
+                    WHERE  bucket = :bucket
+                    """
+                ),
+                {"bucket": f"{name}:tokens", "capacity": tpm, "delta": tokens_delta},
+            )
+    except Exception as e:
+        logging.warning("Rate limit settle for %s failed: %s", name, e)
+
+
+def acquire(name: str, requests: float = 1, tokens: float = 0):
+    """Block until ``name`` has capacity. Limiter errors fail open."""
+    started = time.monotonic()
+    while True:
+        try:
+            wait = try_acquire(name, requests, tokens)
+        except Exception as e:
+            logging.warning("Rate limiter unavailable for %s: %s", name, e)
+            return
+        waited = time.monotonic() - started
+        if not wait or waited >= RATE_LIMIT_MAX_WAIT_S:
+            break
+        time.sleep(min(wait, MAX_POLL_S))
+    _record(name, waited, wait)
+
+
+async def aacquire(name: str, requests: float = 1, tokens: float = 0):
+    """Async :func:`acquire`; the event loop keeps serving while this waits."""
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    while True:
+        try:
+            wait = await asyncio.to_thread(try_acquire, name, requests, tokens)
+        except Exception as e:
+            logging.warning("Rate limiter unavailable for %s: %s", name, e)
+            return
+        waited = loop.time() - started
+        if not wait or waited >= RATE_LIMIT_MAX_WAIT_S:
+            break
+        await asyncio.sleep(min(wait, MAX_POLL_S))
+    _record(name, waited, wait)
+
+
+def _record(name: str, waited: float, still_short: float):
+    if waited > 0.01:
+        service_metrics.observe(f"rate_limit.{name}.wait_seconds", waited)
+    if still_short:
+        service_metrics.incr(f"rate_limit.{name}.gave_up")
+        logging.warning("Rate limit wait for %s exceeded %ss; sending anyway", name, RATE_LIMIT_MAX_WAIT_S)
@@ -0,0 +1,145 @@
+"""Compile an assignment's rubric into a structured criteria table.
+
+Rubric PDFs are chunked like any other reference document, so every grading
+call used to re-send whichever rubric chunks retrieval ranked highest, as raw
+PDF text. After a rubric is uploaded this module asks the model once to turn
+those chunks into criteria, mark bands and descriptors, and stores the result
+in ``compiled_rubrics``. Grading prompts then carry the compact table instead
+(``rag_db.compiled_rubric``): it is shorter and identical for every essay.
+"""
+
+import os
+import json
+import logging
+
+from sqlalchemy import text as sqltext
+
+from rag_db import CompiledRubric, get_sessionmaker, rubric_version
+from feedback_json import compile_schema, format_errors, loads_tolerant
+from llm import LLM, ProviderChain, run_sync
+
+RUBRIC_COMPILE_PROVIDER = os.getenv("RAG_RUBRIC_COMPILE_PROVIDER", "deepseek")
+
+COMPILED_RUBRIC_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "criteria": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "name": {"type": "string"},
+                    "max_mark": {"type": "number"},
+                    "bands": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {
+                                "marks": {"type": "string"},
+                                "descriptor": {"type": "string"},
+                            },
+                            "required": ["marks", "descriptor"],
+                        },
+                    },
+                },
+                "required": ["name", "max_mark", "bands"],
+            },
+        }
+    },
+    "required": ["criteria"],
+}
+validate_compiled_rubric = compile_schema(COMPILED_RUBRIC_SCHEMA)
+
+COMPILE_INSTRUCTIONS = (
+    "You convert a marking rubric extracted from a PDF into a structured criteria table. "
+    "Reply with only JSON of the form "
+    '{"criteria": [{"name": "", "max_mark": 0, "bands": [{"marks": "", "descriptor": ""}]}]}. '
+    "List every criterion in the rubric's order. For each, give its maximum mark and its "
+    'mark bands from highest to lowest; "marks" is the band\'s mark or range as written '
+    '(e.g. "3-4"), "descriptor" the band\'s descriptor condensed to the words that '
+    "distinguish it from the neighbouring bands. Do not invent criteria or bands."
+)
+
+
+def compile_messages(rubric_chunks: list[str]) -> list[dict]:
+    return [
+        {"role": "system", "content": COMPILE_INSTRUCTIONS},
+        {"role": "user", "content": "[RUBRIC]\n" + "\n\n".join(rubric_chunks)},
+    ]
+
+
+def _rubric_chunks(session, assignment_id: str) -> list[str]:
+    rows = session.execute(
+        sqltext(
+            """
+            SELECT content
+            FROM   reference_chunks
+            WHERE  assignment_id = :aid AND doc_type = 'rubric'
+            ORDER  BY id
+            """
+        ),
+        {"aid": assignment_id},
+    ).fetchall()
+    return [r[0] for r in rows]
+
+
+def compile_rubric(assignment_id: str, provider: str | None = None) -> dict | None:
+    """Compile and store the assignment's rubric; ``None`` if it has no rubric chunks.
+
+    Raises ``ValueError`` when the model's table does not match the schema;
+    the previous compiled rubric (if any) is then left stale and unused.
+    """
+    provider = provider or RUBRIC_COMPILE_PROVIDER
+    Session = get_sessionmaker()
+    with Session() as session:
+        chunks = _rubric_chunks(session, assignment_id)
+        source_version = rubric_version(session, assignment_id)
+    if not chunks:
+        return None
+
+    chain = ProviderChain(provider, response_schema=COMPILED_RUBRIC_SCHEMA)
+    used_provider, text = run_sync(chain.agenerate(compile_messages(chunks)))
+    compiled = loads_tolerant(text)
+    errors = validate_compiled_rubric(compiled) if isinstance(compiled, dict) else [((), "not an object")]
+    if not errors and not compiled["criteria"]:
+        errors = [(("criteria",), "no criteria")]
+    if errors:
+        raise ValueError("Compiled rubric is invalid: " + "; ".join(format_errors(errors)[:5]))
+
+    model = LLM(used_provider).model
+    with Session.begin() as session:
+        session.merge(
+            CompiledRubric(
+                assignment_id=assignment_id,
+                source_version=source_version,
+                criteria=compiled["criteria"],
+                model=f"{used_provider}/{model}",
+            )
+        )
+    raw_chars = sum(len(c) for c in chunks)
+    compiled_chars = len(json.dumps(compiled["criteria"]))
+    logging.info(
+        "Compiled rubric for %s: %d criteria, %d -> %d chars",
+        assignment_id,
+        len(compiled["criteria"]),
+        raw_chars,
+        compiled_chars,
+    )
+    return {
+        "assignment_id": assignment_id,
+        "source_version": source_version,
+        "criteria": compiled["criteria"],
+        "model": f"{used_provider}/{model}",
+        "raw_chars": raw_chars,
+    }
+
+
+def compile_rubric_in_background(assignment_id: str, provider: str | None = None):
+    """:func:`compile_rubric` for background tasks: failures are logged, not raised.
+
+    Until a compile succeeds grading keeps using the raw rubric chunks.
+    """
+    try:
+        compile_rubric(assignment_id, provider)
+    except Exception as e:
+        logging.error("Rubric compilation for %s failed: %s", assignment_id, e)
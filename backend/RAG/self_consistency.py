@@ -0,0 +1,266 @@
+"""Self-consistency grading.
+
+One sample at ``temperature=0.2`` can land on either side of a borderline
+decision. This mode sends the same grading prompt ``samples`` times
+concurrently and marks each criterion by the median (or the most common mark)
+of the samples. As soon as ``quorum`` finished samples agree on every
+criterion within ``tolerance`` marks, the rest are cancelled, so the usual
+latency is that of the quorum-th fastest sample rather than the slowest.
+
+The stored feedback is the sample closest to the aggregate, with its marks
+replaced by the aggregate and a ``self_consistency`` section that tells
+the teacher how much the samples agreed.
+"""
+
+import os
+import time
+import json
+import asyncio
+import logging
+import statistics
+from collections import Counter
+from itertools import combinations
+
+from feedback_json import parse_feedback
+from compact_output import expand_and_measure
+from llm import (
+    LLM,
+    ProviderChain,
+    _output_contract,
+    _retrieve,
+    arepair_feedback,
+    budgeted_feedback_messages,
+    record_usage,
+    run_sync,
+    store_feedback,
+    sum_usage,
+)
+import metrics as service_metrics
+
+SELF_CONSISTENCY_SAMPLES = int(os.getenv("RAG_SELF_CONSISTENCY_SAMPLES", "1"))
+SELF_CONSISTENCY_MAX_SAMPLES = int(os.getenv("RAG_SELF_CONSISTENCY_MAX_SAMPLES", "7"))
+# Marks two samples may differ by on a criterion and still count as agreeing.
+SELF_CONSISTENCY_TOLERANCE = float(os.getenv("RAG_SELF_CONSISTENCY_TOLERANCE", "0"))
+AGGREGATES = ("median", "vote")
+SELF_CONSISTENCY_AGGREGATE = os.getenv("RAG_SELF_CONSISTENCY_AGGREGATE", "median")
+
+
+def default_quorum(samples: int) -> int:
+    return samples // 2 + 1
+
+
+def cache_salt(samples: int, aggregate: str = SELF_CONSISTENCY_AGGREGATE) -> str:
+    return f"\n[self_consistency:{samples}:{aggregate}]"
+
+
+def _criteria_items(feedback: dict):
+    criteria = feedback.get("criteria")
+    if isinstance(criteria, dict):
+        return [(name, c) for name, c in criteria.items() if isinstance(c, dict)]
+    if isinstance(criteria, list):
+        return [(c.get("criterion", str(i)), c) for i, c in enumerate(criteria) if isinstance(c, dict)]
+    return []
+
+
+def criterion_marks(feedback: dict) -> dict:
+    """``{criterion: mark}`` for every criterion with a numeric mark."""
+    return {
+        name: c["mark"]
+        for name, c in _criteria_items(feedback)
+        if isinstance(c.get("mark"), (int, float)) and not isinstance(c.get("mark"), bool)
+    }
+
+
+def agree(marks: list[dict], tolerance: float) -> bool:
+    """Whether every sample marked the same criteria within ``tolerance`` of each other."""
+    names = set(marks[0])
+    if not names or any(set(m) != names for m in marks):
+        return False
+    return all(max(m[n] for m in marks) - min(m[n] for m in marks) <= tolerance for n in names)
+
+
+def agreeing_subset(marks: list[dict], quorum: int, tolerance: float) -> list[int] | None:
+    """Indices of ``quorum`` samples that agree, or ``None``."""
+    for subset in combinations(range(len(marks)), quorum):
+        if agree([marks[i] for i in subset], tolerance):
+            return list(subset)
+    return None
+
+
+def aggregate_marks(marks: list[dict], aggregate: str) -> dict:
+    names = set().union(*marks)
+    result = {}
+    for name in names:
+        values = sorted(m[name] for m in marks if name in m)
+        if aggregate == "vote":
+            counts = Counter(values).most_common()
+            top = [v for v, n in counts if n == counts[0][1]]
+            # Ties go to the median of the tied marks.
+            result[name] = statistics.median_high(top)
+        else:
+            # median_high keeps the result an actual mark band and, like the
+            # marking guide, gives the student the benefit of the doubt.
+            result[name] = statistics.median_high(values)
+    return result
+
+
+def consistency_report(marks, aggregated, tolerance, requested, early_stopped) -> dict:
+    within = [
+        all(abs(m.get(n, float("inf")) - v) <= tolerance for n, v in aggregated.items())
+        for m in marks
+    ]
+    return {
+        "samples": len(marks),
+        "requested_samples": requested,
+        "early_stopped": early_stopped,
+        "agreement": round(sum(within) / len(marks), 2) if marks else 0.0,
+        "criteria": {
+            name: {
+                "marks": [m[name] for m in marks if name in m],
+                "spread": max(m[name] for m in marks if name in m)
+                - min(m[name] for m in marks if name in m),
+            }
+            for name in sorted(aggregated)
+        },
+    }
+
+
+def apply_marks(feedback: dict, aggregated: dict) -> dict:
+    """Overwrite criterion marks with the aggregate and shift the total to match."""
+    before = sum(criterion_marks(feedback).values())
+    for name, c in _criteria_items(feedback):
+        if name in aggregated:
+            c["mark"] = aggregated[name]
+    delta = sum(criterion_marks(feedback).values()) - before
+    overall = feedback.get("overall_evaluation")
+    if isinstance(overall, dict):
+        for key in ("total_mark", "mark_out_of_20"):
+            if isinstance(overall.get(key), (int, float)):
+                overall[key] = overall[key] + delta
+    return feedback
+
+
+async def astream_self_consistent(
+    student_id: str,
+    assignment_id: str,
+    course_id: str,
+    qvec: list[float] | None,
+    essay_text: str,
+    provider: str = "openai",
+    retrieval: str = "vector",
+    metrics: dict | None = None,
+    cache_key: str | None = None,
+    samples: int = 3,
+    quorum: int | None = None,
+    tolerance: float = SELF_CONSISTENCY_TOLERANCE,
+    aggregate: str = SELF_CONSISTENCY_AGGREGATE,
+    compact: bool = False,
+):
+    """Grade with ``samples`` concurrent samples and store the aggregate.
+
+    Yields ``("sample", {...})`` as each sample finishes, then
+    ``("done", feedback_json)`` once the feedback is stored.
+    """
+    metrics = dict(metrics or {})
+    samples = max(1, min(samples, SELF_CONSISTENCY_MAX_SAMPLES))
+    quorum = max(1, min(quorum or default_quorum(samples), samples))
+    prompt, rubric_ctx, exemplar_ctx = await asyncio.to_thread(
+        _retrieve, course_id, assignment_id, qvec, essay_text, retrieval, metrics
+    )
+    instruction, response_schema = _output_contract(compact)
+    messages = budgeted_feedback_messages(
+        prompt.text, rubric_ctx, exemplar_ctx, essay_text, provider, metrics, instruction
+    )
+
+    async def sample():
+        chain = ProviderChain(provider, response_schema=response_schema)
+        used_provider, text = await chain.agenerate(messages)
+        if compact:
+            text = expand_and_measure(text, LLM(used_provider).model, metrics)
+        return used_provider, text, chain.usage
+
+    started = time.perf_counter()
+    tasks = [asyncio.ensure_future(sample()) for _ in range(samples)]
+    parsed = []  # (provider, text, feedback, marks)
+    unparsed, usage, chosen, last_error = [], [], None, None
+    try:
+        for index, next_done in enumerate(asyncio.as_completed(tasks), start=1):
+            try:
+                used_provider, text, sample_usage = await next_done
+            except Exception as e:
+                last_error = e
+                logging.warning("Grading sample failed: %s", str(e) or type(e).__name__)
+                continue
+            usage.append(sample_usage)
+            try:
+                feedback = parse_feedback(text)
+            except ValueError:
+                unparsed.append((used_provider, text))
+                continue
+            marks = criterion_marks(feedback)
+            parsed.append((used_provider, text, feedback, marks))
+            yield "sample", {"index": index, "of": samples, "marks": marks}
+            if len(parsed) >= quorum:
+                chosen = agreeing_subset([p[3] for p in parsed], quorum, tolerance)
+                if chosen is not None:
+                    break
+    finally:
+        in_flight = [task for task in tasks if not task.done()]
+        for task in in_flight:
+            task.cancel()
+    early_stopped = chosen is not None and bool(in_flight)
+    metrics["generation_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    record_usage(metrics, sum_usage(usage))
+
+    if parsed:
+        used = [parsed[i] for i in chosen] if chosen is not None else parsed
+        aggregated = aggregate_marks([p[3] for p in used], aggregate)
+        # Keep the wording of the sample whose marks are closest to the aggregate.
+        used_provider, _, feedback, _ = min(
+            used,
+            key=lambda p: sum(abs(p[3].get(n, 0) - v) for n, v in aggregated.items()),
+        )
+        report = consistency_report(
+            [p[3] for p in parsed], aggregated, tolerance, samples, early_stopped
+        )
+        feedback = apply_marks(feedback, aggregated)
+        feedback["self_consistency"] = report
+        feedback_json = json.dumps(feedback)
+        service_metrics.observe("self_consistency.agreement", report["agreement"])
+        service_metrics.observe("self_consistency.samples", report["samples"])
+        if early_stopped:
+            service_metrics.incr("self_consistency.early_stopped")
+    elif unparsed:
+        # Nothing parsed: hand the first answer to the repair step as a single call would.
+        used_provider, feedback_json = unparsed[0]
+        report = {"samples": 0, "requested_samples": samples, "early_stopped": False}
+    else:
+        raise last_error
+    metrics["provider"] = used_provider
+    metrics["self_consistency"] = {k: v for k, v in report.items() if k != "criteria"}
+    feedback_json = await arepair_feedback(feedback_json, used_provider, metrics)
+
+    await asyncio.to_thread(
+        store_feedback,
+        student_id,
+        assignment_id,
+        course_id,
+        feedback_json,
+        metrics,
+        cache_key,
+        qvec,
+    )
+    yield "done", feedback_json
+
+
+async def agenerate_self_consistent(**kwargs) -> str:
+    """Non-streaming :func:`astream_self_consistent`; returns the stored feedback JSON."""
+    feedback_json = None
+    async for kind, payload in astream_self_consistent(**kwargs):
+        if kind == "done":
+            feedback_json = payload
+    return feedback_json
+
+
+def generate_self_consistent(**kwargs) -> str:
+    return run_sync(agenerate_self_consistent(**kwargs))
@@ -1,12 +1,14 @@
-from fastapi import APIRouter, HTTPException
-from pydantic import BaseModel
-from typing import Dict, Any, List, Optional
+import asyncio
+from fastapi import APIRouter, Header, HTTPException
+from pydantic import BaseModel, Field
+from typing import Annotated, Dict, Any, List, Literal, Optional, Union
 from decimal import Decimal
 
 from rag_db import (
     update_student_submission_stats,
     update_subject_feedback,
     update_teacher_analytics,
+    apply_statistics_batch,
     get_student_statistics,
     get_teacher_analytics
 )
@@ -33,6 +35,27 @@ class TeacherAnalyticsPayload(BaseModel):
     worst_criteria: Dict[str, Any]
     grade_distribution: Dict[str, Any]
 
+# Batch events: the single-update payloads, tagged with their type
+class SubmissionStatsEvent(SubmissionStatsPayload):
+    type: Literal["submission"]
+    idempotency_key: Optional[str] = None
+
+class SubjectFeedbackEvent(SubjectFeedbackPayload):
+    type: Literal["feedback"]
+    idempotency_key: Optional[str] = None
+
+class TeacherAnalyticsEvent(TeacherAnalyticsPayload):
+    type: Literal["teacher_analytics"]
+    idempotency_key: Optional[str] = None
+
+StatisticsEvent = Annotated[
+    Union[SubmissionStatsEvent, SubjectFeedbackEvent, TeacherAnalyticsEvent],
+    Field(discriminator="type"),
+]
+
+class StatisticsBatchPayload(BaseModel):
+    events: List[StatisticsEvent]
+
 # Response Models
 class SubjectGradeResponse(BaseModel):
     course_name: str
@@ -65,25 +88,38 @@ class TeacherAnalyticsResponse(BaseModel):
 
 
 @router.post("/submissions", summary="Update student submission statistics")
-async def update_submission_stats(payload: SubmissionStatsPayload):
+async def update_submission_stats(
+    payload: SubmissionStatsPayload, idempotency_key: Optional[str] = Header(None)
+):
+    """A repeated ``Idempotency-Key`` is acknowledged without counting the submission again."""
     try:
-        update_student_submission_stats(
+        applied = await asyncio.to_thread(
+            update_student_submission_stats,
             student_id=payload.student_id,
             course_name=payload.course_name,
             grade=payload.grade,
+            idempotency_key=idempotency_key,
         )
+        if not applied:
+            return {"message": "Already applied.", "duplicate": True}
         return {"message": "Student submission statistics updated successfully."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @router.post("/feedback", summary="Update subject feedback for a student")
-async def update_feedback(payload: SubjectFeedbackPayload):
+async def update_feedback(
+    payload: SubjectFeedbackPayload, idempotency_key: Optional[str] = Header(None)
+):
     try:
-        update_subject_feedback(
+        applied = await asyncio.to_thread(
+            update_subject_feedback,
             student_id=payload.student_id,
             course_name=payload.course_name,
             feedback=payload.feedback,
+            idempotency_key=idempotency_key,
         )
+        if not applied:
+            return {"message": "Already applied.", "duplicate": True}
         return {"message": "Subject feedback updated successfully."}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -91,7 +127,8 @@ async def update_feedback(payload: SubjectFeedbackPayload):
 @router.post("/analytics/teacher", summary="Update teacher analytics")
 async def update_analytics(payload: TeacherAnalyticsPayload):
     try:
-        update_teacher_analytics(
+        await asyncio.to_thread(
+            update_teacher_analytics,
             teacher_id=payload.teacher_id,
             course_name=payload.course_name,
             worst_criteria=payload.worst_criteria,
@@ -101,6 +138,19 @@ async def update_analytics(payload: TeacherAnalyticsPayload):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@router.post("/batch", summary="Apply many statistics updates in one transaction")
+async def update_statistics_batch(payload: StatisticsBatchPayload):
+    """
+    Events of any type, applied together (all or nothing) with one set-based statement
+    per table. Events whose ``idempotency_key`` was applied before are skipped.
+    """
+    events = [event.model_dump() for event in payload.events]
+    try:
+        # Synchronous SQLAlchemy; keep it off the event loop.
+        return await asyncio.to_thread(apply_statistics_batch, events)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
 @router.get("/student/{student_id}", response_model=StudentStatisticsResponse)
 def get_student_stats(student_id: int):
     try:
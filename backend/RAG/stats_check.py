@@ -0,0 +1,155 @@
+"""Consistency checks for the running statistics sums.
+
+``student_statistics`` keeps ``grade_sum``/``graded_courses`` as running sums
+maintained by one upsert (see ``rag_db._SUBMISSION_STATS_UPSERT``).
+:func:`stats_mismatches` recomputes them from the stored ``subject_grades``
+rows; only non-NULL grades count, as in the upsert.
+
+Run from the command line (exit status 1 on any mismatch):
+
+    python rag_cli.py check-stats
+    python rag_cli.py check-stats --concurrency 200 --workers 16
+
+The first form checks every student read-only. The second first fires N
+parallel updates for a reserved test student (``CHECK_STUDENT_ID``) and checks
+that student, then removes it. ``tests/test_stats_check.py`` runs the same
+concurrency check against ``DATABASE_URL`` when a Postgres is reachable.
+"""
+
+import time
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from sqlalchemy import text as sqltext
+
+from rag_db import get_db_session, update_student_submission_stats
+
+# Negative, so it never collides with a real student.
+CHECK_STUDENT_ID = -4242
+CHECK_COURSE_PREFIX = "stats-check-"
+
+
+def stats_mismatches(session, student_id: Optional[int] = None) -> list:
+    """Students whose running sums differ from their stored subject grades.
+
+    Recomputes ``grade_sum``, ``graded_courses`` and ``average_grade_overall``
+    from ``subject_grades`` (every student, or just ``student_id``).
+    """
+    return session.execute(
+        sqltext(
+            """
+            SELECT s.student_id,
+                   s.grade_sum, COALESCE(g.grade_sum, 0) AS expected_grade_sum,
+                   s.graded_courses, COALESCE(g.graded_courses, 0) AS expected_graded_courses,
+                   s.average_grade_overall,
+                   round(g.grade_sum / NULLIF(g.graded_courses, 0), 2) AS expected_average
+            FROM   student_statistics s
+            LEFT   JOIN (
+                       SELECT student_id, COALESCE(sum(grade), 0) AS grade_sum,
+                              count(grade) AS graded_courses
+                       FROM   subject_grades
+                       GROUP  BY student_id
+                   ) g USING (student_id)
+            WHERE  (CAST(:sid AS integer) IS NULL OR s.student_id = :sid)
+              AND  (s.grade_sum <> COALESCE(g.grade_sum, 0)
+                    OR s.graded_courses <> COALESCE(g.graded_courses, 0)
+                    OR s.average_grade_overall
+                       IS DISTINCT FROM round(g.grade_sum / NULLIF(g.graded_courses, 0), 2))
+            ORDER  BY s.student_id
+            """
+        ),
+        {"sid": student_id},
+    ).fetchall()
+
+
+def print_mismatches(rows: list):
+    print(f"{'student':>10} {'grade_sum':>22} {'graded_courses':>16} {'average':>18}")
+    for r in rows:
+        print(
+            f"{r.student_id:>10} {f'{r.grade_sum}/{r.expected_grade_sum}':>22} "
+            f"{f'{r.graded_courses}/{r.expected_graded_courses}':>16} "
+            f"{f'{r.average_grade_overall}/{r.expected_average}':>18}"
+        )
+
+
+def check_stats() -> bool:
+    """Verify every student's running sums against the stored subject grades."""
+    session = get_db_session()
+    try:
+        students = session.execute(sqltext("SELECT count(*) FROM student_statistics")).scalar()
+        rows = stats_mismatches(session)
+    finally:
+        session.close()
+    print(f"{students} students checked, {len(rows)} mismatched (stored/recomputed)")
+    if rows:
+        print_mismatches(rows)
+    return not rows
+
+
+def cleanup_check_student(session):
+    # subject_grades rows go with it (ON DELETE CASCADE).
+    session.execute(
+        sqltext("DELETE FROM student_statistics WHERE student_id = :sid"),
+        {"sid": CHECK_STUDENT_ID},
+    )
+    session.commit()
+
+
+def run_concurrent_updates(updates: int, workers: int, rng: random.Random) -> list:
+    """Apply ``updates`` random grades for ``CHECK_STUDENT_ID`` from ``workers`` threads.
+
+    Returns the ``(course_name, grade)`` events sent.
+    """
+    courses = [f"{CHECK_COURSE_PREFIX}{i}" for i in range(max(1, updates // 10))]
+    events = [(rng.choice(courses), round(rng.uniform(0, 100), 2)) for _ in range(updates)]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(
+            pool.map(
+                lambda e: update_student_submission_stats(CHECK_STUDENT_ID, e[0], e[1]), events
+            )
+        )
+    return events
+
+
+def check_stats_concurrency(updates: int, workers: int, rng: random.Random) -> bool:
+    """Apply ``updates`` submissions for one student concurrently and verify the totals."""
+    session = get_db_session()
+    try:
+        cleanup_check_student(session)
+        start = time.perf_counter()
+        events = run_concurrent_updates(updates, workers, rng)
+        elapsed = time.perf_counter() - start
+
+        stats = session.execute(
+            sqltext(
+                """
+                SELECT total_submissions, graded_courses
+                FROM   student_statistics WHERE student_id = :sid
+                """
+            ),
+            {"sid": CHECK_STUDENT_ID},
+        ).one()
+        mismatches = stats_mismatches(session, CHECK_STUDENT_ID)
+    finally:
+        cleanup_check_student(session)
+        session.close()
+
+    # Counts the events themselves determine; the sums are checked against
+    # the grades that were stored last.
+    checks = {
+        "total_submissions": (stats.total_submissions, updates),
+        "graded_courses": (stats.graded_courses, len({course for course, _ in events})),
+    }
+    ok = not mismatches
+    print(f"{updates} updates from {workers} threads in {elapsed:.2f}s")
+    for name, (got, want) in checks.items():
+        status = "ok" if got == want else "MISMATCH"
+        ok = ok and got == want
+        print(f"{name:<22} {str(got):>12} {str(want):>12}  {status}")
+    if mismatches:
+        print("running sums differ from the stored subject grades (stored/recomputed):")
+        print_mismatches(mismatches)
+    else:
+        print("running sums match the stored subject grades")
+    return ok
@@ -0,0 +1,303 @@
+"""Teacher analytics kept up to date as feedback is stored.
+
+``llm.store_feedback`` calls :func:`record_feedback` in its own transaction
+for every ``Feedback`` row. If the app registered the course's teacher
+(``teacher_id``/``course_name`` on the grading request, see
+:func:`register_course`), the feedback's marks are added to:
+
+- running mark sums per (teacher, course, criterion) in ``teacher_criterion_marks``;
+- a histogram of overall marks (out of 20, ``GRADE_BUCKET_WIDTH`` wide buckets)
+  in ``teacher_grade_buckets``.
+
+Only a student's latest feedback per assignment counts: a re-grade or
+resubmission takes the earlier feedback's marks back out
+(``teacher_analytics_feedback``). The ``teacher_analytics`` row is then rebuilt
+from those few rows, so ``/statistics/teacher/{id}`` reads current analytics
+without recomputing them from stored feedback. When a feedback moves to another
+teacher or course name, both courses are locked in a fixed order.
+"""
+
+import os
+import json
+
+from sqlalchemy import text as sqltext
+
+from rag_db import CourseTeacher, get_sessionmaker
+import metrics as service_metrics
+
+# Fixed, so the stored bucket numbers keep their meaning.
+GRADE_BUCKET_WIDTH = 2
+GRADE_BUCKETS = 20 // GRADE_BUCKET_WIDTH
+TEACHER_ANALYTICS_WORST_CRITERIA = int(os.getenv("TEACHER_ANALYTICS_WORST_CRITERIA", "3"))
+
+
+def register_course(course_id: str, teacher_id: int, course_name: str):
+    """Record (or update) the teacher and name of ``course_id``."""
+    Session = get_sessionmaker()
+    with Session.begin() as session:
+        session.execute(
+            sqltext(
+                """
+                INSERT INTO course_teachers (course_id, teacher_id, course_name, updated_at)
+                VALUES (:course_id, :teacher_id, :course_name, now())
+                ON CONFLICT (course_id) DO UPDATE
+                SET    teacher_id = EXCLUDED.teacher_id,
+                       course_name = EXCLUDED.course_name,
+                       updated_at = now()
+                WHERE  course_teachers.teacher_id <> EXCLUDED.teacher_id
+                   OR  course_teachers.course_name <> EXCLUDED.course_name
+                """
+            ),
+            {"course_id": course_id, "teacher_id": teacher_id, "course_name": course_name},
+        )
+
+
+def _number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def feedback_marks(feedback: dict) -> tuple[dict, int | None]:
+    """``({criterion: [mark, max_mark]}, grade_bucket)`` of a parsed feedback.
+
+    Criteria without a numeric mark and a positive ``maxMark`` are left out;
+    the bucket is ``None`` without a usable overall mark.
+    """
+    criteria = feedback.get("criteria")
+    if isinstance(criteria, dict):
+        items = list(criteria.items())
+    elif isinstance(criteria, list):
+        items = [
+            (c.get("criterion", str(i)), c) for i, c in enumerate(criteria) if isinstance(c, dict)
+        ]
+    else:
+        items = []
+    marks = {}
+    for name, c in items:
+        if isinstance(c, dict) and _number(c.get("mark")) and _number(c.get("maxMark")):
+            if c["maxMark"] > 0:
+                marks[str(name)] = [c["mark"], c["maxMark"]]
+
+    bucket = None
+    overall = feedback.get("overall_evaluation")
+    if isinstance(overall, dict):
+        total = overall.get("total_mark", overall.get("mark_out_of_20"))
+        max_mark = overall.get("maxMark") if "total_mark" in overall else 20
+        if _number(total) and _number(max_mark) and max_mark > 0:
+            scaled = min(max(total * 20.0 / max_mark, 0.0), 20.0)
+            bucket = min(int(scaled // GRADE_BUCKET_WIDTH), GRADE_BUCKETS - 1)
+    return marks, bucket
+
+
+def _lock_course(session, teacher_id: int, course_name: str):
+    # Feedback for the same course applies one transaction at a time, so each
+    # rebuild below sees every earlier update.
+    session.execute(
+        sqltext(
+            """
+            INSERT INTO teacher_analytics (teacher_id, course_name, last_updated)
+            VALUES (:teacher_id, :course_name, now())
+            ON CONFLICT (teacher_id, course_name) DO UPDATE SET last_updated = now()
+            """
+        ),
+        {"teacher_id": teacher_id, "course_name": course_name},
+    )
+
+
+def _add(session, teacher_id: int, course_name: str, marks: dict, bucket: int | None, sign: int):
+    if marks:
+        session.execute(
+            sqltext(
+                """
+                INSERT INTO teacher_criterion_marks
+                       (teacher_id, course_name, criterion, mark_sum, max_mark_sum, marks)
+                SELECT :teacher_id, :course_name, c.name, :sign * c.mark, :sign * c.max_mark, :sign
+                FROM   unnest(CAST(:names AS text[]), CAST(:marks AS numeric[]),
+                              CAST(:max_marks AS numeric[])) AS c(name, mark, max_mark)
+                ON CONFLICT (teacher_id, course_name, criterion) DO UPDATE
+                SET    mark_sum = teacher_criterion_marks.mark_sum + EXCLUDED.mark_sum,
+                       max_mark_sum = teacher_criterion_marks.max_mark_sum + EXCLUDED.max_mark_sum,
+                       marks = teacher_criterion_marks.marks + EXCLUDED.marks
+                """
+            ),
+            {
+                "teacher_id": teacher_id,
+                "course_name": course_name,
+                "sign": sign,
+                "names": list(marks),
+                "marks": [m for m, _ in marks.values()],
+                "max_marks": [x for _, x in marks.values()],
+            },
+        )
+    if bucket is not None:
+        session.execute(
+            sqltext(
+                """
+                INSERT INTO teacher_grade_buckets (teacher_id, course_name, bucket, students)
+                VALUES (:teacher_id, :course_name, :bucket, :sign)
+                ON CONFLICT (teacher_id, course_name, bucket) DO UPDATE
+                SET    students = teacher_grade_buckets.students + EXCLUDED.students
+                """
+            ),
+            {"teacher_id": teacher_id, "course_name": course_name, "bucket": bucket, "sign": sign},
+        )
+
+
+def _bucket_label(bucket: int) -> str:
+    return f"{bucket * GRADE_BUCKET_WIDTH}-{(bucket + 1) * GRADE_BUCKET_WIDTH}"
+
+
+def _rebuild(session, teacher_id: int, course_name: str):
+    """Rewrite the course's ``teacher_analytics`` row from its sums and histogram."""
+    params = {"teacher_id": teacher_id, "course_name": course_name}
+    criteria = session.execute(
+        sqltext(
+            """
+            SELECT criterion, mark_sum, max_mark_sum, marks
+            FROM   teacher_criterion_marks
+            WHERE  teacher_id = :teacher_id AND course_name = :course_name
+              AND  marks > 0 AND max_mark_sum > 0
+            ORDER  BY mark_sum / max_mark_sum, criterion
+            LIMIT  :limit
+            """
+        ),
+        {**params, "limit": TEACHER_ANALYTICS_WORST_CRITERIA},
+    ).fetchall()
+    worst = {
+        row.criterion: {
+            "rank": rank,
+            "average_mark": round(float(row.mark_sum) / row.marks, 2),
+            "average_max_mark": round(float(row.max_mark_sum) / row.marks, 2),
+            "average_percent": round(100 * float(row.mark_sum / row.max_mark_sum), 1),
+            "marked": row.marks,
+        }
+        for rank, row in enumerate(criteria, 1)
+    }
+    students = dict(
+        session.execute(
+            sqltext(
+                """
+                SELECT bucket, students FROM teacher_grade_buckets
+                WHERE  teacher_id = :teacher_id AND course_name = :course_name
+                """
+            ),
+            params,
+        ).fetchall()
+    )
+    distribution = {_bucket_label(b): max(students.get(b, 0), 0) for b in range(GRADE_BUCKETS)}
+    session.execute(
+        sqltext(
+            """
+            UPDATE teacher_analytics
+            SET    worst_marked_criteria = CAST(:worst AS jsonb),
+                   student_grade_distribution = CAST(:distribution AS jsonb),
+                   last_updated = now()
+            WHERE  teacher_id = :teacher_id AND course_name = :course_name
+            """
+        ),
+        {**params, "worst": json.dumps(worst), "distribution": json.dumps(distribution)},
+    )
+
+
+def record_feedback(
+    session, feedback_id: int, student_id: str, assignment_id: str, course_id: str, feedback: dict
+) -> bool:
+    """Count a stored feedback towards its course's teacher analytics, in the caller's transaction.
+
+    A feedback without usable marks still replaces the student's earlier
+    feedback for the assignment, whose marks are taken back out. Returns
+    ``False`` when the course has no registered teacher or the feedback has no
+    usable marks.
+    """
+    course = session.get(CourseTeacher, course_id)
+    if course is None:
+        return False
+    marks, bucket = feedback_marks(feedback)
+    counted = bool(marks) or bucket is not None
+    teacher_id, course_name = course.teacher_id, course.course_name
+    key = {"course_id": course_id, "student_id": student_id, "assignment_id": assignment_id}
+
+    # One feedback per student and assignment at a time, so the contribution
+    # read here is the one the upsert below replaces.
+    session.execute(
+        sqltext(
+            "SELECT pg_advisory_xact_lock("
+            "hashtext(:course_id || '/' || :student_id || '/' || :assignment_id))"
+        ),
+        key,
+    )
+    previous = session.execute(
+        sqltext(
+            """
+            SELECT teacher_id, course_name, criterion_marks, grade_bucket
+            FROM   teacher_analytics_feedback
+            WHERE  course_id = :course_id AND student_id = :student_id
+              AND  assignment_id = :assignment_id
+            """
+        ),
+        key,
+    ).one_or_none()
+    if not counted and previous is None:
+        return False
+    courses = {(teacher_id, course_name)} if counted else set()
+    if previous is not None:
+        courses.add((previous.teacher_id, previous.course_name))
+    # Always in the same order, so two moves between the same courses can't deadlock.
+    for course_key in sorted(courses):
+        _lock_course(session, *course_key)
+
+    if not counted:
+        session.execute(
+            sqltext(
+                """
+                DELETE FROM teacher_analytics_feedback
+                WHERE  course_id = :course_id AND student_id = :student_id
+                  AND  assignment_id = :assignment_id
+                """
+            ),
+            key,
+        )
+    else:
+        session.execute(
+            sqltext(
+                """
+                INSERT INTO teacher_analytics_feedback
+                       (course_id, student_id, assignment_id, feedback_id, teacher_id, course_name,
+                        criterion_marks, grade_bucket)
+                VALUES (:course_id, :student_id, :assignment_id, :feedback_id, :teacher_id,
+                        :course_name, CAST(:marks AS jsonb), :bucket)
+                ON CONFLICT (course_id, student_id, assignment_id) DO UPDATE
+                SET    feedback_id = EXCLUDED.feedback_id,
+                       teacher_id = EXCLUDED.teacher_id,
+                       course_name = EXCLUDED.course_name,
+                       criterion_marks = EXCLUDED.criterion_marks,
+                       grade_bucket = EXCLUDED.grade_bucket
+                """
+            ),
+            {
+                **key,
+                "feedback_id": feedback_id,
+                "teacher_id": teacher_id,
+                "course_name": course_name,
+                "marks": json.dumps(marks),
+                "bucket": bucket,
+            },
+        )
+
+    if previous is not None:
+        _add(
+            session,
+            previous.teacher_id,
+            previous.course_name,
+            previous.criterion_marks or {},
+            previous.grade_bucket,
+            -1,
+        )
+        service_metrics.incr("teacher_analytics.replaced")
+    if counted:
+        _add(session, teacher_id, course_name, marks, bucket, 1)
+    for course_key in sorted(courses):
+        _rebuild(session, *course_key)
+    if not counted:
+        return False
+    service_metrics.incr("teacher_analytics.recorded")
+    return True
@@ -0,0 +1,64 @@
+"""Concurrent statistics upserts keep the running sums exact.
+
+Needs a Postgres at ``DATABASE_URL`` (e.g. the docker-compose ``ragdb``);
+skipped when none is reachable:
+
+    cd backend/RAG && python -m pytest tests
+"""
+
+import os
+import sys
+import random
+
+import pytest
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+rag_db = pytest.importorskip("rag_db")
+stats_check = pytest.importorskip("stats_check")
+
+
+@pytest.fixture(scope="module")
+def session():
+    try:
+        engine = rag_db.get_engine()
+        with engine.connect():
+            pass
+    except Exception as e:
+        pytest.skip(f"No Postgres at DATABASE_URL: {e}")
+    rag_db.init_schema(engine)
+    session = rag_db.get_db_session()
+    yield session
+    stats_check.cleanup_check_student(session)
+    session.close()
+
+
+def _stats(session):
+    return session.execute(
+        text(
+            "SELECT total_submissions, graded_courses FROM student_statistics "
+            "WHERE student_id = :sid"
+        ),
+        {"sid": stats_check.CHECK_STUDENT_ID},
+    ).one()
+
+
+def test_concurrent_updates_keep_running_sums(session):
+    stats_check.cleanup_check_student(session)
+    updates = 200
+    events = stats_check.run_concurrent_updates(updates, 16, random.Random(7))
+
+    assert stats_check.stats_mismatches(session, stats_check.CHECK_STUDENT_ID) == []
+    stats = _stats(session)
+    assert stats.total_submissions == updates
+    assert stats.graded_courses == len({course for course, _ in events})
+
+
+def test_null_grades_are_not_counted(session):
+    stats_check.cleanup_check_student(session)
+    course = f"{stats_check.CHECK_COURSE_PREFIX}null"
+    for grade in (None, 50, None, None, 70):
+        rag_db.update_student_submission_stats(stats_check.CHECK_STUDENT_ID, course, grade)
+        assert stats_check.stats_mismatches(session, stats_check.CHECK_STUDENT_ID) == []
+    assert _stats(session).graded_courses == 1
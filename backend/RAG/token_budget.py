@@ -0,0 +1,116 @@
+"""Fit the grading prompt into a per-model token budget.
+
+The budget is shared between the system prompt, rubric, exemplars and essay.
+When the prompt is too large, context is dropped in order of value:
+
+1. exemplar chunks, lowest ranked first (they only illustrate the standard),
+2. rubric chunks, last first (the rubric is what the essay is marked against),
+3. the tail of the essay, as a last resort.
+
+The system prompt is never trimmed.
+"""
+
+import os
+import logging
+
+try:
+    import tiktoken
+except ImportError:  # counts fall back to a characters-per-token estimate
+    tiktoken = None
+
+# Prompt tokens per model, leaving room for the feedback JSON (and, for
+# deepseek-reasoner, its reasoning tokens) within the context window.
+MODEL_PROMPT_BUDGETS = {
+    "gpt-4.1": 100_000,
+    "gemini-2.5-pro": 200_000,
+    "Qwen3-235B-A22B": 24_000,
+    "deepseek-reasoner": 48_000,
+}
+DEFAULT_PROMPT_BUDGET = 24_000
+# Cost/latency ceiling applied on top of the model limit.
+PROMPT_TOKEN_CAP = int(os.getenv("RAG_PROMPT_TOKEN_CAP", "32000"))
+
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD = 4  # role and separators, per chat message
+TRUNCATION_MARK = "\n\n[... essay truncated to fit the grading prompt ...]"
+
+_encodings = {}
+
+
+def _encoding(model: str):
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            try:
+                enc = tiktoken.encoding_for_model(model)
+            except KeyError:
+                # Not an OpenAI model: o200k is a close enough proxy for budgeting.
+                enc = tiktoken.get_encoding("o200k_base")
+        except Exception as e:
+            # tiktoken downloads encodings on first use; offline hosts estimate.
+            logging.warning("No tokenizer for %s (%s); estimating token counts.", model, e)
+            enc = None
+        _encodings[model] = enc
+    return _encodings[model]
+
+
+def count_tokens(text: str, model: str) -> int:
+    enc = _encoding(model)
+    if enc is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> str:
+    if max_tokens <= 0:
+        return ""
+    enc = _encoding(model)
+    if enc is None:
+        return text[: max_tokens * CHARS_PER_TOKEN]
+    tokens = enc.encode(text, disallowed_special=())
+    return enc.decode(tokens[:max_tokens])
+
+
+def prompt_budget(model: str) -> int:
+    return min(MODEL_PROMPT_BUDGETS.get(model, DEFAULT_PROMPT_BUDGET), PROMPT_TOKEN_CAP)
+
+
+def fit_prompt(system_prompt, rubric_ctx, exemplar_ctx, essay_text, model, budget=None):
+    """Return ``(rubric_ctx, exemplar_ctx, essay_text, report)`` within ``budget`` tokens.
+
+    ``exemplar_ctx`` must be in rank order (best first). ``report`` records the
+    budget, the resulting size and what was dropped; it is stored with the
+    feedback.
+    """
+    budget = prompt_budget(model) if budget is None else budget
+    fixed = count_tokens(system_prompt, model) + 2 * MESSAGE_OVERHEAD + 32  # headings
+    rubric_tokens = [count_tokens(c, model) for c in rubric_ctx]
+    exemplar_tokens = [count_tokens(c, model) for c in exemplar_ctx]
+    essay_tokens = count_tokens(essay_text, model)
+
+    rubric_ctx, exemplar_ctx = list(rubric_ctx), list(exemplar_ctx)
+    total = fixed + sum(rubric_tokens) + sum(exemplar_tokens) + essay_tokens
+    report = {"budget": budget, "requested_tokens": total}
+
+    dropped_exemplars = dropped_rubric = 0
+    while total > budget and exemplar_ctx:
+        exemplar_ctx.pop()
+        total -= exemplar_tokens.pop()
+        dropped_exemplars += 1
+    while total > budget and rubric_ctx:
+        rubric_ctx.pop()
+        total -= rubric_tokens.pop()
+        dropped_rubric += 1
+    if total > budget:
+        keep = essay_tokens - (total - budget) - count_tokens(TRUNCATION_MARK, model)
+        essay_text = truncate_to_tokens(essay_text, keep, model) + TRUNCATION_MARK
+        report["essay_truncated_tokens"] = essay_tokens - max(keep, 0)
+        total = budget
+
+    report["prompt_tokens"] = total
+    if dropped_exemplars:
+        report["dropped_exemplars"] = dropped_exemplars
+    if dropped_rubric:
+        report["dropped_rubric"] = dropped_rubric
+    return rubric_ctx, exemplar_ctx, essay_text, report
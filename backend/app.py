@@ -1,5 +1,6 @@
 from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 from sqlalchemy import text
@@ -7,11 +8,15 @@ from passlib.context import CryptContext
 from jose import jwt, JWTError
 from datetime import datetime, timedelta
 import os
+import asyncio
 import httpx
 import json
 from typing import Optional, List
 import uvicorn
 import database
+import regrade
+import submissions
+import stats_outbox
 import random
 import string
 import tempfile
@@ -30,6 +35,7 @@ from database import (
     Assignment,
     Enrollment,
     SubmittedAssignment,
+    RegradeJob,
     AdminCreate,
     AdminResponse,
     TeacherCreate,
@@ -54,8 +60,10 @@ from database import (
     CourseStudentResponse,
     CourseDetailResponse,
     SubmissionResponse,
+    RegradeJobResponse,
     Token,
     create_cross_table_email_uniqueness_triggers,
+    apply_schema_upgrades,
 )
 
 # Security setup
@@ -1282,13 +1290,37 @@ def get_student_assignments_due_soon(
     return result
 
 
-@app.post("/assignments/{assignment_id}/submit", response_model=SubmissionResponse)
+def _store_graded_submission(
+    db: Session, student_id: int, assignment_id: int, feedback_json, file_bytes, filename
+):
+    new_submission = SubmittedAssignment(
+        submitted_assignment_student_id=student_id,
+        submitted_assignment_assignment_id=assignment_id,
+        submission_file=file_bytes,
+        submission_filename=filename,
+    )
+    submissions.apply_feedback(db, new_submission, feedback_json)
+    db.commit()
+    db.refresh(new_submission)
+    return new_submission
+
+
+@app.post(
+    "/assignments/{assignment_id}/submit",
+    response_model=SubmissionResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+)
 async def submit_assignment(
     assignment_id: int,
     file: UploadFile = File(...),
     db: Session = Depends(get_db),
     current_user: Student = Depends(get_current_user),
 ):
+    """
+    Store the upload and grade it in the background. The submission is returned as
+    ``processing``; poll ``GET /submissions/{submission_id}`` until it is ``graded`` or
+    ``failed``.
+    """
     if not isinstance(current_user, Student):
         raise HTTPException(status_code=403, detail="Only students can submit assignments")
 
@@ -1296,83 +1328,215 @@ async def submit_assignment(
     if not assignment:
         raise HTTPException(status_code=404, detail="Assignment not found")
 
-    # 1. Call RAG API to get feedback
-    rag_api_url = os.getenv("RAG_API_URL", "http://localhost:8082")
-    files = {"file": (file.filename, await file.read(), file.content_type)}
-    data = {
-        "student_id": str(current_user.student_id),
-        "assignment_id": str(assignment_id),
-        "course_id": str(assignment.assignment_course_id),
-    }
+    file_bytes = await file.read()
+    new_submission = submissions.create_submission(
+        db, current_user.student_id, assignment_id, file_bytes, file.filename
+    )
+    submissions.start_grading(
+        new_submission.submission_id, os.getenv("RAG_API_URL", "http://localhost:8082")
+    )
+    return new_submission
 
-    # Pass through embedder/provider preferences to RAG API (defaults set in env)
-    rag_embedder = os.getenv("RAG_EMBEDDER", "gitee")
-    rag_provider = os.getenv("RAG_PROVIDER", "deepseek")
-    data.update({"embedder": rag_embedder, "provider": rag_provider})
 
-    feedback_json = {}
-    try:
-        async with httpx.AsyncClient(timeout=300.0) as client:
-            response = await client.post(f"{rag_api_url}/get-feedback/", files=files, data=data)
-            response.raise_for_status()
-            feedback_data = response.json()
-            feedback_json = (
-                json.loads(feedback_data) if isinstance(feedback_data, str) else feedback_data
+@app.get("/submissions/{submission_id}", response_model=SubmissionResponse)
+def get_submission(
+    submission_id: int, db: Session = Depends(get_db), current_user=Depends(get_current_user)
+):
+    submission = (
+        db.query(SubmittedAssignment)
+        .filter(SubmittedAssignment.submission_id == submission_id)
+        .first()
+    )
+    if not submission:
+        raise HTTPException(status_code=404, detail="Submission not found")
+    if isinstance(current_user, Student):
+        if submission.submitted_assignment_student_id != current_user.student_id:
+            raise HTTPException(status_code=403, detail="You can only view your own submissions")
+    elif isinstance(current_user, Teacher):
+        course = (
+            db.query(Course)
+            .join(Assignment, Assignment.assignment_course_id == Course.course_id)
+            .filter(Assignment.assignment_id == submission.submitted_assignment_assignment_id)
+            .first()
+        )
+        if not course or course.course_teacher_id != current_user.teacher_id:
+            raise HTTPException(
+                status_code=403, detail="You can only view submissions of your own courses"
             )
-    except httpx.RequestError as e:
-        raise HTTPException(status_code=500, detail=f"Error calling RAG API: {e}")
-    except json.JSONDecodeError:
-        raise HTTPException(status_code=500, detail="Failed to parse feedback from RAG API")
+    else:
+        raise HTTPException(status_code=403, detail="Not authorized to view this submission")
+    return submission
 
-    feedback_text = json.dumps(feedback_json)
 
-    if "overall_evaluation" in feedback_json:
-        overall_mark = feedback_json.get("overall_evaluation", {}).get("mark_out_of_20", 0)
-    else:
-        # Legacy fallback: use average of provided grades or 0.
-        grades_fallback = feedback_json.get("grades", [])
-        overall_mark = sum(grades_fallback) / len(grades_fallback) if grades_fallback else 0
+@app.post("/assignments/{assignment_id}/submit/stream", summary="Submit and stream feedback (SSE)")
+async def submit_assignment_stream(
+    assignment_id: int,
+    file: UploadFile = File(...),
+    db: Session = Depends(get_db),
+    current_user: Student = Depends(get_current_user),
+):
+    """
+    Streaming variant of ``/assignments/{assignment_id}/submit``.
 
-    grade_list = [overall_mark]
+    Relays the RAG API's Server-Sent Events (``status``, ``token``,
+    ``criterion``, ``result``, ``error``) as they arrive. When the ``result``
+    event comes through, the graded submission is stored and a final
+    ``submission`` event carries the saved row.
+    """
+    if not isinstance(current_user, Student):
+        raise HTTPException(status_code=403, detail="Only students can submit assignments")
 
-    new_submission = SubmittedAssignment(
-        submitted_assignment_student_id=current_user.student_id,
-        submitted_assignment_assignment_id=assignment_id,
-        submission_status="graded",
-        ai_feedback=feedback_text,
-        ai_grade=grade_list,
-        graded_at=datetime.utcnow(),
+    assignment = db.query(Assignment).filter(Assignment.assignment_id == assignment_id).first()
+    if not assignment:
+        raise HTTPException(status_code=404, detail="Assignment not found")
+    course = db.get(Course, assignment.assignment_course_id)
+
+    rag_api_url = os.getenv("RAG_API_URL", "http://localhost:8082")
+    file_bytes = await file.read()
+    files, data = submissions.rag_feedback_request(
+        current_user.student_id, assignment_id, course, file.filename, file_bytes, file.content_type
     )
-    db.add(new_submission)
-    db.commit()
-    db.refresh(new_submission)
+    student_id = current_user.student_id
+    filename = file.filename
 
-    # 3. Trigger statistics update
-    try:
-        course = (
-            db.query(Course).filter(Course.course_id == assignment.assignment_course_id).first()
+    def _store_streamed_result(feedback_json):
+        # The request-scoped session is closed once the response starts streaming;
+        # runs in a worker thread so the commit doesn't block the event loop.
+        stream_db = database.SessionLocal()
+        try:
+            submission = _store_graded_submission(
+                stream_db, student_id, assignment_id, feedback_json, file_bytes, filename
+            )
+            body = SubmissionResponse.model_validate(submission).model_dump(mode="json")
+            return f"event: submission\ndata: {json.dumps(body)}\n\n"
+        finally:
+            stream_db.close()
+
+    async def relay():
+        try:
+            # No read timeout: tokens can pause while the model reasons.
+            timeout = httpx.Timeout(300.0, read=None)
+            async with httpx.AsyncClient(timeout=timeout) as client:
+                async with client.stream(
+                    "POST", f"{rag_api_url}/get-feedback/stream/", files=files, data=data
+                ) as response:
+                    response.raise_for_status()
+                    event, data_lines = None, []
+                    async for line in response.aiter_lines():
+                        if line.startswith("event:"):
+                            event = line[len("event:") :].strip()
+                        elif line.startswith("data:"):
+                            data_lines.append(line[len("data:") :].strip())
+                        elif line == "" and (event or data_lines):
+                            payload = "\n".join(data_lines)
+                            yield f"event: {event or 'message'}\ndata: {payload}\n\n"
+                            if event == "result":
+                                yield await asyncio.to_thread(
+                                    _store_streamed_result, json.loads(payload)
+                                )
+                            event, data_lines = None, []
+        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            error = {"status_code": 500, "detail": f"Error calling RAG API: {e}"}
+            yield f"event: error\ndata: {json.dumps(error)}\n\n"
+
+    return StreamingResponse(
+        relay(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _teacher_owned_assignment(db: Session, assignment_id: int, current_user):
+    if not isinstance(current_user, Teacher):
+        raise HTTPException(status_code=403, detail="Only teachers can re-grade assignments")
+    assignment = db.query(Assignment).filter(Assignment.assignment_id == assignment_id).first()
+    if not assignment:
+        raise HTTPException(status_code=404, detail="Assignment not found")
+    course = db.query(Course).filter(Course.course_id == assignment.assignment_course_id).first()
+    if not course or course.course_teacher_id != current_user.teacher_id:
+        raise HTTPException(
+            status_code=403, detail="You can only re-grade assignments of your own courses"
         )
-        # Assume average grade for now
-        avg_grade = sum(grade_list) / len(grade_list) if grade_list else 0
+    return assignment
 
-        stats_payload = {
-            "student_id": current_user.student_id,
-            "course_name": course.course_name if course else "Unknown Course",
-            "grade": avg_grade,
-        }
-        feedback_payload = {
-            "student_id": current_user.student_id,
-            "course_name": course.course_name if course else "Unknown Course",
-            "feedback": feedback_text,
-        }
-        async with httpx.AsyncClient() as client:
-            await client.post(f"{rag_api_url}/statistics/submissions", json=stats_payload)
-            await client.post(f"{rag_api_url}/statistics/feedback", json=feedback_payload)
-    except Exception as e:
-        # Log this error but don't fail the request
-        print(f"Failed to update statistics: {e}")
 
-    return new_submission
+@app.post(
+    "/assignments/{assignment_id}/regrade",
+    response_model=RegradeJobResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def regrade_assignment(
+    assignment_id: int,
+    concurrency: Optional[int] = None,
+    db: Session = Depends(get_db),
+    current_user=Depends(get_current_user),
+):
+    """
+    Re-grade every stored submission of an assignment (e.g. after a rubric fix).
+    Runs in the background; poll ``GET /regrade-jobs/{id}`` for progress. Submissions keep
+    their current feedback until the whole job has finished.
+    """
+    _teacher_owned_assignment(db, assignment_id, current_user)
+    active = (
+        db.query(RegradeJob)
+        .filter(
+            RegradeJob.regrade_job_assignment_id == assignment_id,
+            RegradeJob.status.in_(("pending", "running")),
+        )
+        .first()
+    )
+    if active:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Regrade job {active.regrade_job_id} is already running for this assignment",
+        )
+
+    job = regrade.create_regrade_job(
+        db, assignment_id, current_user.teacher_id, concurrency or regrade.REGRADE_CONCURRENCY
+    )
+    regrade.start_regrade_job(job.regrade_job_id, os.getenv("RAG_API_URL", "http://localhost:8082"))
+    return job
+
+
+def _teacher_owned_regrade_job(db: Session, regrade_job_id: int, current_user):
+    job = db.query(RegradeJob).filter(RegradeJob.regrade_job_id == regrade_job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Regrade job not found")
+    _teacher_owned_assignment(db, job.regrade_job_assignment_id, current_user)
+    return job
+
+
+@app.get("/regrade-jobs/{regrade_job_id}", response_model=RegradeJobResponse)
+def get_regrade_job(
+    regrade_job_id: int, db: Session = Depends(get_db), current_user=Depends(get_current_user)
+):
+    return _teacher_owned_regrade_job(db, regrade_job_id, current_user)
+
+
+@app.post(
+    "/regrade-jobs/{regrade_job_id}/resume",
+    response_model=RegradeJobResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+async def resume_regrade_job(
+    regrade_job_id: int, db: Session = Depends(get_db), current_user=Depends(get_current_user)
+):
+    job = _teacher_owned_regrade_job(db, regrade_job_id, current_user)
+    if job.status not in ("pending", "running"):
+        raise HTTPException(status_code=409, detail=f"Regrade job is already {job.status}")
+    regrade.start_regrade_job(regrade_job_id, os.getenv("RAG_API_URL", "http://localhost:8082"))
+    return job
+
+
+@app.on_event("startup")
+async def startup():
+    apply_schema_upgrades(database.engine)
+    if os.getenv("REGRADE_RESUME_ON_STARTUP", "1") == "1":
+        regrade.resume_regrade_jobs(os.getenv("RAG_API_URL", "http://localhost:8082"))
+    if os.getenv("SUBMISSION_RESUME_ON_STARTUP", "1") == "1":
+        submissions.start_resume_sweeper(os.getenv("RAG_API_URL", "http://localhost:8082"))
+    if os.getenv("STATS_OUTBOX_RELAY", "1") == "1":
+        stats_outbox.start_relay(os.getenv("RAG_API_URL", "http://localhost:8082"))
 
 
 if __name__ == "__main__":
@@ -10,11 +10,13 @@ from sqlalchemy import (
     DECIMAL,
     Text,
     ForeignKeyConstraint,
+    LargeBinary,
+    UniqueConstraint,
     text,
 )
-from sqlalchemy.dialects.postgresql import ARRAY
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.orm import sessionmaker, Session, relationship, deferred
 from pydantic import BaseModel, EmailStr
 from datetime import datetime
 import os
@@ -129,11 +131,85 @@ class SubmittedAssignment(Base):
     submitted_assignment_assignment_id = Column(
         Integer, ForeignKey("assignments.assignment_id"), nullable=False
     )
+    # submitted -> processing -> graded | failed
     submission_status = Column(String(50), default="submitted")
+    submission_error = Column(Text)
     ai_feedback = Column(Text)
     ai_grade = Column(ARRAY(DECIMAL(5, 2)))
     uploaded_at = Column(DateTime, default=datetime.utcnow)
     graded_at = Column(DateTime)
+    # Kept so the submission can be re-graded after the rubric changes
+    submission_file = deferred(Column(LargeBinary))
+    submission_filename = Column(String(255))
+    # While processing: the worker grading it holds it until then (see submissions).
+    processing_lease_expires_at = Column(DateTime)
+
+
+class RegradeJob(Base):
+    __tablename__ = "regrade_jobs"
+    regrade_job_id = Column(Integer, primary_key=True, autoincrement=True)
+    regrade_job_assignment_id = Column(
+        Integer, ForeignKey("assignments.assignment_id"), nullable=False
+    )
+    requested_by_teacher_id = Column(Integer, ForeignKey("teachers.teacher_id"), nullable=False)
+    # pending -> running -> completed | failed
+    status = Column(String(50), nullable=False, default="pending")
+    concurrency = Column(Integer, nullable=False)
+    total_items = Column(Integer, nullable=False, default=0)
+    completed_items = Column(Integer, nullable=False, default=0)
+    failed_items = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+    # App worker running the job, which holds it until lease_expires_at.
+    runner = Column(String(255))
+    lease_expires_at = Column(DateTime)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+
+
+class RegradeJobItem(Base):
+    """One submission of a re-grade job; its row is the job's checkpoint."""
+
+    __tablename__ = "regrade_job_items"
+    regrade_job_item_id = Column(Integer, primary_key=True, autoincrement=True)
+    regrade_job_id = Column(
+        Integer, ForeignKey("regrade_jobs.regrade_job_id", ondelete="CASCADE"), nullable=False
+    )
+    submission_id = Column(
+        Integer, ForeignKey("submitted_assignments.submission_id"), nullable=False
+    )
+    # pending -> done | failed
+    status = Column(String(50), nullable=False, default="pending")
+    attempts = Column(Integer, nullable=False, default=0)
+    ai_feedback = Column(Text)
+    ai_grade = Column(ARRAY(DECIMAL(5, 2)))
+    error = Column(Text)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (UniqueConstraint("regrade_job_id", "submission_id"),)
+
+
+class StatsOutbox(Base):
+    """
+    Statistics updates for the RAG service, written in the same transaction as the graded
+    submission and delivered by ``stats_outbox``. ``idempotency_key`` lets the RAG service
+    drop redeliveries.
+    """
+
+    __tablename__ = "stats_outbox"
+    stats_outbox_id = Column(Integer, primary_key=True, autoincrement=True)
+    idempotency_key = Column(String(255), nullable=False, unique=True)
+    # submission | feedback
+    kind = Column(String(50), nullable=False)
+    payload = Column(JSONB, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    delivered_at = Column(DateTime)
+    # Set once the RAG service rejected the row STATS_OUTBOX_MAX_ATTEMPTS times;
+    # it is no longer retried.
+    failed_at = Column(DateTime)
+    last_error = Column(Text)
+    created_at = Column(DateTime, default=datetime.utcnow)
 
 
 # Pydantic schemas
@@ -375,6 +451,7 @@ class SubmissionResponse(BaseModel):
     submitted_assignment_student_id: int
     submitted_assignment_assignment_id: int
     submission_status: str
+    submission_error: Optional[str] = None
     ai_feedback: Optional[str] = None
     ai_grade: Optional[List[float]] = None
     uploaded_at: datetime
@@ -384,6 +461,24 @@ class SubmissionResponse(BaseModel):
         from_attributes = True
 
 
+class RegradeJobResponse(BaseModel):
+    regrade_job_id: int
+    regrade_job_assignment_id: int
+    requested_by_teacher_id: int
+    status: str
+    concurrency: int
+    total_items: int
+    completed_items: int
+    failed_items: int
+    error: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -497,3 +592,55 @@ def create_cross_table_email_uniqueness_triggers(engine):
                 BEFORE INSERT OR UPDATE ON students 
                 FOR EACH ROW EXECUTE FUNCTION check_student_email_uniqueness();
         """))
+
+
+SUBMISSION_STATUSES = ("submitted", "processing", "graded", "failed")
+
+
+def apply_schema_upgrades(engine):
+    """
+    Bring an existing database up to the current models.
+    create_all only adds missing tables, so columns added to existing tables are altered in here.
+    Every statement is idempotent; this runs on each startup.
+    """
+    Base.metadata.create_all(
+        bind=engine,
+        tables=[RegradeJob.__table__, RegradeJobItem.__table__, StatsOutbox.__table__],
+    )
+    with engine.begin() as conn:
+        conn.execute(text("""
+            ALTER TABLE submitted_assignments
+                ADD COLUMN IF NOT EXISTS submission_file BYTEA,
+                ADD COLUMN IF NOT EXISTS submission_filename VARCHAR(255),
+                ADD COLUMN IF NOT EXISTS submission_error TEXT,
+                ADD COLUMN IF NOT EXISTS processing_lease_expires_at TIMESTAMP;
+        """))
+        # Replacing the constraint locks and re-validates the whole table, so
+        # only do it while it still lacks one of the statuses.
+        status_check = conn.execute(text("""
+            SELECT pg_get_constraintdef(oid)
+            FROM   pg_constraint
+            WHERE  conname = 'submitted_assignments_submission_status_check'
+              AND  conrelid = 'submitted_assignments'::regclass
+        """)).scalar()
+        statuses = [f"'{status}'" for status in SUBMISSION_STATUSES]
+        if status_check is None or any(status not in status_check for status in statuses):
+            conn.execute(text(f"""
+                ALTER TABLE submitted_assignments
+                    DROP CONSTRAINT IF EXISTS submitted_assignments_submission_status_check;
+                ALTER TABLE submitted_assignments
+                    ADD CONSTRAINT submitted_assignments_submission_status_check
+                    CHECK (submission_status IN ({", ".join(statuses)}));
+            """))
+        conn.execute(text("""
+            ALTER TABLE regrade_jobs
+                ADD COLUMN IF NOT EXISTS runner VARCHAR(255),
+                ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMP;
+        """))
+        conn.execute(text("""
+            ALTER TABLE stats_outbox ADD COLUMN IF NOT EXISTS failed_at TIMESTAMP;
+        """))
+        conn.execute(text("""
+            CREATE INDEX IF NOT EXISTS idx_stats_outbox_pending
+                ON stats_outbox (next_attempt_at) WHERE delivered_at IS NULL;
+        """))
@@ -0,0 +1,443 @@
+"""
+Assignment-wide re-grade jobs.
+
+After fixing a rubric a teacher can re-run retrieval and generation for every
+stored submission of an assignment instead of asking students to resubmit.
+
+- Submissions are sent to the RAG API by a worker pool capped at the job's
+  ``concurrency`` and spaced to ``REGRADE_REQUESTS_PER_MINUTE``.
+- Each finished submission is written to its ``regrade_job_items`` row straight
+  away, so a job interrupted by a restart resumes with the pending items only.
+- Students keep seeing their old feedback while the job runs; the new results
+  are copied into ``submitted_assignments`` in a single transaction at the end.
+- A job is claimed with a lease (``REGRADE_JOB_LEASE_S``) that its runner keeps
+  extending, so with several app workers only one of them runs it; a job whose
+  runner died is taken over once the lease expires.
+"""
+
+import os
+import json
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import text
+
+import database
+import stats_outbox
+from database import Assignment, Course, RegradeJob, RegradeJobItem, SubmittedAssignment
+
+REGRADE_CONCURRENCY = int(os.getenv("REGRADE_CONCURRENCY", "4"))
+REGRADE_MAX_CONCURRENCY = int(os.getenv("REGRADE_MAX_CONCURRENCY", "16"))
+REGRADE_REQUESTS_PER_MINUTE = float(os.getenv("REGRADE_REQUESTS_PER_MINUTE", "30"))
+REGRADE_MAX_ATTEMPTS = int(os.getenv("REGRADE_MAX_ATTEMPTS", "3"))
+REGRADE_JOB_LEASE_S = float(os.getenv("REGRADE_JOB_LEASE_S", "120"))
+
+RUNNER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# Jobs running in this process, so a resume request does not start a second runner.
+_running = {}
+
+
+def overall_mark(feedback_json: dict) -> float:
+    """The overall mark out of 20, from ``total_mark``/``maxMark`` or ``mark_out_of_20``."""
+    if "overall_evaluation" in feedback_json:
+        overall = feedback_json.get("overall_evaluation") or {}
+        total = overall.get("total_mark", overall.get("mark_out_of_20"))
+        max_mark = overall.get("maxMark") if "total_mark" in overall else 20
+        numbers = all(
+            isinstance(v, (int, float)) and not isinstance(v, bool) for v in (total, max_mark)
+        )
+        if not numbers or max_mark <= 0:
+            return 0
+        return round(total * 20.0 / max_mark, 2)
+    # Legacy fallback: use average of provided grades or 0.
+    grades_fallback = feedback_json.get("grades", [])
+    return sum(grades_fallback) / len(grades_fallback) if grades_fallback else 0
+
+
+class RateLimiter:
+    """Spaces calls evenly so a job stays under the provider's request rate."""
+
+    def __init__(self, per_minute: float):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0.0
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = asyncio.get_running_loop().time()
+            delay = self.next_at - now
+            self.next_at = max(now, self.next_at) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def create_regrade_job(db, assignment_id: int, teacher_id: int, concurrency: int) -> RegradeJob:
+    """Create a job with one pending item per submission that has its upload stored."""
+    submission_ids = [
+        row.submission_id
+        for row in db.query(SubmittedAssignment.submission_id).filter(
+            SubmittedAssignment.submitted_assignment_assignment_id == assignment_id,
+            SubmittedAssignment.submission_file.isnot(None),
+            # Still being graded for the first time.
+            SubmittedAssignment.submission_status != "processing",
+        )
+    ]
+    job = RegradeJob(
+        regrade_job_assignment_id=assignment_id,
+        requested_by_teacher_id=teacher_id,
+        status="pending",
+        concurrency=max(1, min(concurrency, REGRADE_MAX_CONCURRENCY)),
+        total_items=len(submission_ids),
+    )
+    db.add(job)
+    db.flush()
+    db.add_all(
+        RegradeJobItem(regrade_job_id=job.regrade_job_id, submission_id=submission_id)
+        for submission_id in submission_ids
+    )
+    db.commit()
+    db.refresh(job)
+    return job
+
+
+def start_regrade_job(regrade_job_id: int, rag_api_url: str) -> asyncio.Task:
+    task = _running.get(regrade_job_id)
+    if task is None or task.done():
+        task = asyncio.create_task(run_regrade_job(regrade_job_id, rag_api_url))
+        _running[regrade_job_id] = task
+    return task
+
+
+def resume_regrade_jobs(rag_api_url: str):
+    """Start every pending job, and every running one whose runner's lease expired.
+
+    Each job is claimed before it runs, so other workers resuming at the same
+    time skip it.
+    """
+    db = database.SessionLocal()
+    try:
+        job_ids = [
+            row.regrade_job_id
+            for row in db.query(RegradeJob.regrade_job_id).filter(
+                RegradeJob.status.in_(("pending", "running"))
+            )
+        ]
+    finally:
+        db.close()
+    for regrade_job_id in job_ids:
+        logging.info("Resuming regrade job %s", regrade_job_id)
+        start_regrade_job(regrade_job_id, rag_api_url)
+
+
+def _begin_job(regrade_job_id: int):
+    """Claim the job for this worker; ``None`` if it is finished or leased to another."""
+    db = database.SessionLocal()
+    try:
+        now = datetime.utcnow()
+        claimed = db.execute(
+            text("""
+                UPDATE regrade_jobs
+                SET    status = 'running',
+                       runner = :runner,
+                       lease_expires_at = :lease_until,
+                       started_at = COALESCE(started_at, :now)
+                WHERE  regrade_job_id = :job_id
+                  AND  (status = 'pending'
+                        OR (status = 'running'
+                            AND (runner = :runner
+                                 OR lease_expires_at IS NULL
+                                 OR lease_expires_at < :now)))
+                RETURNING regrade_job_assignment_id, concurrency
+            """),
+            {
+                "job_id": regrade_job_id,
+                "runner": RUNNER_ID,
+                "now": now,
+                "lease_until": now + timedelta(seconds=REGRADE_JOB_LEASE_S),
+            },
+        ).first()
+        if claimed is None:
+            db.rollback()
+            return None
+        assignment = db.get(Assignment, claimed.regrade_job_assignment_id)
+        course = db.get(Course, assignment.assignment_course_id)
+        pending = [
+            row.regrade_job_item_id
+            for row in db.query(RegradeJobItem.regrade_job_item_id).filter(
+                RegradeJobItem.regrade_job_id == regrade_job_id,
+                RegradeJobItem.status == "pending",
+            )
+        ]
+        plan = (
+            assignment.assignment_id,
+            course.course_id,
+            course.course_teacher_id,
+            course.course_name,
+            claimed.concurrency,
+            pending,
+        )
+        db.commit()
+        return plan
+    finally:
+        db.close()
+
+
+def _extend_lease(regrade_job_id: int) -> bool:
+    """Heartbeat; ``False`` if the job is no longer leased to this worker."""
+    db = database.SessionLocal()
+    try:
+        extended = (
+            db.query(RegradeJob)
+            .filter(
+                RegradeJob.regrade_job_id == regrade_job_id,
+                RegradeJob.runner == RUNNER_ID,
+                RegradeJob.status == "running",
+            )
+            .update(
+                {
+                    RegradeJob.lease_expires_at: datetime.utcnow()
+                    + timedelta(seconds=REGRADE_JOB_LEASE_S)
+                },
+                synchronize_session=False,
+            )
+        )
+        db.commit()
+        return bool(extended)
+    finally:
+        db.close()
+
+
+async def _heartbeat(regrade_job_id: int, runner_task: asyncio.Task):
+    while True:
+        await asyncio.sleep(REGRADE_JOB_LEASE_S / 3)
+        try:
+            extended = await asyncio.to_thread(_extend_lease, regrade_job_id)
+        except Exception as e:
+            # Retried on the next tick, well before the lease runs out.
+            logging.warning("Regrade job %s: extending the lease failed: %s", regrade_job_id, e)
+            continue
+        if not extended:
+            logging.warning("Regrade job %s: lease lost, stopping this runner", regrade_job_id)
+            runner_task.cancel()
+            return
+
+
+def _load_item(regrade_job_item_id: int):
+    db = database.SessionLocal()
+    try:
+        item, submission = (
+            db.query(RegradeJobItem, SubmittedAssignment)
+            .join(
+                SubmittedAssignment,
+                SubmittedAssignment.submission_id == RegradeJobItem.submission_id,
+            )
+            .filter(RegradeJobItem.regrade_job_item_id == regrade_job_item_id)
+            .one()
+        )
+        return (
+            submission.submitted_assignment_student_id,
+            submission.submission_filename or f"submission-{submission.submission_id}.pdf",
+            submission.submission_file,
+        )
+    finally:
+        db.close()
+
+
+def _checkpoint_item(regrade_job_id, regrade_job_item_id, attempts, feedback_json=None, error=None):
+    db = database.SessionLocal()
+    try:
+        item = db.get(RegradeJobItem, regrade_job_item_id)
+        if item.status != "pending":
+            # Already recorded by a runner that held the job before this one.
+            return
+        item.attempts += attempts
+        if feedback_json is not None:
+            item.status = "done"
+            item.ai_feedback = json.dumps(feedback_json)
+            item.ai_grade = [overall_mark(feedback_json)]
+            item.error = None
+            counter = RegradeJob.completed_items
+        else:
+            item.status = "failed"
+            item.error = error
+            counter = RegradeJob.failed_items
+        db.query(RegradeJob).filter(RegradeJob.regrade_job_id == regrade_job_id).update(
+            {counter: counter + 1}, synchronize_session=False
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _finish_job(regrade_job_id: int):
+    """Swap all re-graded results into submitted_assignments in one transaction."""
+    db = database.SessionLocal()
+    try:
+        job = (
+            db.query(RegradeJob)
+            .filter(RegradeJob.regrade_job_id == regrade_job_id)
+            .with_for_update()
+            .one()
+        )
+        if job.status != "running" or job.runner != RUNNER_ID:
+            return
+        pending = (
+            db.query(RegradeJobItem)
+            .filter(
+                RegradeJobItem.regrade_job_id == regrade_job_id,
+                RegradeJobItem.status == "pending",
+            )
+            .count()
+        )
+        if pending:
+            # Interrupted; the items stay checkpointed for the next resume.
+            return
+
+        regraded_ids = [
+            row.submission_id
+            for row in db.execute(
+                text("""
+                    UPDATE submitted_assignments AS s
+                    SET    ai_feedback = i.ai_feedback,
+                           ai_grade = i.ai_grade,
+                           submission_status = 'graded',
+                           submission_error = NULL,
+                           graded_at = :now
+                    FROM   regrade_job_items AS i
+                    WHERE  i.regrade_job_id = :job_id
+                      AND  i.status = 'done'
+                      AND  s.submission_id = i.submission_id
+                    RETURNING s.submission_id
+                """),
+                {"job_id": regrade_job_id, "now": datetime.utcnow()},
+            )
+        ]
+        # The new grades reach the student statistics like any other grading.
+        if regraded_ids:
+            course = (
+                db.query(Course)
+                .join(Assignment, Assignment.assignment_course_id == Course.course_id)
+                .filter(Assignment.assignment_id == job.regrade_job_assignment_id)
+                .first()
+            )
+            course_name = course.course_name if course else "Unknown Course"
+            for submission in db.query(SubmittedAssignment).filter(
+                SubmittedAssignment.submission_id.in_(regraded_ids)
+            ):
+                stats_outbox.add_submission_events(db, submission, course_name)
+        job.status = "failed" if job.failed_items and not job.completed_items else "completed"
+        if job.failed_items:
+            job.error = f"{job.failed_items} of {job.total_items} submissions could not be re-graded"
+        job.finished_at = datetime.utcnow()
+        job.lease_expires_at = None
+        db.commit()
+    finally:
+        db.close()
+
+
+async def _regrade_item(client, limiter, rag_api_url, regrade_job_id, regrade_job_item_id, form):
+    student_id, filename, file_bytes = await asyncio.to_thread(_load_item, regrade_job_item_id)
+    data = {**form, "student_id": str(student_id)}
+    error = None
+    for attempt in range(1, REGRADE_MAX_ATTEMPTS + 1):
+        await limiter.wait()
+        try:
+            response = await client.post(
+                f"{rag_api_url}/get-feedback/",
+                files={"file": (filename, file_bytes, "application/pdf")},
+                data=data,
+            )
+            response.raise_for_status()
+            feedback_data = response.json()
+            feedback_json = (
+                json.loads(feedback_data) if isinstance(feedback_data, str) else feedback_data
+            )
+            await asyncio.to_thread(
+                _checkpoint_item, regrade_job_id, regrade_job_item_id, attempt, feedback_json
+            )
+            return
+        except (httpx.HTTPError, json.JSONDecodeError) as e:
+            error = str(e) or type(e).__name__
+            logging.warning(
+                "Regrade item %s attempt %s failed: %s", regrade_job_item_id, attempt, error
+            )
+            if attempt < REGRADE_MAX_ATTEMPTS:
+                await asyncio.sleep(2**attempt)
+    await asyncio.to_thread(
+        _checkpoint_item, regrade_job_id, regrade_job_item_id, REGRADE_MAX_ATTEMPTS, None, error
+    )
+
+
+async def run_regrade_job(regrade_job_id: int, rag_api_url: str):
+    try:
+        plan = await asyncio.to_thread(_begin_job, regrade_job_id)
+        if plan is None:
+            return
+        assignment_id, course_id, teacher_id, course_name, concurrency, pending = plan
+        form = {
+            "assignment_id": str(assignment_id),
+            "course_id": str(course_id),
+            "teacher_id": str(teacher_id),
+            "course_name": course_name,
+            "embedder": os.getenv("RAG_EMBEDDER", "gitee"),
+            "provider": os.getenv("RAG_PROVIDER", "deepseek"),
+            # A re-grade must not copy pre-fix feedback from a similar essay.
+            "reuse_similar": "false",
+        }
+
+        semaphore = asyncio.Semaphore(concurrency)
+        limiter = RateLimiter(REGRADE_REQUESTS_PER_MINUTE)
+
+        async def worker(regrade_job_item_id):
+            async with semaphore:
+                try:
+                    await _regrade_item(
+                        client, limiter, rag_api_url, regrade_job_id, regrade_job_item_id, form
+                    )
+                except Exception as e:
+                    # Anything but an API error: fail this item, not its siblings.
+                    error = str(e) or type(e).__name__
+                    logging.error("Regrade item %s failed: %s", regrade_job_item_id, error)
+                    await asyncio.to_thread(
+                        _checkpoint_item, regrade_job_id, regrade_job_item_id, 0, None, error
+                    )
+
+        heartbeat = asyncio.ensure_future(_heartbeat(regrade_job_id, asyncio.current_task()))
+        try:
+            async with httpx.AsyncClient(timeout=300.0) as client:
+                # Every item settles before a failure (e.g. its checkpoint could
+                # not be written) fails the job.
+                results = await asyncio.gather(
+                    *(worker(item_id) for item_id in pending), return_exceptions=True
+                )
+        finally:
+            heartbeat.cancel()
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        await asyncio.to_thread(_finish_job, regrade_job_id)
+    except asyncio.CancelledError:
+        logging.info("Regrade job %s interrupted; it will resume from its checkpoint", regrade_job_id)
+        raise
+    except Exception as e:
+        logging.error(f"Regrade job {regrade_job_id} failed: {e}")
+        db = database.SessionLocal()
+        try:
+            db.query(RegradeJob).filter(
+                RegradeJob.regrade_job_id == regrade_job_id, RegradeJob.runner == RUNNER_ID
+            ).update(
+                {
+                    RegradeJob.status: "failed",
+                    RegradeJob.error: str(e),
+                    RegradeJob.lease_expires_at: None,
+                }
+            )
+            db.commit()
+        finally:
+            db.close()
+    finally:
+        _running.pop(regrade_job_id, None)
@@ -75,11 +75,59 @@ CREATE TABLE submitted_assignments (
     submission_id SERIAL PRIMARY KEY,
     submitted_assignment_student_id INTEGER NOT NULL REFERENCES students(student_id),
     submitted_assignment_assignment_id INTEGER NOT NULL REFERENCES assignments(assignment_id),
-    submission_status VARCHAR(50) DEFAULT 'submitted' CHECK (submission_status IN ('submitted', 'graded')),
+    submission_status VARCHAR(50) DEFAULT 'submitted'
+        CHECK (submission_status IN ('submitted', 'processing', 'graded', 'failed')),
+    submission_error TEXT,
     ai_feedback TEXT,
     ai_grade DECIMAL(5, 2)[],
     uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    graded_at TIMESTAMP
+    graded_at TIMESTAMP,
+    submission_file BYTEA,
+    submission_filename VARCHAR(255),
+    processing_lease_expires_at TIMESTAMP
+);
+
+CREATE TABLE regrade_jobs (
+    regrade_job_id SERIAL PRIMARY KEY,
+    regrade_job_assignment_id INTEGER NOT NULL REFERENCES assignments(assignment_id),
+    requested_by_teacher_id INTEGER NOT NULL REFERENCES teachers(teacher_id),
+    status VARCHAR(50) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'running', 'completed', 'failed')),
+    concurrency INTEGER NOT NULL,
+    total_items INTEGER NOT NULL DEFAULT 0,
+    completed_items INTEGER NOT NULL DEFAULT 0,
+    failed_items INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    runner VARCHAR(255),
+    lease_expires_at TIMESTAMP,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    started_at TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE TABLE regrade_job_items (
+    regrade_job_item_id SERIAL PRIMARY KEY,
+    regrade_job_id INTEGER NOT NULL REFERENCES regrade_jobs(regrade_job_id) ON DELETE CASCADE,
+    submission_id INTEGER NOT NULL REFERENCES submitted_assignments(submission_id),
+    status VARCHAR(50) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'done', 'failed')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    ai_feedback TEXT,
+    ai_grade DECIMAL(5, 2)[],
+    error TEXT,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(regrade_job_id, submission_id)
+);
+
+CREATE TABLE stats_outbox (
+    stats_outbox_id SERIAL PRIMARY KEY,
+    idempotency_key VARCHAR(255) NOT NULL UNIQUE,
+    kind VARCHAR(50) NOT NULL CHECK (kind IN ('submission', 'feedback')),
+    payload JSONB NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    delivered_at TIMESTAMP,
+    failed_at TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Performance indexes
@@ -87,6 +135,8 @@ CREATE INDEX idx_teachers_school_admin ON teachers(school_admin_id);
 CREATE INDEX idx_students_school_admin ON students(school_admin_id);
 CREATE INDEX idx_courses_teacher ON courses(course_teacher_id);
 CREATE INDEX idx_assignments_course ON assignments(assignment_course_id);
+CREATE INDEX idx_regrade_job_items_job ON regrade_job_items(regrade_job_id, status);
+CREATE INDEX idx_stats_outbox_pending ON stats_outbox(next_attempt_at) WHERE delivered_at IS NULL;
 
 -- Data validation constraints
 ALTER TABLE submitted_assignments ADD CONSTRAINT check_grade_range 
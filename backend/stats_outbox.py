@@ -0,0 +1,218 @@
+"""
+Transactional outbox for the RAG service's statistics.
+
+Grading used to post two statistics updates to the RAG API after the submission was
+saved, printing and dropping any failure, so the statistics drifted. Now the updates are
+added to ``stats_outbox`` in the same transaction as the graded submission, and a relay
+task delivers them in the background:
+
+- The relay claims a batch with ``FOR UPDATE SKIP LOCKED``, so several app workers can
+  run it side by side, and pushes each claimed row's ``next_attempt_at`` past a lease
+  before delivering.
+- A batch is delivered in one ``/statistics/batch`` request, applied by the RAG service
+  in one transaction. If the service is unreachable or fails (5xx) the batch is
+  retried with exponential backoff (capped, never given up).
+- If the service rejects a batch (a 4xx response), the batch is split in halves
+  and each half sent again, down to single rows, so one bad event does not hold
+  back the rows queued behind it. A row rejected ``STATS_OUTBOX_MAX_ATTEMPTS`` times
+  is dead-lettered (``failed_at`` set, ``last_error`` kept); clear ``failed_at`` to
+  retry it.
+- Each update carries an idempotency key; the RAG service applies a key once, so a
+  redelivery after a lost response does not count a submission twice.
+"""
+
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import text
+
+import database
+from database import StatsOutbox
+
+STATS_OUTBOX_BATCH_SIZE = int(os.getenv("STATS_OUTBOX_BATCH_SIZE", "500"))
+STATS_OUTBOX_POLL_S = float(os.getenv("STATS_OUTBOX_POLL_S", "2"))
+STATS_OUTBOX_LEASE_S = float(os.getenv("STATS_OUTBOX_LEASE_S", "60"))
+STATS_OUTBOX_MAX_BACKOFF_S = float(os.getenv("STATS_OUTBOX_MAX_BACKOFF_S", "600"))
+STATS_OUTBOX_MAX_ATTEMPTS = int(os.getenv("STATS_OUTBOX_MAX_ATTEMPTS", "10"))
+
+_relay_task = None
+
+
+def add_submission_events(db, submission, course_name: str):
+    """Queue the statistics for a graded submission; the caller commits."""
+    grade_list = [float(g) for g in submission.ai_grade or []]
+    # Assume average grade for now
+    avg_grade = sum(grade_list) / len(grade_list) if grade_list else 0
+    student_id = submission.submitted_assignment_student_id
+    # Keyed on the grading, so a later re-grade is a new event.
+    key = f"submission:{submission.submission_id}:{submission.graded_at:%Y%m%dT%H%M%S%f}"
+    db.add_all(
+        [
+            StatsOutbox(
+                idempotency_key=f"{key}:submission",
+                kind="submission",
+                payload={"student_id": student_id, "course_name": course_name, "grade": avg_grade},
+            ),
+            StatsOutbox(
+                idempotency_key=f"{key}:feedback",
+                kind="feedback",
+                payload={
+                    "student_id": student_id,
+                    "course_name": course_name,
+                    "feedback": submission.ai_feedback,
+                },
+            ),
+        ]
+    )
+
+
+def _claim_batch(limit: int):
+    db = database.SessionLocal()
+    try:
+        rows = db.execute(
+            text("""
+                UPDATE stats_outbox
+                SET    attempts = attempts + 1,
+                       next_attempt_at = :lease_until
+                WHERE  stats_outbox_id IN (
+                    SELECT stats_outbox_id
+                    FROM   stats_outbox
+                    WHERE  delivered_at IS NULL AND failed_at IS NULL
+                      AND  next_attempt_at <= :now
+                    ORDER  BY stats_outbox_id
+                    LIMIT  :limit
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING stats_outbox_id, idempotency_key, kind, payload, attempts
+            """),
+            {
+                "now": datetime.utcnow(),
+                "lease_until": datetime.utcnow() + timedelta(seconds=STATS_OUTBOX_LEASE_S),
+                "limit": limit,
+            },
+        ).fetchall()
+        db.commit()
+        return sorted(rows, key=lambda row: row.stats_outbox_id)
+    finally:
+        db.close()
+
+
+def _record_delivered(stats_outbox_ids: list):
+    db = database.SessionLocal()
+    try:
+        db.query(StatsOutbox).filter(StatsOutbox.stats_outbox_id.in_(stats_outbox_ids)).update(
+            {StatsOutbox.delivered_at: datetime.utcnow(), StatsOutbox.last_error: None},
+            synchronize_session=False,
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def _record_failed(stats_outbox_ids: list, error: str, rejected: bool = False) -> list:
+    """Back off each row by 2**attempts seconds, capped.
+
+    A ``rejected`` row that has used up ``STATS_OUTBOX_MAX_ATTEMPTS`` is
+    dead-lettered instead; returns the dead-lettered ids.
+    """
+    db = database.SessionLocal()
+    try:
+        rows = db.execute(
+            text("""
+                UPDATE stats_outbox
+                SET    next_attempt_at = :now + LEAST(power(2, attempts), :max_backoff)
+                                                * interval '1 second',
+                       failed_at = CASE WHEN :rejected AND attempts >= :max_attempts
+                                        THEN :now END,
+                       last_error = :error
+                WHERE  stats_outbox_id = ANY(:ids)
+                RETURNING stats_outbox_id, failed_at
+            """),
+            {
+                "now": datetime.utcnow(),
+                "max_backoff": STATS_OUTBOX_MAX_BACKOFF_S,
+                "max_attempts": STATS_OUTBOX_MAX_ATTEMPTS,
+                "rejected": rejected,
+                "error": error,
+                "ids": stats_outbox_ids,
+            },
+        ).fetchall()
+        db.commit()
+        return [row.stats_outbox_id for row in rows if row.failed_at is not None]
+    finally:
+        db.close()
+
+
+async def _deliver(client: httpx.AsyncClient, rag_api_url: str, rows: list):
+    """Deliver ``rows``; on a 4xx rejection, halve the batch until the bad rows are isolated."""
+    events = [
+        {"type": row.kind, "idempotency_key": row.idempotency_key, **row.payload} for row in rows
+    ]
+    ids = [row.stats_outbox_id for row in rows]
+    try:
+        response = await client.post(f"{rag_api_url}/statistics/batch", json={"events": events})
+    except httpx.HTTPError as e:
+        error = str(e) or type(e).__name__
+    else:
+        if response.is_success:
+            await asyncio.to_thread(_record_delivered, ids)
+            return
+        error = f"{response.status_code}: {response.text[:500]}"
+        if response.is_client_error:
+            await _rejected(client, rag_api_url, rows, error)
+            return
+    # The service is unreachable or failing (5xx): back off the batch as a whole.
+    logging.warning(
+        "Statistics outbox: delivering %s updates failed (%s); will retry", len(rows), error
+    )
+    await asyncio.to_thread(_record_failed, ids, error)
+
+
+async def _rejected(client: httpx.AsyncClient, rag_api_url: str, rows: list, error: str):
+    # The service rejected the events themselves (4xx): isolate the bad rows.
+    if len(rows) > 1:
+        middle = len(rows) // 2
+        await _deliver(client, rag_api_url, rows[:middle])
+        await _deliver(client, rag_api_url, rows[middle:])
+        return
+    dead = await asyncio.to_thread(_record_failed, [rows[0].stats_outbox_id], error, True)
+    if dead:
+        logging.error(
+            "Statistics outbox: %s rejected %s times, giving up (%s)",
+            rows[0].idempotency_key,
+            STATS_OUTBOX_MAX_ATTEMPTS,
+            error,
+        )
+    else:
+        logging.warning("Statistics outbox: %s rejected (%s)", rows[0].idempotency_key, error)
+
+
+async def deliver_pending(client: httpx.AsyncClient, rag_api_url: str) -> int:
+    """Deliver one batch; returns how many rows were claimed."""
+    rows = await asyncio.to_thread(_claim_batch, STATS_OUTBOX_BATCH_SIZE)
+    if rows:
+        await _deliver(client, rag_api_url, rows)
+    return len(rows)
+
+
+async def run_relay(rag_api_url: str):
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        while True:
+            try:
+                claimed = await deliver_pending(client, rag_api_url)
+            except Exception as e:
+                logging.error(f"Statistics outbox relay failed: {e}")
+                claimed = 0
+            # Keep draining while there is a backlog.
+            if claimed < STATS_OUTBOX_BATCH_SIZE:
+                await asyncio.sleep(STATS_OUTBOX_POLL_S)
+
+
+def start_relay(rag_api_url: str) -> asyncio.Task:
+    global _relay_task
+    if _relay_task is None or _relay_task.done():
+        _relay_task = asyncio.create_task(run_relay(rag_api_url))
+    return _relay_task
@@ -0,0 +1,283 @@
+"""
+Background grading of student submissions.
+
+``POST /assignments/{id}/submit`` stores the upload as a ``processing`` row and
+returns 202 straight away; grading (the RAG API call, which can take minutes)
+runs here, off the request. Clients poll ``GET /submissions/{id}`` until the
+row is ``graded`` or ``failed``.
+
+- The upload is kept on the row, so a submission left ``processing`` by a
+  restart is graded again. The worker grading a row holds it with a lease
+  (``processing_lease_expires_at``) that it keeps extending; every app worker
+  periodically claims rows whose lease expired, so each row is graded by
+  one worker at a time.
+- A failed call leaves ``submission_status = 'failed'`` and the reason in
+  ``submission_error``; the student can submit again.
+- Statistics for the RAG service are queued in ``stats_outbox`` in the same
+  transaction as the grade (see ``stats_outbox``).
+"""
+
+import os
+import json
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import text
+
+import database
+import regrade
+import stats_outbox
+from database import Assignment, Course, SubmittedAssignment
+
+SUBMISSION_GRADING_TIMEOUT_S = float(os.getenv("SUBMISSION_GRADING_TIMEOUT_S", "300"))
+SUBMISSION_PROCESSING_LEASE_S = float(os.getenv("SUBMISSION_PROCESSING_LEASE_S", "60"))
+# How often each worker looks for processing rows whose lease expired.
+SUBMISSION_RESUME_INTERVAL_S = float(os.getenv("SUBMISSION_RESUME_INTERVAL_S", "60"))
+
+# Submissions being graded in this process, so a resume does not start a second task.
+_running = {}
+_sweeper_task = None
+
+
+def rag_feedback_request(
+    student_id: int,
+    assignment_id: int,
+    course,
+    filename: str,
+    file_bytes: bytes,
+    content_type: str = "application/pdf",
+):
+    """Form fields and file for the RAG API feedback endpoints.
+
+    ``course`` needs ``course_id``, ``course_teacher_id`` and ``course_name``.
+    """
+    files = {"file": (filename, file_bytes, content_type)}
+    data = {
+        "student_id": str(student_id),
+        "assignment_id": str(assignment_id),
+        "course_id": str(course.course_id),
+        # Lets the RAG service count the feedback in the teacher's analytics.
+        "teacher_id": str(course.course_teacher_id),
+        "course_name": course.course_name,
+        # Embedder/provider preferences for the RAG API (defaults set in env)
+        "embedder": os.getenv("RAG_EMBEDDER", "gitee"),
+        "provider": os.getenv("RAG_PROVIDER", "deepseek"),
+    }
+    return files, data
+
+
+def _lease_until() -> datetime:
+    return datetime.utcnow() + timedelta(seconds=SUBMISSION_PROCESSING_LEASE_S)
+
+
+def create_submission(db, student_id: int, assignment_id: int, file_bytes, filename):
+    submission = SubmittedAssignment(
+        submitted_assignment_student_id=student_id,
+        submitted_assignment_assignment_id=assignment_id,
+        submission_status="processing",
+        submission_file=file_bytes,
+        submission_filename=filename,
+        processing_lease_expires_at=_lease_until(),
+    )
+    db.add(submission)
+    db.commit()
+    db.refresh(submission)
+    return submission
+
+
+def apply_feedback(db, submission: SubmittedAssignment, feedback_json: dict):
+    """Grade ``submission`` and queue its statistics; the caller commits both together."""
+    submission.submission_status = "graded"
+    submission.submission_error = None
+    submission.ai_feedback = json.dumps(feedback_json)
+    submission.ai_grade = [regrade.overall_mark(feedback_json)]
+    submission.graded_at = datetime.utcnow()
+    db.add(submission)
+    db.flush()
+    course = (
+        db.query(Course)
+        .join(Assignment, Assignment.assignment_course_id == Course.course_id)
+        .filter(Assignment.assignment_id == submission.submitted_assignment_assignment_id)
+        .first()
+    )
+    stats_outbox.add_submission_events(
+        db, submission, course.course_name if course else "Unknown Course"
+    )
+
+
+def start_grading(submission_id: int, rag_api_url: str) -> asyncio.Task:
+    task = _running.get(submission_id)
+    if task is None or task.done():
+        task = asyncio.create_task(grade_submission(submission_id, rag_api_url))
+        _running[submission_id] = task
+        task.add_done_callback(lambda _: _running.pop(submission_id, None))
+    return task
+
+
+def _claim_expired_submissions() -> list:
+    """Lease every processing row whose lease expired to this worker."""
+    db = database.SessionLocal()
+    try:
+        rows = db.execute(
+            text("""
+                UPDATE submitted_assignments
+                SET    processing_lease_expires_at = :lease_until
+                WHERE  submission_id IN (
+                    SELECT submission_id
+                    FROM   submitted_assignments
+                    WHERE  submission_status = 'processing'
+                      AND  (processing_lease_expires_at IS NULL
+                            OR processing_lease_expires_at < :now)
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING submission_id
+            """),
+            {"now": datetime.utcnow(), "lease_until": _lease_until()},
+        ).fetchall()
+        db.commit()
+        return [row.submission_id for row in rows]
+    finally:
+        db.close()
+
+
+def _extend_lease(submission_id: int) -> bool:
+    db = database.SessionLocal()
+    try:
+        extended = (
+            db.query(SubmittedAssignment)
+            .filter(
+                SubmittedAssignment.submission_id == submission_id,
+                SubmittedAssignment.submission_status == "processing",
+            )
+            .update(
+                {SubmittedAssignment.processing_lease_expires_at: _lease_until()},
+                synchronize_session=False,
+            )
+        )
+        db.commit()
+        return bool(extended)
+    finally:
+        db.close()
+
+
+async def _heartbeat(submission_id: int):
+    while True:
+        await asyncio.sleep(SUBMISSION_PROCESSING_LEASE_S / 3)
+        try:
+            if not await asyncio.to_thread(_extend_lease, submission_id):
+                return
+        except Exception as e:
+            logging.warning("Submission %s: extending the lease failed: %s", submission_id, e)
+
+
+async def resume_processing_submissions(rag_api_url: str) -> int:
+    """Restart grading of the processing submissions no live worker holds."""
+    submission_ids = await asyncio.to_thread(_claim_expired_submissions)
+    for submission_id in submission_ids:
+        logging.info("Resuming grading of submission %s", submission_id)
+        start_grading(submission_id, rag_api_url)
+    return len(submission_ids)
+
+
+async def run_resume_sweeper(rag_api_url: str):
+    while True:
+        try:
+            await resume_processing_submissions(rag_api_url)
+        except Exception as e:
+            logging.error(f"Resuming processing submissions failed: {e}")
+        await asyncio.sleep(SUBMISSION_RESUME_INTERVAL_S)
+
+
+def start_resume_sweeper(rag_api_url: str) -> asyncio.Task:
+    global _sweeper_task
+    if _sweeper_task is None or _sweeper_task.done():
+        _sweeper_task = asyncio.create_task(run_resume_sweeper(rag_api_url))
+    return _sweeper_task
+
+
+def _load_submission(submission_id: int):
+    db = database.SessionLocal()
+    try:
+        row = (
+            db.query(
+                SubmittedAssignment.submitted_assignment_student_id,
+                SubmittedAssignment.submitted_assignment_assignment_id,
+                SubmittedAssignment.submission_filename,
+                SubmittedAssignment.submission_file,
+                Course.course_id,
+                Course.course_teacher_id,
+                Course.course_name,
+            )
+            .join(
+                Assignment,
+                Assignment.assignment_id == SubmittedAssignment.submitted_assignment_assignment_id,
+            )
+            .join(Course, Course.course_id == Assignment.assignment_course_id)
+            .filter(
+                SubmittedAssignment.submission_id == submission_id,
+                SubmittedAssignment.submission_status == "processing",
+            )
+            .first()
+        )
+        return row
+    finally:
+        db.close()
+
+
+def _finish_submission(submission_id: int, feedback_json: dict | None, error: str | None = None):
+    db = database.SessionLocal()
+    try:
+        submission = db.get(SubmittedAssignment, submission_id)
+        if submission is None or submission.submission_status != "processing":
+            return
+        if feedback_json is not None:
+            apply_feedback(db, submission, feedback_json)
+        else:
+            submission.submission_status = "failed"
+            submission.submission_error = error
+        db.commit()
+    finally:
+        db.close()
+
+
+async def request_feedback(client, rag_api_url: str, files, data) -> dict:
+    response = await client.post(f"{rag_api_url}/get-feedback/", files=files, data=data)
+    response.raise_for_status()
+    feedback_data = response.json()
+    return json.loads(feedback_data) if isinstance(feedback_data, str) else feedback_data
+
+
+async def grade_submission(submission_id: int, rag_api_url: str):
+    heartbeat = asyncio.ensure_future(_heartbeat(submission_id))
+    try:
+        loaded = await asyncio.to_thread(_load_submission, submission_id)
+        if loaded is None:
+            return
+        files, data = rag_feedback_request(
+            loaded.submitted_assignment_student_id,
+            loaded.submitted_assignment_assignment_id,
+            loaded,
+            loaded.submission_filename,
+            loaded.submission_file,
+        )
+        async with httpx.AsyncClient(timeout=SUBMISSION_GRADING_TIMEOUT_S) as client:
+            feedback_json = await request_feedback(client, rag_api_url, files, data)
+        await asyncio.to_thread(_finish_submission, submission_id, feedback_json)
+    except asyncio.CancelledError:
+        logging.info(
+            "Grading of submission %s interrupted; it resumes once its lease expires", submission_id
+        )
+        raise
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        error = f"Error calling RAG API: {str(e) or type(e).__name__}"
+        logging.warning("Submission %s could not be graded: %s", submission_id, error)
+        await asyncio.to_thread(_finish_submission, submission_id, None, error)
+    except Exception as e:
+        # Never leave the row processing: the student would poll forever.
+        error = f"Grading failed: {str(e) or type(e).__name__}"
+        logging.exception("Submission %s could not be graded", submission_id)
+        await asyncio.to_thread(_finish_submission, submission_id, None, error)
+    finally:
+        heartbeat.cancel()
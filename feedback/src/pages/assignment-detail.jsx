@@ -1,12 +1,14 @@
 import React, { useState, useEffect } from 'react';
 import { Container, Row, Col, Card, Badge, Button, Alert, Form } from 'react-bootstrap';
 import { useParams, useNavigate } from 'react-router-dom';
-import { assignmentAPI, courseAPI } from '../services/api';
+import { assignmentAPI, courseAPI, submissionAPI } from '../services/api';
 import { formatDate } from '../utils/helpers';
 import { useAuth } from '../context/AuthContext';
 import { StudentNav } from '../components/Navbar';
 import ChromeDinoGame from 'react-chrome-dino';
 
+const SUBMISSION_POLL_MS = 3000;
+
 const AssignmentDetailsPage = () => {
   const { id } = useParams();
   const navigate = useNavigate();
@@ -47,6 +49,23 @@ const AssignmentDetailsPage = () => {
     }
   }, [id, user.role]);
 
+  // Grading runs in the background; poll until the submission leaves 'processing'.
+  useEffect(() => {
+    if (submission?.submission_status !== 'processing') {
+      return undefined;
+    }
+    const timer = setTimeout(async () => {
+      try {
+        const res = await submissionAPI.getById(submission.submission_id);
+        setSubmission(res.data);
+      } catch (err) {
+        console.error("Failed to refresh submission:", err);
+        setSubmission({ ...submission });
+      }
+    }, SUBMISSION_POLL_MS);
+    return () => clearTimeout(timer);
+  }, [submission]);
+
   const handleFileChange = (e) => {
     setSelectedFile(e.target.files[0]);
   };
@@ -186,9 +205,9 @@ const AssignmentDetailsPage = () => {
                         <Button type="submit" disabled={isSubmitting || !selectedFile}>
                           {isSubmitting ? 'Submitting...' : 'Submit Assignment'}
                         </Button>
-                        {isSubmitting && !submission && (
+                        {(isSubmitting || submission?.submission_status === 'processing') && (
                           <div style={{ position: "relative" }}>
-                            <ChromeDinoGame gameOver={!isSubmitting} />
+                            <ChromeDinoGame gameOver={false} />
                             {/* Cover the duplicate (if it appears) */}
                             <div
                               style={{
@@ -214,6 +233,17 @@ const AssignmentDetailsPage = () => {
                         <Card.Title className="my-2 mx-2"><h4>Your Submission</h4></Card.Title>
                         <div className="bg-light p-3 rounded">
                           <p><strong>Submitted:</strong> {formatDate(submission.uploaded_at)}</p>
+                          {submission.submission_status === 'processing' && (
+                            <p>
+                              <strong>Status:</strong>
+                              <Badge bg="warning" className="ms-2">Grading</Badge>
+                            </p>
+                          )}
+                          {submission.submission_status === 'failed' && (
+                            <Alert variant="danger">
+                              Your submission could not be graded. Please submit it again.
+                            </Alert>
+                          )}
                           {submission.submission_status === 'graded' && (
                             <>
                               <p>
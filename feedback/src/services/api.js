@@ -181,4 +181,10 @@ export const assignmentAPI = {
   },
 };
 
+// Submission API calls
+export const submissionAPI = {
+  // Poll after submitting: the submission is 'processing' until it is 'graded' or 'failed'.
+  getById: (id) => api.get(`/submissions/${id}`),
+};
+
 export default api;